@@ -1,89 +1,175 @@
 import time
 
 import requests
-from selenium import webdriver
-from selenium.common import TimeoutException
 import json
-from selenium.webdriver.edge.service import Service as EdgeService
-from webdriver_manager.microsoft import EdgeChromiumDriverManager
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from datetime import datetime, timezone
-from urllib.parse import urlencode
+from datetime import datetime
 import logging
+import functools
+import itertools
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging_setup import LazyJSON
+from cookie_store import get_cookie_store
+from http_session import get_http_session
+from upstream_governor import get_upstream_governor
+from request_templates import get_request_templates
+from result_cache import RESULT_CACHE_DEFAULTS, get_sim_result_cache
+from history_sync import get_history_sync_store
+from sim_store import get_sim_store
+from time_format import datetime_from_epoch_ms, datetime_from_epoch_s, epoch_ms, format_epoch_ms
+from file_utils import file_lock
+from settings import load_settings
+from single_flight import SingleFlight, SingleFlightTimeout
+from metrics import span
+from sim_history import ChangeHistoryError, collapse_change_history, filter_change_records, parse_change_history_page
 
 
-# 配置日志格式、级别和输出方式
-handlers = [
-    logging.StreamHandler(),  # 输出到终端
-    logging.FileHandler("app.log", encoding="utf-8",mode='w')  # 输出到文件（可选）
-]
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=handlers,  # 输出到终端  # 日志写入文件
-)
-
 def log_method(func):
     '''
     装饰器，用于给每个函数在运行前和后添加打印，用于后续日志
     :param func:
     :return:
     '''
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        logging.info(f"========Start of {func.__name__}========")
+        # DEBUG未开启时直接调用，不产生任何日志开销
+        if not logging.root.isEnabledFor(logging.DEBUG):
+            return func(*args, **kwargs)
+        logging.debug("========Start of %s========", func.__name__)
         result = func(*args, **kwargs)
-        logging.info(f"========End of {func.__name__}========")
+        logging.debug("========End of %s========", func.__name__)
         return result
     return wrapper
 
 
+# 登录相关的默认配置，可在service_settings.json的login段中按项目覆盖
+LOGIN_DEFAULTS = {
+    # 登录失败后多少秒内不再尝试登录
+    "failure_cooldown": 60,
+    # 有界面的浏览器等待人工输入邮箱验证码的最长时间（秒）；无头模式遇到验证码直接失败
+    "verification_timeout": 300,
+    # 其他请求等待进行中的登录的最长时间（秒），超时按更新失败处理
+    "wait_timeout": 420,
+}
+
+# 同一项目的并发cookies更新合并为一次登录
+_login_flight = SingleFlight()
+# 各项目最近一次登录失败的时间
+_login_failures = {}
+# get_sim_data可以选择的部分：基础信息和变更历史
+SIM_DATA_SECTIONS = frozenset(("basic", "history"))
+
+# 同一张卡的并发查询合并为一次上游请求，键为(项目, 查询值)，只查一部分时键中再加上该部分
+_lookup_flight = SingleFlight()
+# 正在后台重新获取的(项目, 查询值)，同一张卡同时只提交一次
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+_revalidate_pool = None
+
+
+def _get_revalidate_pool():
+    global _revalidate_pool
+    with _revalidating_lock:
+        if _revalidate_pool is None:
+            workers = load_settings('result_cache', RESULT_CACHE_DEFAULTS)["revalidate_workers"]
+            _revalidate_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='revalidate')
+        return _revalidate_pool
+
+
+def _revalidate(project, search_value, sim_basic_data):
+    """
+    后台重新获取一张卡并写入缓存，cookies失效时更新一次后重试
+    :param sim_basic_data: 仍在有效期内的基础信息，有则只重新获取变更历史
+    """
+    key = (project, str(search_value))
+    try:
+        sim_info_getter = SIMInfoGetter(project, search_value)
+        sim_data, _ = _lookup_flight.do(key, lambda: sim_info_getter.fetch_sim_data(
+            sim_basic_data, basic_refreshed=sim_basic_data is None))
+        if not sim_data["success"] and sim_data.get("error_message") == "cookies_need_update":
+            if sim_info_getter.update_cookies():
+                _lookup_flight.do(key, lambda: sim_info_getter.fetch_sim_data(
+                    sim_basic_data, basic_refreshed=sim_basic_data is None))
+    except Exception:
+        logging.exception('后台重新获取%s失败', search_value)
+    finally:
+        with _revalidating_lock:
+            _revalidating.discard(key)
+
+
+def lookup_stats():
+    """
+    :return: 在途的查询（section为basic、history或full）及各自的等待数、累计上游请求次数和复用次数、合并比例以及后台重新获取数
+    """
+    flight_stats = _lookup_flight.stats()
+    with _revalidating_lock:
+        revalidating = len(_revalidating)
+    executions = flight_stats["executions"]
+    shared = flight_stats["shared"]
+    return {
+        "in_flight": [
+            # 只查一部分时键为(项目, 查询值或simId, 部分)，完整查询的键只有前两项
+            {"project": key[0], "search_value": key[1], "section": key[2] if len(key) > 2 else "full",
+             "waiters": waiters}
+            for key, waiters in flight_stats["in_flight"].items()
+        ],
+        "executions": executions,
+        "shared": shared,
+        "collapse_ratio": round((executions + shared) / executions, 3) if executions else None,
+        "revalidating": revalidating,
+    }
+
+
 class SIMInfoGetter:
-    def __init__(self, project = None, search_value = None):
-        logging.info('新建实例对象项目为：%s', project)
+    def __init__(self, project = None, search_value = None, load_cookies = True):
+        '''
+        :param load_cookies: 是否在创建时加载cookies，项目还没有cookies时会登录；只用于更新cookies的实例传False
+        '''
+        logging.debug('新建实例对象项目为：%s', project)
         # 需要查询的MOS项目
         self.__project__ = project
         # 传入的搜索值，ICCID或者VIN
         self.__search_value__ = search_value
         # cookie file文件路径
         self.cookies_file_path = 'config/cookies_for_request.json'
+        # 进程级共享的cookies缓存，所有实例共用，避免每次请求都读取cookies文件
+        self.cookie_store = get_cookie_store(self.cookies_file_path)
         # 当前项目的cookies_dict
         self.__project_cookies_dict__ = {}
+        # 最近一次get_sim_data结果的内容哈希，结果来自或写入了结果缓存时才有值
+        self.sim_data_etag = None
         # 加载Cookie数据
-        self.load_cookies()
-        logging.debug('当前项目cookies的全局字典为：%s', json.dumps(self.__project_cookies_dict__, indent=4))
+        if load_cookies:
+            self.load_cookies()
+        logging.debug('当前项目cookies的全局字典为：%s', LazyJSON(self.__project_cookies_dict__))
 
     @staticmethod
-    @log_method
     def timestamp_processor(input_value, timestamp_level):
         """
         时间戳处理器,默认输出的都是UTC时间
+        批量处理Jasper返回的毫秒级时间请使用time_format.format_epoch_ms_batch
         :param input_value: 输入的值
-        :param timestamp_level: 需要转化的时间戳的级别，秒级('s')还是毫秒级('ms')
+        :param timestamp_level: 时间戳的级别，秒级('s')还是毫秒级('ms')；输入为时间戳时表示输入的级别，
+                                输入为datetime时表示输出的级别
         :return:datetime或者是时间戳(整数或者浮点)
         """
         # 如果输入的是datatime格式，说明是希望转换成时间戳
-        if type(input_value) == datetime:
+        if isinstance(input_value, datetime):
             # 转换成秒级时间戳
             if timestamp_level == 's':
                 return input_value.timestamp()
             # 转换成毫秒级时间戳
             if timestamp_level == 'ms':
-                return int(input_value.timestamp() * 1000)
+                return epoch_ms(input_value)
         # 如果输入的是时间戳（整数或者浮点），说明是希望转换成datetime类型
-        elif type(input_value) == int or type(input_value) == float:
+        elif isinstance(input_value, (int, float)):
             # 输入的是秒级时间戳
             if timestamp_level == 's':
-                input_value = input_value/1000
-                return datetime.fromtimestamp(input_value, tz=timezone.utc)
+                return datetime_from_epoch_s(input_value)
             # 输入的是毫秒级时间戳
             if timestamp_level == 'ms':
-                return datetime.fromtimestamp(input_value, tz=timezone.utc)
+                return datetime_from_epoch_ms(input_value)
 
     @log_method
     def load_cookies(self):
@@ -91,35 +177,20 @@ class SIMInfoGetter:
         用于加载cookies
         :return:直接修改全局变量 self.__project_cookies_dict__，返回True和False
         """
-        all_cookies_json = {}
-        try:
-            logging.info('尝试打开cookies json文件')
-            # 能够打开文件并且读取到数据
-            all_cookies_json = self.read_all_cookies()
-            try:
-                # 提取当前项目的request cookies dict
-                self.__project_cookies_dict__ = all_cookies_json[self.__project__]
-                # 如果Cookie列表里面包含当前项目
-                logging.info("cookies文件内容包含当前项目")
-                logging.debug('成功获得当前项目cookies字典：%s', json.dumps(self.__project_cookies_dict__, indent=4))
-                return True
-            except KeyError as e:
-                # Cookie列表里面没有当前项目，则在字典中创建当前项目键值的空列表并开始更新Cookie
-                logging.debug('cookies文件内容缺少字段：%s', e)
-                logging.info("cookies文件内容没有包含当前项目")
-                logging.info("开始获取当前项目的cookies")
-                return self.update_cookies()
-        # 文件未找到,则创建文件并开始更新cookie
-        except FileNotFoundError:
-            logging.info('cookies文件不存在')
-            logging.info("创建cookies文件")
-            logging.info("开始获取当前项目的cookies")
-            return self.update_cookies()
-        # 文件为空的话就更新Cookie进去
-        except json.decoder.JSONDecodeError:
-            logging.info("cookies文件为空")
+        logging.debug('从cookies缓存中读取当前项目cookies')
+        with span('cookie_load', self.__project__) as timing:
+            project_cookies_dict = self.cookie_store.get(self.__project__)
+            if project_cookies_dict is None:
+                timing["outcome"] = "cookies_missing"
+        # cookies文件不存在、为空或者没有包含当前项目，则开始更新Cookie
+        if project_cookies_dict is None:
+            logging.info("cookies文件内容没有包含当前项目")
             logging.info("开始获取当前项目的cookies")
             return self.update_cookies()
+        self.__project_cookies_dict__ = project_cookies_dict
+        logging.debug("cookies文件内容包含当前项目")
+        logging.debug('成功获得当前项目cookies字典：%s', LazyJSON(self.__project_cookies_dict__))
+        return True
 
     @log_method
     def process_cookies_dict(self):
@@ -129,11 +200,11 @@ class SIMInfoGetter:
         """
         cookies_dict = {}
         cookies_list_from_webdriver = self.webdriver_cookies_getter()
-        logging.debug(f'webdriver获取到的cookies list为：{json.dumps(cookies_list_from_webdriver, indent=4)}')
+        logging.debug('webdriver获取到的cookies list为：%s', LazyJSON(cookies_list_from_webdriver))
         # 如果cookies_list不为空
         if cookies_list_from_webdriver:
             cookies_dict = {cookie['name']:cookie['value'] for cookie in cookies_list_from_webdriver}
-            logging.debug(f'处理后的cookies dict:{json.dumps(cookies_dict, indent=4)}')
+            logging.debug('处理后的cookies dict:%s', LazyJSON(cookies_dict))
             return cookies_dict
         else:
             return cookies_dict
@@ -141,262 +212,130 @@ class SIMInfoGetter:
     @log_method
     def webdriver_cookies_getter(self):
         """
-        用于执行webdriver登录
-        :return: 返回获取到的cookies_dict
+        用于执行webdriver登录，selenium只在真正需要登录时随jasper_login加载
+        :return: 返回获取到的cookies_list
         """
-        # 初始化webdriver
-        # 加载配置文件中的用户名和密码
-        logging.debug('开始加载配置文件内容：')
-        with open('.\\config\\mno_account.json', 'r') as f:
-            mno_account_info_dict = json.load(f)
-            username = mno_account_info_dict[self.__project__]['ID']
-            password = mno_account_info_dict[self.__project__]['PW']
-            logging.debug('用户名和密码配置加载完成')
-        # 加载配置文件中的链接和元素
-        with open('.\\config\\url_and_element.json', 'r') as f:
-            url_and_element_dict = json.load(f)
-            url_login = url_and_element_dict['urls']['Jasper_login']
-            url_home = url_and_element_dict['urls']['Jasper_Homepage']
-            element_xpath_dict = url_and_element_dict['element_xpath']
-            logging.debug('url和页面元素配置加载完成')
-        options = Options()
-        # options.add_argument("--headless")  # 无头模式
-        options.add_argument("--no-sandbox")  # 禁用沙盒（Docker 需要）
-        options.add_argument("--disable-dev-shm-usage")  # 避免内存问题
-
-        # 初始化 WebDriver
-        driver = webdriver.Chrome(
-            # 自动检测浏览器版本并下载对应驱动
-            service=Service(ChromeDriverManager().install()),
-            options=options
-        )
-
-        driver.get(url_login)  # 正常访问网页
-        logging.info('访问： %s', url_login)
-
-        try:
-            with open('config/cookies_for_webdriver.json', 'r') as f:
-                logging.info('读取cookies_for_webdriver')
-                try:
-                    cookies_for_webdriver = json.load(f)
-                except json.decoder.JSONDecodeError:
-                    logging.info('cookies_for_webdriver没有内容')
-                    cookies_for_webdriver = {}
-            if cookies_for_webdriver != {} and self.__project__ in cookies_for_webdriver.keys():
-                logging.info('开始加载cookies到webdriver')
-                driver.delete_all_cookies()
-                for cookie in cookies_for_webdriver[self.__project__]:
-                    driver.add_cookie(cookie)
-                driver.get(url_login)
-                logging.info('刷新driver完成')
-                logging.debug(f'当前页面名：{driver.title}')
-                if 'Welcome to the Control Center!' in driver.title:
-                    pass
-                elif '欢迎' in driver.title:
-                    logging.info('登录成功')
-                    cookies_list = driver.get_cookies()
-                    return cookies_list
-            else:
-                logging.info('cookies_for_webdriver没有当前项目的内容')
-                logging.info('开始获取cookies for webdriver')
-                pass
-        except FileNotFoundError:
-            pass
-        logging.info('开始更新cookies')
-        cookies_list = self.webdriver_login(driver, element_xpath_dict, username, password)
-        return cookies_list
-
-
-
-    def webdriver_login(self,driver,element_xpath_dict,username,password):
-        logging.info('开始Webdriver登录')
-        # 找到用户名、密码和登录按钮
-        try:
-            # 输入用户名和密码
-            username_input_box = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, element_xpath_dict['Input_box']['login_username']))
-            )
-            username_input_box.send_keys(username)
-            password_input_box = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, element_xpath_dict['Input_box']['login_password']))
-            )
-            password_input_box.send_keys(password)
-            logging.info('输入用户名和密码')
-            # 提交登录表单
-            login_button = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, element_xpath_dict['button']['login_submit']))
-            )
-            login_button.click()
-            logging.info('点击登录')
-            logging.debug(f'当前Webdriver中的cookies:{driver.get_cookies()}')
-        except TimeoutException:
-            logging.info('10秒内未找到元素')
-            cookies_dict = []
-            return cookies_dict
-        while True:
-            try:
-                # 通过检查SIM卡搜索框有没有出现来判断检查是否登录成功
-                WebDriverWait(driver, 30).until(
-                    EC.title_contains('欢迎')
-                    # EC.presence_of_element_located((By.XPATH, element_xpath_dict['Input_box']['search_sim']))
-                )
-                logging.info('登录成功')
-                cookies_list = driver.get_cookies()
-                # 删除所有的有效期字段
-                # for cookie in cookies_list:
-                #     if 'expiry' in cookie.keys():
-                #         del cookie['expiry']
-                logging.info('写入新的cookies到cookies_for_webdriver.json')
-                with open('.\\config\\cookies_for_webdriver.json', 'r') as f:
-                    # 有内容则加载到cookies_dict中
-                    try:
-                        cookies_dict = json.load(f)
-                    # 没有内容则令cookies_dict为空
-                    except json.decoder.JSONDecodeError:
-                        cookies_dict = {}
-                    logging.debug('加载cookies_for_webdriver.json中的内容')
-                with open('.\\config\\cookies_for_webdriver.json', 'w') as f:
-                    # 打开cookies_for_webdriver.json并写入当前项目的cookies_list
-                    cookies_dict[self.__project__] = cookies_list
-                    f.write(json.dumps(cookies_dict, indent=4))
-                    logging.debug('写入当前项目cookies_list到cookies_for_webdriver.json')
-                driver.close()
-                logging.info('关闭浏览器')
-                return cookies_list
-            except TimeoutException:
-                logging.info('10秒内未找到元素')
-                if driver.title == '身份验证':
-                    logging.info('请输入邮箱验证码！')
-                    continue
-                elif 'Welcome' in driver.title:
-                    continue
-                else:
-                    print(driver.title)
-                    cookies_list = []
-                    logging.error('读取页面数据的时候遇到未知错误')
-                    return cookies_list
+        import jasper_login
+        return jasper_login.webdriver_cookies_getter(self.__project__)
 
     @log_method
-    def mno_get_request(self,request_name,search_value):
+    def mno_get_request(self,request_name,search_value,**extra_params):
         """
         构建jasper API的请求
         :param request_name: 请求名,参照http_request_parameter.json
         :param search_value: 请求的搜索值
+        :param extra_params: 模板中的其他占位符参数，例如page、limit、search_values
         :return:
         """
-        # 处理加载cookies
-        cookies = ';'.join([f'{key}={value}' for key, value in self.__project_cookies_dict__.items()]),
-        cookies = cookies[0]
-        logging.debug('对该请求载入cookies:\n %s', cookies)
-        # 根据输入的参数加载配置文件中的请求参数
-        with open('.\\config\\http_request_parameter.json', 'r') as f:
-            request_info_dict = json.load(f)
-            base_url = request_info_dict[request_name]['base_url']
-            logging.debug('加载Base url: \n %s', base_url)
-            # 获取查询字符串
-            request_args = request_info_dict[request_name]['request_args']
-            search_args = request_info_dict[request_name]['request_args']['search']
-            # 获取查询字符串
+        # 获取项目共享的HTTP会话，并同步当前项目的cookies到会话的cookie jar
+        http_session = get_http_session(self.__project__)
+        http_session.sync_cookies(self.__project_cookies_dict__)
+        # 从启动时编译好的请求模板渲染请求url和请求头
+        with span('template_render', self.__project__, request_name):
+            request_template = get_request_templates()[request_name]
             param_dict = {
-                "timestamp_now" : self.timestamp_processor(datetime.now(),'ms'),
-                "search_value" : search_value
+                "timestamp_now": int(time.time() * 1000),
+                "search_value": search_value
             }
-            search_args = self.replace_placeholder(search_args,param_dict)
-            request_args = self.replace_placeholder(request_args,param_dict)
-            search_args = json.dumps(search_args)
-            request_args['search']=search_args
-            logging.debug('加载查询字符串：\n %s', json.dumps(request_args,indent=4))
-            # 查询字符串编码
-            query_string = urlencode(request_args)
-            logging.debug('编码后的查询字符串：\n %s', query_string)
-            headers = request_info_dict[request_name]['headers']
-            param_dict = {
-                'cookies' : cookies
-            }
-            headers = self.replace_placeholder(headers,param_dict)
-            logging.debug('加载请求头：\n %s', headers)
-        # 拼接请求url
-        url = base_url + '?' + query_string
-        logging.debug('拼接请求结果：\n %s', url)
-        # 加载请求头发送请求
-        response = requests.get(url, headers=headers)
+            param_dict.update(extra_params)
+            url, headers = request_template.render(param_dict)
+        logging.debug('渲染请求结果：\n %s', url)
+        # 加载请求头，通过连接池发送请求；启用了上游调控时先排队获取并发名额和令牌
+        governor = get_upstream_governor(self.__project__)
+        if governor is None:
+            with span('upstream', self.__project__, request_name) as timing:
+                response = http_session.get(url, headers=headers)
+                timing["outcome"] = f'http_{response.status_code}'
+        else:
+            with governor.slot(request_name) as feedback, span('upstream', self.__project__, request_name) as timing:
+                response = http_session.get(url, headers=headers)
+                feedback["status_code"] = response.status_code
+                timing["outcome"] = f'http_{response.status_code}'
         # 加载相应内容为字典
-        response_data_dict = json.loads(response.text)
-        logging.debug('加载请求响应结果到字典：\n %s', json.dumps(response_data_dict, indent=4))
+        with span('json_decode', self.__project__, request_name):
+            response_data_dict = json.loads(response.text)
+        logging.debug('加载请求响应结果到字典：\n %s', LazyJSON(response_data_dict))
         return response_data_dict
 
-    @log_method
-    def replace_placeholder(self, target_root_dict, param_dict=None):
-        """
-        递归替换占位符，支持字典嵌套列表、列表嵌套字典
-        :param target_root_dict: 配置文件读取出来的字典
-        :param param_dict: 需要替换的参数字典
-        :return: 处理后的 target_root_dict
-        """
-        #判断当前根节点是否为字典
-        if isinstance(target_root_dict, dict):
-            # 遍历字典的每一个键值对
-            for key, value in target_root_dict.items():
-                # 判断当前值是否为字典或列表，如果是则递归调用本函数
-                if isinstance(value, (dict, list)):
-                    self.replace_placeholder(value, param_dict)
-                #  判断当前值是否为字符串且以{}开头结尾，如果是则替换
-                elif isinstance(value, str) and value.startswith('{') and value.endswith('}'):
-                    param_name = value.strip('{}')
-                    target_root_dict[key] = param_dict[param_name]
-        # 判断当前根节点是否为列表
-        elif isinstance(target_root_dict, list):
-            #  遍历列表的每一个元素
-            for i, item in enumerate(target_root_dict):
-                #  判断当前元素是否为字典或列表，如果是则递归调用本函数
-                if isinstance(item, (dict, list)):
-                    self.replace_placeholder(item, param_dict)
-                # 判断当前元素是否为字符串且以{}开头结尾，如果是则替换
-                elif isinstance(item, str) and item.startswith('{') and item.endswith('}'):
-                    param_name = item.strip('{}')
-                    target_root_dict[i] = param_dict[param_name]
-        return target_root_dict
-
     @log_method
     def if_cookies_need_update(self):
         '''
         用于检查cookies是否需要更新
         :return: bool值
         '''
-        logging.info(f'检查{self.__project__}项目是否需要更新cookies')
-        response_data_dict = self.mno_get_request('get_sim_id')
+        logging.info('检查%s项目是否需要更新cookies', self.__project__)
+        try:
+            # 只取一条记录的轻量请求
+            response_data_dict = self.mno_get_request('session_probe', None)
+        except requests.exceptions.RequestException as e:
+            # 网络问题不代表cookies失效，不触发登录
+            logging.error('检查cookies时请求Jasper失败：%r', e)
+            return False
         try:
             if response_data_dict['errorMessage'] == 'Full authentication is required to access this resource':
-                logging.info(f'{self.__project__}项目需要更新cookies')
+                logging.info('%s项目需要更新cookies', self.__project__)
                 return True
             else:
-                logging.debug(f'未知errorMessage%r', response_data_dict)
-                logging.info(f'{self.__project__}项目不需要更新cookies')
+                logging.debug('未知errorMessage%r', response_data_dict)
+                logging.info('%s项目不需要更新cookies', self.__project__)
                 return False
         except KeyError:
             logging.debug('响应中没有找到errorMessage')
-            logging.info(f'{self.__project__}项目不需要更新cookies')
+            logging.info('%s项目不需要更新cookies', self.__project__)
             return False
 
     @log_method
-    def update_cookies(self):
+    def update_cookies(self, stale_cookies_dict=None):
         '''
         该方法会更新cookies_for_request.json，并赋值当前项目cookies的全局变量__project_cookies_dict__
+        同一项目的并发调用只登录一次：进程内第一个调用方执行登录，其他调用方等待并复用结果；
+        多个进程之间通过文件锁串行，拿到锁时cookies已经被别的进程更新则直接复用
+        :param stale_cookies_dict: 调用方请求时使用、已经失效的cookies，默认为当前实例的cookies
         :return:bool值
         '''
-        all_cookies_json = self.read_all_cookies()
-        all_cookies_json[self.__project__] = self.process_cookies_dict()
-        if all_cookies_json[self.__project__] != {}:
-            logging.info("开始写入当前项目cookies到cookies文件")
-            with open(self.cookies_file_path, 'w') as f:
-                f.write(json.dumps(all_cookies_json, indent=4))
-                logging.info('当前项目cookies已经写入到cookies文件中')
-        else:
-            return False
-        self.__project_cookies_dict__ = all_cookies_json[self.__project__]
-        logging.debug('成功更新当前项目cookies的全局字典：%s', json.dumps(self.__project_cookies_dict__, indent=4))
+        if stale_cookies_dict is None:
+            stale_cookies_dict = self.__project_cookies_dict__
+        wait_timeout = load_settings('login', LOGIN_DEFAULTS, self.__project__)["wait_timeout"]
+        with span('login', self.__project__) as timing:
+            try:
+                refreshed = _login_flight.do(self.__project__, lambda: self.refresh_cookies(stale_cookies_dict),
+                                             timeout=wait_timeout)
+            except SingleFlightTimeout:
+                logging.error('%s项目等待登录超过%s秒，按cookies更新失败处理', self.__project__, wait_timeout)
+                refreshed = False
+            if not refreshed:
+                timing["outcome"] = "cookies_update_failed"
+                return False
+        self.__project_cookies_dict__ = self.cookie_store.get(self.__project__) or {}
+        logging.debug('成功更新当前项目cookies的全局字典：%s', LazyJSON(self.__project_cookies_dict__))
         return True
 
+    def refresh_cookies(self, stale_cookies_dict):
+        '''
+        持有项目登录锁执行登录，由update_cookies调用
+        :param stale_cookies_dict: 调用方认为已经失效的cookies
+        :return:bool值
+        '''
+        with file_lock(f'config/login_{self.__project__}.lock'):
+            current_cookies_dict = self.cookie_store.get(self.__project__)
+            if current_cookies_dict and current_cookies_dict != stale_cookies_dict:
+                logging.info('%s项目cookies已被其他请求更新，直接复用', self.__project__)
+                return True
+            failure_cooldown = load_settings('login', LOGIN_DEFAULTS, self.__project__)["failure_cooldown"]
+            failed_at = _login_failures.get(self.__project__)
+            if failed_at is not None and time.monotonic() - failed_at < failure_cooldown:
+                logging.info('%s项目最近登录失败，冷却中不再登录', self.__project__)
+                return False
+            project_cookies_dict = self.process_cookies_dict()
+            if project_cookies_dict == {}:
+                _login_failures[self.__project__] = time.monotonic()
+                return False
+            _login_failures.pop(self.__project__, None)
+            logging.info("开始写入当前项目cookies到cookies文件")
+            # 通过共享缓存写入，同时使其他实例读到新的cookies
+            self.cookie_store.save(self.__project__, project_cookies_dict)
+            return True
+
     @log_method
     def read_all_cookies(self):
         '''
@@ -417,87 +356,455 @@ class SIMInfoGetter:
         }
 
         '''
-        with open(self.cookies_file_path, 'r') as f:
-            logging.info('cookies文件存在')
-            # 如果文件有内容则直接赋值到变量
+        all_cookies_json = self.cookie_store.get_all()
+        logging.debug('all_cookies_json：%s', LazyJSON(all_cookies_json))
+        return all_cookies_json
+
+    def fetch_sim_basic_data(self, search_value):
+        '''
+        请求SIM卡基础信息并规范化
+        :param search_value: 查询值，ICCID或者VIN
+        :return: 成功时为{"success": True, "sim_basic_data": {...}}，失败时为带error_message的字典
+        '''
+        with span('basic_data', self.__project__, 'sim_basic_data') as timing:
             try:
-                all_cookies_json = json.load(f)
-                logging.info('cookies文件有内容')
-            except json.decoder.JSONDecodeError:
-                all_cookies_json = {}
-                logging.info('cookies文件无内容')
-            logging.debug('all_cookies_json：%s', json.dumps(all_cookies_json, indent=4))
-            return all_cookies_json
+                response = self.mno_get_request('sim_basic_data', search_value)
+            except requests.exceptions.RequestException as e:
+                logging.error('请求Jasper失败：%r', e)
+                result = {"success":False,"error_message": "upstream_error"}
+            else:
+                result = self.parse_sim_basic_data_response(response)
+            timing["outcome"] = result.get("error_message", "ok")
+        return result
+
+    @staticmethod
+    def parse_error_response(response):
+        '''
+        将Jasper返回的错误响应转换为带error_message的结果
+        :param response: 响应字典
+        :return: cookies失效时为cookies_need_update，否则为unknown_error
+        '''
+        if response.get("errorMessage") == "Full authentication is required to access this resource":
+            logging.info("cookies需要更新")
+            result = {"success":False,"error_message": "cookies_need_update"}
+            return result
+        else:
+            logging.info("未知错误")
+            result = {"success":False,"error_message": "unknown_error"}
+            return result
+
+    @staticmethod
+    def parse_sim_basic_data_response(response):
+        '''
+        解析sim_basic_data的响应，同步和异步客户端共用
+        :param response: 响应字典
+        :return: 成功时为{"success": True, "sim_basic_data": {...}}，失败时为带error_message的字典
+        '''
+        if "totalCount" not in response:
+            return SIMInfoGetter.parse_error_response(response)
+        if response["totalCount"] == 0:
+            result = {"success":False,"error_message":"can_not_find_sim"}
+            return result
+        elif response["totalCount"] > 1:
+            result = {"success":False,"error_message":"more_than_one_sim"}
+            return result
+        sim_basic_data = SIMInfoGetter.normalize_sim_basic_data(response["data"][0])
+        logging.debug('sim_basic_data：%s', LazyJSON(sim_basic_data))
+        return {"success": True, "sim_basic_data": sim_basic_data}
+
+    @staticmethod
+    def normalize_sim_basic_data(record):
+        '''
+        将Jasper返回的一条SIM卡记录转换为sim_basic_data
+        :param record: /provision/api/v1/sims返回的data中的一条
+        :return: sim_basic_data字典
+        '''
+        activation_datetime = format_epoch_ms(record["activationDate"])
+        sim_basic_data = {
+            "sim_id": record["simId"],
+            "iccid": record["iccid"],
+            "imei": record["simAuxFieldsDTO"]["imei"],
+            "bound_vin": record["custom1"],
+            "brand": record["custom2"],
+            "lifecycle": record["custom3"],
+            "session_type_now": record["sessionType"],
+            "device_type": record["simAuxFieldsDTO"]["custom9"],
+            "activation_datetime": activation_datetime,
+        }
+        return sim_basic_data
+
+    def get_sim_basic_data_batch(self, search_values, batch_size=100, page_size=500):
+        '''
+        批量获取SIM卡基础信息：每个请求携带一组ICCID/VIN，按page翻页直到取完全部结果，
+        再按iccid/custom1把结果对应回各自的查询值
+        :param search_values: 查询值列表，ICCID或者VIN
+        :param batch_size: 每个请求携带的查询值个数
+        :param page_size: 每页条数
+        :return: {查询值: 与fetch_sim_basic_data相同格式的结果}
+        '''
+        results = {}
+        search_values = list(dict.fromkeys(search_values))
+        for start in range(0, len(search_values), batch_size):
+            chunk = search_values[start:start + batch_size]
+            rows = []
+            page = 1
+            error_result = None
+            while True:
+                try:
+                    response = self.mno_get_request('sim_basic_data_batch', None,
+                                                    search_values=chunk, page=page, limit=page_size)
+                except requests.exceptions.RequestException as e:
+                    logging.error('请求Jasper失败：%r', e)
+                    error_result = {"success":False,"error_message": "upstream_error"}
+                    break
+                if "totalCount" not in response:
+                    error_result = self.parse_error_response(response)
+                    break
+                page_rows = response["data"] or []
+                rows.extend(page_rows)
+                if not page_rows or len(rows) >= response["totalCount"]:
+                    break
+                page += 1
+            logging.info('批量获取基础信息：%s个查询值，%s页，%s条结果', len(chunk), page, len(rows))
+            if error_result is not None:
+                for search_value in chunk:
+                    results[search_value] = dict(error_result)
+                continue
+            results.update(self.match_sim_basic_data_rows(chunk, rows))
+        sim_store = get_sim_store()
+        if sim_store is not None:
+            try:
+                sim_store.save_basic_data(self.__project__, {
+                    result["sim_basic_data"]["sim_id"]: result["sim_basic_data"]
+                    for result in results.values() if result["success"]
+                }.values())
+            except sqlite3.Error:
+                logging.exception('%s项目批量写入本地SIM卡存储失败', self.__project__)
+        return results
+
+    @staticmethod
+    def match_sim_basic_data_rows(search_values, rows):
+        '''
+        按iccid/custom1把批量查询得到的记录对应回查询值
+        :param search_values: 本批次的查询值
+        :param rows: 本批次全部分页的记录
+        :return: {查询值: 与fetch_sim_basic_data相同格式的结果}
+        '''
+        results = {}
+        matched_rows = {search_value: [] for search_value in search_values}
+        for row in rows:
+            for identifier in {row.get("iccid"), row.get("custom1")}:
+                if identifier in matched_rows:
+                    matched_rows[identifier].append(row)
+        for search_value, value_rows in matched_rows.items():
+            if not value_rows:
+                results[search_value] = {"success":False,"error_message":"can_not_find_sim"}
+            elif len(value_rows) > 1:
+                results[search_value] = {"success":False,"error_message":"more_than_one_sim"}
+            else:
+                results[search_value] = {
+                    "success": True,
+                    "sim_basic_data": SIMInfoGetter.normalize_sim_basic_data(value_rows[0]),
+                }
+        return results
+
+    def iter_sim_change_history(self, sim_id, change_types=None, start_after=None, start_before=None, page_size=None):
+        '''
+        逐页请求SIM卡变更历史，按需产出记录，只有消费到下一页时才会发出下一页的请求
+        :param sim_id: Jasper的simId
+        :param change_types: 需要的changeTypeDisplay集合，None表示全部
+        :param start_after: 只保留开始时间不早于该毫秒时间戳的记录
+        :param start_before: 只保留开始时间早于该毫秒时间戳的记录
+        :param page_size: 每页条数，None时使用请求模板中的默认值
+        :return: SIMChangeRecord的生成器，按dateModified倒序
+        :raise ChangeHistoryError: 任意一页请求失败
+        '''
+        extra_params = {} if page_size is None else {"limit": page_size}
+        page = 1
+        fetched = 0
+        while True:
+            try:
+                response = self.mno_get_request('sim_change_history', str(sim_id), page=page, **extra_params)
+            except requests.exceptions.RequestException as e:
+                logging.error('请求Jasper失败：%r', e)
+                raise ChangeHistoryError("upstream_error") from e
+            with span('history_normalize', self.__project__, 'sim_change_history'):
+                records, total_count = parse_change_history_page(response)
+            fetched += len(records)
+            yield from filter_change_records(records, change_types, start_after, start_before)
+            if not records or fetched >= total_count:
+                return
+            page += 1
+
+    def sync_sim_change_history(self, sim_id):
+        '''
+        增量同步SIM卡的变更历史：已经同步过的卡只请求比水位新的记录，遇到第一条已知记录就停止翻页，
+        再与保存的历史合并；未启用history_sync时每次全量请求
+        :param sim_id: Jasper的simId
+        :return: 全部SIMChangeRecord列表，按dateModified倒序
+        :raise ChangeHistoryError: 任意一页请求失败
+        '''
+        history_sync_store = get_history_sync_store()
+        if history_sync_store is None:
+            return list(self.iter_sim_change_history(sim_id))
+        watermark = history_sync_store.watermark(self.__project__, sim_id)
+        if watermark is not None:
+            new_records = list(itertools.takewhile(
+                lambda record: not history_sync_store.is_known(record, watermark),
+                self.iter_sim_change_history(sim_id, page_size=history_sync_store.delta_page_size),
+            ))
+            records = history_sync_store.merge(self.__project__, sim_id, new_records, watermark)
+            if records is not None:
+                logging.debug('%s增量同步变更历史：新增%s条', sim_id, len(new_records))
+                return records
+        records = list(self.iter_sim_change_history(sim_id))
+        return history_sync_store.merge(self.__project__, sim_id, records, None)
+
+    def fetch_sim_change_records(self, sim_id):
+        '''
+        请求SIM卡的全部变更历史记录
+        :param sim_id: Jasper的simId
+        :return: (error_message, SIMChangeRecord列表)，成功时error_message为None
+        '''
+        with span('change_history', self.__project__, 'sim_change_history') as timing:
+            try:
+                return None, self.sync_sim_change_history(sim_id)
+            except ChangeHistoryError as e:
+                timing["outcome"] = e.error_message
+                return e.error_message, []
+
+    def fetch_sim_change_history(self, sim_id):
+        '''
+        请求SIM卡的全部变更历史，按变更类型整理
+        :param sim_id: Jasper的simId
+        :return: (error_message, sim_change_history字典)，成功时error_message为None
+        '''
+        error_message, change_records = self.fetch_sim_change_records(sim_id)
+        return error_message, collapse_change_history(change_records)
 
     @log_method
-    def get_sim_data(self):
+    def get_sim_data(self, fresh=False, sim_basic_data=None, max_age=None, include=None, change_types=None,
+                     sim_id=None):
         '''
         发起两个请求，一个用于获取SIM卡基础信息和simId，一个用于查SIM卡变更历史
+        结果会写入进程内缓存和本地存储，基础信息仍有效而变更历史过期时只重新请求变更历史
+        同一张卡的并发查询共用一次上游请求；开启stale_while_revalidate时，过期不久的结果直接返回并在后台更新
+        :param fresh: 为True时跳过缓存，直接请求Jasper
+        :param sim_basic_data: 已经批量获取到的基础信息，缓存未命中时用它代替基础信息请求
+        :param max_age: 传入时先查本地存储，数据在max_age秒内从Jasper取得过则直接返回
+        :param include: 需要的部分，SIM_DATA_SECTIONS的子集，None表示全部；不含history时不请求变更历史
+        :param change_types: 只返回这些changeTypeDisplay的变更历史，None表示全部
+        :param sim_id: 已知的simId，只需要history时直接请求变更历史，不再请求基础信息
+        :return: 返回一个字典，为全部SIM卡信息，或者只包含include中的部分
+        '''
+        include = SIM_DATA_SECTIONS if include is None else frozenset(include)
+        if "history" not in include:
+            return self.get_sim_basic_data(fresh=fresh, max_age=max_age)
+        if "basic" not in include and sim_id is not None:
+            return self.get_sim_change_history(sim_id, fresh=fresh, max_age=max_age, change_types=change_types)
+        sim_data = self.get_full_sim_data(fresh=fresh, sim_basic_data=sim_basic_data, max_age=max_age)
+        if include == SIM_DATA_SECTIONS and change_types is None:
+            return sim_data
+        # 投影后的内容与缓存中的不同，内容哈希需要按投影结果重新计算
+        self.sim_data_etag = None
+        return self.project_sim_data(sim_data, include, change_types)
+
+    @staticmethod
+    def project_sim_data(sim_data, include, change_types=None):
+        '''
+        从完整的sim_data中取出需要的部分，不修改原字典（它可能是缓存中的对象）
+        :param sim_data: get_full_sim_data的结果
+        :param include: SIM_DATA_SECTIONS的子集
+        :param change_types: 只保留这些changeTypeDisplay的变更历史，None表示全部
+        :return: 新的sim_data字典，失败的结果原样返回
+        '''
+        if not sim_data["success"]:
+            return sim_data
+        projected = {"success": True}
+        if "basic" in include:
+            projected["sim_basic_data"] = sim_data["sim_basic_data"]
+        if "history" in include:
+            sim_change_history = sim_data["sim_change_history"]
+            if change_types is not None:
+                sim_change_history = {change_type: change for change_type, change in sim_change_history.items()
+                                      if change_type in change_types}
+            projected["sim_change_history"] = sim_change_history
+        return projected
+
+    def get_sim_basic_data(self, fresh=False, max_age=None):
+        '''
+        只获取基础信息，不请求变更历史；依次使用结果缓存、本地存储，都没有时只发一个基础信息请求
+        :param fresh: 为True时跳过缓存和本地存储
+        :param max_age: 传入时本地存储中max_age秒内取得的基础信息可以直接返回
+        :return: {"success": True, "sim_basic_data": {...}}，失败时为带error_message的字典
+        '''
+        self.sim_data_etag = None
+        with span('get_sim_basic_data', self.__project__) as timing:
+            sim_result_cache = get_sim_result_cache()
+            if sim_result_cache is not None and not fresh:
+                cached = sim_result_cache.get(self.__project__, self.__search_value__,
+                                              allow_stale=sim_result_cache.stale_ttl > 0)
+                if cached is not None and cached.basic_fresh:
+                    timing["outcome"] = "cache_hit"
+                    return {"success": True, "sim_basic_data": cached.sim_data["sim_basic_data"]}
+                if cached is not None and cached.stale:
+                    timing["outcome"] = "stale_hit"
+                    self.revalidate_in_background()
+                    return {"success": True, "sim_basic_data": cached.sim_data["sim_basic_data"]}
+            sim_store = get_sim_store()
+            if max_age is not None and sim_store is not None and not fresh:
+                stored_sim_basic_data = sim_store.get_sim_basic_data(self.__project__, self.__search_value__, max_age)
+                if stored_sim_basic_data is not None:
+                    timing["outcome"] = "store_hit"
+                    return {"success": True, "sim_basic_data": stored_sim_basic_data}
+            result = _lookup_flight.do((self.__project__, str(self.__search_value__), "basic"),
+                                       lambda: self.fetch_sim_basic_data(self.__search_value__))
+            if not result["success"]:
+                timing["outcome"] = result["error_message"]
+            elif sim_store is not None:
+                try:
+                    with span('store_write', self.__project__):
+                        sim_store.save_basic_data(self.__project__, [result["sim_basic_data"]])
+                except sqlite3.Error:
+                    logging.exception('写入本地SIM卡存储失败：%s', self.__search_value__)
+            return result
+
+    def get_sim_change_history(self, sim_id, fresh=False, max_age=None, change_types=None):
+        '''
+        已知simId时只获取变更历史，不请求基础信息
+        :param sim_id: Jasper的simId
+        :param fresh: 为True时跳过缓存和本地存储
+        :param max_age: 传入时本地存储中max_age秒内取得的数据可以直接返回
+        :param change_types: 只返回这些changeTypeDisplay的变更历史，None表示全部
+        :return: {"success": True, "sim_change_history": {...}}，失败时为带error_message的字典
+        '''
+        self.sim_data_etag = None
+        include = frozenset(("history",))
+        with span('get_sim_change_history', self.__project__) as timing:
+            # 结果缓存和本地存储都以simId为索引，可以直接用simId查
+            sim_result_cache = get_sim_result_cache()
+            if sim_result_cache is not None and not fresh:
+                cached = sim_result_cache.get(self.__project__, sim_id)
+                if cached is not None and cached.history_fresh:
+                    timing["outcome"] = "cache_hit"
+                    return self.project_sim_data(cached.sim_data, include, change_types)
+            sim_store = get_sim_store()
+            if max_age is not None and sim_store is not None and not fresh:
+                stored_sim_data = sim_store.get_sim_data(self.__project__, sim_id, max_age)
+                if stored_sim_data is not None:
+                    timing["outcome"] = "store_hit"
+                    return self.project_sim_data(stored_sim_data, include, change_types)
+            try:
+                with span('change_history', self.__project__, 'sim_change_history'):
+                    change_records = _lookup_flight.do((self.__project__, str(sim_id), "history"),
+                                                       lambda: self.sync_sim_change_history(sim_id))
+            except ChangeHistoryError as e:
+                timing["outcome"] = e.error_message
+                return {"success": False, "error_message": e.error_message}
+            if change_types is not None:
+                change_records = filter_change_records(change_records, change_types)
+            return {"success": True, "sim_change_history": collapse_change_history(change_records)}
+
+    def get_full_sim_data(self, fresh=False, sim_basic_data=None, max_age=None):
+        '''
+        获取基础信息和全部变更历史，由get_sim_data调用，参数含义与get_sim_data相同
         :return: 返回一个字典，为全部SIM卡信息
         '''
-        response = self.mno_get_request('sim_basic_data', self.__search_value__)
-        if "totalCount" in response:
-            sim_data = {}
-            if response["totalCount"] == 0:
-                result = {"success":False,"error_message":"can_not_find_sim"}
-                return result
-            elif response["totalCount"] > 1:
-                result = {"success":False,"error_message":"more_than_one_sim"}
-                return result
-            elif response["totalCount"] == 1:
-                sim_basic_data = response["data"]
-                sim_id = sim_basic_data[0]["simId"]
-                iccid = sim_basic_data[0]["iccid"]
-                imei = sim_basic_data[0]["simAuxFieldsDTO"]["imei"]
-                bound_vin = sim_basic_data[0]["custom1"]
-                brand = sim_basic_data[0]["custom2"]
-                lifecycle = sim_basic_data[0]["custom3"]
-                session_type_now = sim_basic_data[0]["sessionType"]
-                device_type = sim_basic_data[0]["simAuxFieldsDTO"]["custom9"]
-                activation_datetime = self.timestamp_processor(sim_basic_data[0]["activationDate"],'s').strftime("%Y-%m-%d %H:%M:%S")
-                sim_basic_data = {
-                    "sim_id":sim_id,
-                    "iccid": iccid,
-                    "imei": imei,
-                    "bound_vin": bound_vin,
-                    "brand": brand,
-                    "lifecycle": lifecycle,
-                    "session_type_now": session_type_now,
-                    "device_type": device_type,
-                    "activation_datetime": activation_datetime,
-                }
-                logging.debug('sim_basic_data：%s', json.dumps(sim_basic_data, indent=4))
-
-                response = self.mno_get_request('sim_change_history', str(sim_id))
-                sim_change_history = {}
-                if response["success"]:
-                    sim_change_history_response = response["data"]
-                    for record in sim_change_history_response:
-                        change_type = record["changeTypeDisplay"]
-                        target_value = record["targetValue"]
-                        source_value = record["sourceValue"]
-                        start_time = self.timestamp_processor(record["startTime"],'s').strftime("%Y-%m-%d %H:%M:%S")
-                        end_time = self.timestamp_processor(record["endTime"],'s').strftime("%Y-%m-%d %H:%M:%S")
-                        change_by = record["userName"]
-                        sim_data["success"] = True
-                        sim_change_history[change_type] = {
-                                "target_value":target_value,
-                                "source_value":source_value,
-                                "start_time":start_time,
-                                "end_time":end_time,
-                                "change_by":change_by
-                            }
-                elif not response["success"]:
-                    sim_data["success"] =False
-                sim_data["sim_basic_data"] = sim_basic_data
-                sim_data["sim_change_history"] = sim_change_history
-                return sim_data
-        else:
-            if response["errorMessage"] == "Full authentication is required to access this resource":
-                logging.info("cookies需要更新")
-                result = {"success":False,"error_message": "cookies_need_update"}
-                return result
-            else:
-                logging.info("未知错误")
-                result = {"success":False,"error_message": "unknown_error"}
-                return result
+        self.sim_data_etag = None
+        with span('get_sim_data', self.__project__) as timing:
+            sim_result_cache = get_sim_result_cache()
+            cached = None
+            if sim_result_cache is not None and not fresh:
+                cached = sim_result_cache.get(self.__project__, self.__search_value__,
+                                              allow_stale=sim_result_cache.stale_ttl > 0)
+            if cached is not None and cached.basic_fresh and cached.history_fresh:
+                logging.debug('命中缓存：%s', self.__search_value__)
+                timing["outcome"] = "cache_hit"
+                self.sim_data_etag = cached.etag
+                return cached.sim_data
+            if cached is not None and cached.stale:
+                logging.debug('返回过期结果并在后台更新：%s', self.__search_value__)
+                timing["outcome"] = "stale_hit"
+                self.revalidate_in_background(cached.sim_data["sim_basic_data"] if cached.basic_fresh else None)
+                self.sim_data_etag = cached.etag
+                return cached.sim_data
+            sim_store = get_sim_store()
+            if cached is None and max_age is not None and sim_store is not None and not fresh:
+                stored_sim_data = sim_store.get_sim_data(self.__project__, self.__search_value__, max_age)
+                if stored_sim_data is not None:
+                    timing["outcome"] = "store_hit"
+                    return stored_sim_data
+            if cached is not None:
+                sim_basic_data = cached.sim_data["sim_basic_data"]
+            sim_data, self.sim_data_etag = _lookup_flight.do(
+                (self.__project__, str(self.__search_value__)),
+                lambda: self.fetch_sim_data(sim_basic_data, basic_refreshed=cached is None))
+            if not sim_data["success"]:
+                timing["outcome"] = sim_data.get("error_message", "unknown_error")
+            return sim_data
+
+    def fetch_sim_data(self, sim_basic_data=None, basic_refreshed=True):
+        '''
+        请求Jasper获取完整的sim_data，写入本地存储和结果缓存，由get_sim_data在合并并发查询后调用
+        :param sim_basic_data: 已有的基础信息，有则只请求变更历史
+        :param basic_refreshed: 基础信息是否为本次获取，决定写入缓存时基础信息的有效期
+        :return: (sim_data, 内容哈希)，没有写入结果缓存时内容哈希为None
+        '''
+        if sim_basic_data is None:
+            basic_result = self.fetch_sim_basic_data(self.__search_value__)
+            if not basic_result["success"]:
+                return basic_result, None
+            sim_basic_data = basic_result["sim_basic_data"]
+        error_message, change_records = self.fetch_sim_change_records(sim_basic_data["sim_id"])
+        if error_message is not None:
+            # 与基础信息请求失败一样带上error_message，调用方据此更新cookies或者返回错误
+            return {
+                "success": False,
+                "error_message": error_message,
+                "sim_basic_data": sim_basic_data,
+                "sim_change_history": {},
+            }, None
+        return self.save_sim_data(sim_basic_data, change_records, basic_refreshed)
+
+    def save_sim_data(self, sim_basic_data, change_records, basic_refreshed=True):
+        '''
+        把从Jasper取得的基础信息和全部变更历史写入本地存储和结果缓存
+        :param sim_basic_data: sim_basic_data字典
+        :param change_records: 全部SIMChangeRecord列表
+        :param basic_refreshed: 基础信息是否为本次获取，决定写入缓存时基础信息的有效期
+        :return: (sim_data, 内容哈希)，没有写入结果缓存时内容哈希为None
+        '''
+        sim_data = {
+            "success": True,
+            "sim_basic_data": sim_basic_data,
+            "sim_change_history": collapse_change_history(change_records),
+        }
+        sim_store = get_sim_store()
+        if sim_store is not None:
+            try:
+                with span('store_write', self.__project__):
+                    sim_store.save_sim(self.__project__, sim_basic_data, change_records)
+            except sqlite3.Error:
+                logging.exception('写入本地SIM卡存储失败：%s', self.__search_value__)
+        sim_result_cache = get_sim_result_cache()
+        if sim_result_cache is None:
+            return sim_data, None
+        return sim_data, sim_result_cache.put(self.__project__, self.__search_value__, sim_data,
+                                              basic_refreshed=basic_refreshed)
+
+    def revalidate_in_background(self, sim_basic_data=None):
+        '''
+        提交后台任务重新获取当前查询值，同一张卡同时只有一个后台任务
+        :param sim_basic_data: 仍在有效期内的基础信息，有则只重新获取变更历史
+        '''
+        key = (self.__project__, str(self.__search_value__))
+        with _revalidating_lock:
+            if key in _revalidating:
+                return
+            _revalidating.add(key)
+        try:
+            _get_revalidate_pool().submit(_revalidate, self.__project__, self.__search_value__, sim_basic_data)
+        except RuntimeError:
+            # 进程退出时线程池已关闭
+            with _revalidating_lock:
+                _revalidating.discard(key)
@@ -1,36 +1,122 @@
-from flask import Flask,jsonify
-from SIMDetailsGetter import *
+from flask import Flask,jsonify,Response,stream_with_context,g
+from SIMDetailsGetter import SIM_DATA_SECTIONS, SIMInfoGetter, lookup_stats
+from request_templates import get_request_templates
+from result_cache import get_sim_result_cache
+from sim_store import get_sim_store
+from logging_setup import configure_logging, log_request
+from upstream_governor import upstream_governor_stats
+from response_encoding import get_response_encoder, sim_data_etag
+from metrics import get_metrics, start_request_timing, pop_request_timings, format_server_timing
+from batch_lookup import get_batch_executor, parse_search_values_csv, clean_search_values
+from cookie_refresher import start_cookie_refresher
+from browser_pool import get_browser_pool, start_browser_pool
+from watchlist import WATCHLIST_DEFAULTS, get_watchlist_store, start_watchlist_poller, watchlist_stats
+from settings import load_settings
 from flask import request
 from datetime import datetime
 import os
+import time
 
+# 日志由应用在启动时配置，级别和输出文件见service_settings.json的logging段
+configure_logging()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-fallback-key')
+# 启动时加载并编译请求模板，配置错误在启动阶段就暴露出来
+get_request_templates()
+# 按配置预热浏览器；没有预热项目时不导入selenium，登录时再加载
+start_browser_pool()
+# 按配置启动后台cookies续期，使请求路径不必等待浏览器登录
+start_cookie_refresher()
+# 按配置启动关注列表的后台轮询，没有关注的卡时线程只做检查
+start_watchlist_poller()
 
 def timestamp_processor(input_value, timestamp_level):
     """
-    时间戳处理器,默认输出的都是UTC时间
+    时间戳处理器,默认输出的都是UTC时间，与SIMInfoGetter.timestamp_processor相同
     :param input_value: 输入的值
-    :param timestamp_level: 需要转化的时间戳的级别，秒级('s')还是毫秒级('ms')
+    :param timestamp_level: 时间戳的级别，秒级('s')还是毫秒级('ms')
     :return:datetime或者是时间戳(整数或者浮点)
     """
-    # 如果输入的是datatime格式，说明是希望转换成时间戳
-    if type(input_value) == datetime:
-        # 转换成秒级时间戳
-        if timestamp_level == 's':
-            return input_value.timestamp()
-        # 转换成毫秒级时间戳
-        if timestamp_level == 'ms':
-            return int(input_value.timestamp() * 1000)
-    # 如果输入的是时间戳（整数或者浮点），说明是希望转换成datetime类型
-    elif type(input_value) == int or type(input_value) == float:
-        # 输入的是秒级时间戳
-        if timestamp_level == 's':
-            input_value = input_value / 1000
-            return datetime.fromtimestamp(input_value, tz=timezone.utc)
-        # 输入的是毫秒级时间戳
-        if timestamp_level == 'ms':
-            return datetime.fromtimestamp(input_value, tz=timezone.utc)
+    return SIMInfoGetter.timestamp_processor(input_value, timestamp_level)
+
+def json_response(payload, status, etag=None):
+    """
+    用响应编码器序列化响应，客户端支持时按配置gzip压缩
+    :param payload: 响应字典
+    :param status: HTTP状态码
+    :param etag: sim_data的内容哈希，传入时作为弱ETag返回
+    :return: Response
+    """
+    encoder = get_response_encoder()
+    body, content_encoding = encoder.compress(encoder.dumps(payload), request.accept_encodings['gzip'] > 0)
+    response = Response(body, status=status, mimetype='application/json')
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    if encoder.encoding_settings["gzip"]:
+        response.vary.add('Accept-Encoding')
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+def comma_separated_arg(name):
+    """
+    读取逗号分隔的查询参数
+    :return: 去掉空白后的列表，没有传该参数时返回None
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def sim_data_response(sim_info_getter, sim_data):
+    """
+    返回查询成功的sim_data；If-None-Match与内容哈希一致时直接返回304，不再序列化
+    信封中的timeStamp每次都不同，所以ETag是弱ETag，只表示sim_data没有变化
+    """
+    etag = None
+    if get_response_encoder().encoding_settings["etag"]:
+        # 命中或写入结果缓存时哈希已经算好，只有来自本地存储的结果需要现算
+        etag = sim_info_getter.sim_data_etag or sim_data_etag(sim_data)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+    response = {
+        'code': '200',
+        'data': sim_data,
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return json_response(response, 200, etag)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if get_metrics().metrics_settings["server_timing"]:
+        start_request_timing()
+
+@app.after_request
+def log_request_record(response):
+    # 每个请求输出一条结构化记录；流式响应记录的是开始返回数据前的耗时
+    duration = time.perf_counter() - g.get('request_start', time.perf_counter())
+    log_request(
+        method=request.method,
+        path=request.path,
+        project=request.args.get('project') or request.form.get('project'),
+        status=response.status_code,
+        duration_ms=round(duration * 1000, 2),
+    )
+    metrics = get_metrics()
+    if metrics.enabled:
+        # 未知路径统一记为unmatched，避免标签数量无限增长
+        path = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.http_seconds.observe((request.method, path, str(response.status_code)), duration)
+    if metrics.metrics_settings["server_timing"]:
+        spans = pop_request_timings()
+        spans.append(('total', '', duration))
+        response.headers['Server-Timing'] = format_server_timing(spans)
+    return response
 
 
 @app.route('/')
@@ -41,7 +127,16 @@ def root():
 def sim_data_getter():
     project= request.args.get('project', '')
     search_value = request.args.get('search_value', '')
-    if project == '':
+    # fresh=1时跳过结果缓存，直接请求Jasper
+    fresh = request.args.get('fresh', '') in ('1', 'true')
+    # max_age=秒数时，本地存储中足够新的数据可以直接返回
+    max_age = request.args.get('max_age', type=float)
+    # include=basic只查基础信息；include=history并传入sim_id时不再请求基础信息；
+    # change_types只返回这些类型的变更历史，均为逗号分隔
+    include = comma_separated_arg('include')
+    change_types = comma_separated_arg('change_types')
+    sim_id = request.args.get('sim_id', type=int)
+    if project == '' or (include is not None and not (include and SIM_DATA_SECTIONS.issuperset(include))):
         response = {
             'code': '500',
             'data': {
@@ -50,28 +145,26 @@ def sim_data_getter():
             'message': '后台错误！',
             'timeStamp': timestamp_processor(datetime.now(),'ms')
         }
-        return jsonify(response), 500
+        return json_response(response, 500)
     sim_info_getter = SIMInfoGetter(project, search_value)
-    sim_data = sim_info_getter.get_sim_data()
+    sim_data = sim_info_getter.get_sim_data(fresh=fresh, max_age=max_age, include=include, change_types=change_types,
+                                            sim_id=sim_id)
     if sim_data["success"] == True:
-        response = {
-            'code': '200',
-            'data': sim_data,
-            'message': '请求成功！',
-            'timeStamp': timestamp_processor(datetime.now(), 'ms')
-        }
-        return jsonify(response), 200
+        return sim_data_response(sim_info_getter, sim_data)
     elif sim_data["success"] == False:
         if sim_data["error_message"] == "cookies_need_update":
             if sim_info_getter.update_cookies():
-                sim_data = sim_info_getter.get_sim_data()
+                sim_data = sim_info_getter.get_sim_data(fresh=fresh, include=include, change_types=change_types,
+                                                        sim_id=sim_id)
+                if sim_data["success"] == True:
+                    return sim_data_response(sim_info_getter, sim_data)
                 response = {
                     'code': '200',
                     'data': sim_data,
                     'message': '请求成功！',
                     'timeStamp': timestamp_processor(datetime.now(), 'ms')
                 }
-                return jsonify(response), 200
+                return json_response(response, 200)
             else:
                 response = {
                     'code': '500',
@@ -81,7 +174,7 @@ def sim_data_getter():
                     'message': '后台错误！',
                     'timeStamp': timestamp_processor(datetime.now(), 's')
                 }
-                return jsonify(response), 500
+                return json_response(response, 500)
 
         else:
             response = {
@@ -90,7 +183,284 @@ def sim_data_getter():
                 'message': '请求成功！',
                 'timeStamp': timestamp_processor(datetime.now(), 'ms')
             }
-            return jsonify(response), 200
+            return json_response(response, 200)
+
+@app.route('/JasperGetter/SIMDataBatch',methods=['POST'])
+def sim_data_batch_getter():
+    '''
+    批量查询，支持JSON：{"project": "GP", "search_values": [...], "fresh": false}
+    或者multipart表单：project字段加上传的CSV文件(file)
+    结果以NDJSON按完成顺序逐行返回，每行带各自的success和error_message
+    '''
+    if request.is_json:
+        body = request.get_json(silent=True) or {}
+        project = body.get('project', '')
+        search_values = body.get('search_values', [])
+        fresh = bool(body.get('fresh', False))
+    else:
+        project = request.form.get('project', '')
+        search_values = parse_search_values_csv(request.files['file']) if 'file' in request.files else []
+        fresh = request.form.get('fresh', '') in ('1', 'true')
+    if project == '' or not isinstance(search_values, list):
+        response = {
+            'code': '500',
+            'data': {
+                'error': '接口调用失败，请传入正确参数！'
+            },
+            'message': '后台错误！',
+            'timeStamp': timestamp_processor(datetime.now(),'ms')
+        }
+        return jsonify(response), 500
+    search_values = clean_search_values(search_values)
+    batch_executor = get_batch_executor(project)
+    if len(search_values) > batch_executor.max_items:
+        response = {
+            'code': '500',
+            'data': {
+                'error': f'单次最多查询{batch_executor.max_items}条！'
+            },
+            'message': '后台错误！',
+            'timeStamp': timestamp_processor(datetime.now(),'ms')
+        }
+        return jsonify(response), 500
+
+    encoder = get_response_encoder()
+
+    def generate():
+        for result in batch_executor.run(search_values, fresh=fresh):
+            yield encoder.dumps(result) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/JasperGetter/SIMSearch',methods=['GET'])
+def sim_search_getter():
+    '''
+    在本地存储中按IMEI或者VIN片段搜索，不请求Jasper
+    参数：project，imei或者vin，vin_match为prefix、suffix或contains（默认）
+    '''
+    project = request.args.get('project', '')
+    imei = request.args.get('imei', '')
+    vin = request.args.get('vin', '')
+    vin_match = request.args.get('vin_match', 'contains')
+    sim_store = get_sim_store()
+    if project == '' or not (imei or vin) or vin_match not in ('prefix', 'suffix', 'contains') \
+            or sim_store is None:
+        response = {
+            'code': '500',
+            'data': {
+                'error': '接口调用失败，请传入正确参数！'
+            },
+            'message': '后台错误！',
+            'timeStamp': timestamp_processor(datetime.now(),'ms')
+        }
+        return jsonify(response), 500
+    response = {
+        'code': '200',
+        'data': sim_store.search(project, imei=imei or None, vin=vin or None, vin_match=vin_match,
+                                 limit=request.args.get('limit', type=int)),
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return jsonify(response), 200
+
+@app.route('/JasperGetter/BrowserStats',methods=['GET'])
+def browser_stats_getter():
+    response = {
+        'code': '200',
+        'data': get_browser_pool().stats(),
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return jsonify(response), 200
+
+@app.route('/JasperGetter/CacheStats',methods=['GET'])
+def cache_stats_getter():
+    sim_result_cache = get_sim_result_cache()
+    response = {
+        'code': '200',
+        'data': sim_result_cache.stats() if sim_result_cache is not None else {},
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return jsonify(response), 200
+
+@app.route('/JasperGetter/LookupStats',methods=['GET'])
+def lookup_stats_getter():
+    '''
+    在途的单卡查询及各自的等待数，以及并发查询合并为一次上游请求的比例
+    '''
+    response = {
+        'code': '200',
+        'data': lookup_stats(),
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return jsonify(response), 200
+
+@app.route('/JasperGetter/UpstreamStats',methods=['GET'])
+def upstream_stats_getter():
+    '''
+    各项目发往Jasper的请求调控状态：当前并发上限、在途和排队数、拒绝次数
+    '''
+    response = {
+        'code': '200',
+        'data': upstream_governor_stats(),
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return jsonify(response), 200
+
+@app.route('/JasperGetter/Watchlist',methods=['GET','POST','DELETE'])
+def watchlist_getter():
+    '''
+    关注列表：GET ?project=GP列出关注的卡及上次轮询的状态；
+    POST/DELETE {"project": "GP", "search_values": [...]}添加或移除关注的ICCID/VIN
+    关注的卡由后台按波轮询，变化通过webhook、WatchlistEvents长轮询或WatchlistStream(SSE)获取
+    '''
+    if request.method == 'GET':
+        project = request.args.get('project', '')
+        search_values = []
+    else:
+        body = request.get_json(silent=True) or {}
+        project = body.get('project', '')
+        search_values = body.get('search_values', [])
+    watchlist_store = get_watchlist_store()
+    if project == '' or not isinstance(search_values, list) or watchlist_store is None \
+            or (request.method != 'GET' and not search_values):
+        response = {
+            'code': '500',
+            'data': {
+                'error': '接口调用失败，请传入正确参数！'
+            },
+            'message': '后台错误！',
+            'timeStamp': timestamp_processor(datetime.now(),'ms')
+        }
+        return jsonify(response), 500
+    search_values = clean_search_values(search_values)
+    if request.method == 'GET':
+        data = watchlist_store.watches(project)
+    elif request.method == 'DELETE':
+        data = {'removed': watchlist_store.remove(project, search_values)}
+    else:
+        max_watches = load_settings('watchlist', WATCHLIST_DEFAULTS, project)["max_watches"]
+        added = watchlist_store.add(project, search_values, max_watches)
+        if added is None:
+            response = {
+                'code': '500',
+                'data': {
+                    'error': f'每个项目最多关注{max_watches}张卡！'
+                },
+                'message': '后台错误！',
+                'timeStamp': timestamp_processor(datetime.now(),'ms')
+            }
+            return jsonify(response), 500
+        data = {'added': added}
+    response = {
+        'code': '200',
+        'data': data,
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return jsonify(response), 200
+
+@app.route('/JasperGetter/WatchlistEvents',methods=['GET'])
+def watchlist_events_getter():
+    '''
+    长轮询关注列表的变化事件：参数project，since为上次返回的last_id（不传则只等待之后的新事件），
+    timeout为最长等待秒数（默认25，最多60）；没有新事件时超时返回空列表
+    '''
+    project = request.args.get('project', '')
+    watchlist_store = get_watchlist_store()
+    if project == '' or watchlist_store is None:
+        response = {
+            'code': '500',
+            'data': {
+                'error': '接口调用失败，请传入正确参数！'
+            },
+            'message': '后台错误！',
+            'timeStamp': timestamp_processor(datetime.now(),'ms')
+        }
+        return jsonify(response), 500
+    since = request.args.get('since', type=int)
+    if since is None:
+        since = watchlist_store.last_event_id(project)
+    timeout = min(max(request.args.get('timeout', 25, type=float), 0), 60)
+    events = watchlist_store.wait_for_events(project, since, timeout)
+    response = {
+        'code': '200',
+        'data': {
+            'events': events,
+            'last_id': events[-1]["id"] if events else since,
+        },
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return json_response(response, 200)
+
+@app.route('/JasperGetter/WatchlistStream',methods=['GET'])
+def watchlist_stream_getter():
+    '''
+    以Server-Sent Events推送关注列表的变化事件，参数project；
+    断线重连时浏览器自动带上Last-Event-ID，从该事件之后继续推送。
+    每个连接占用一个线程，最长保持stream_max_seconds秒后由客户端重连
+    '''
+    project = request.args.get('project', '')
+    watchlist_store = get_watchlist_store()
+    if project == '' or watchlist_store is None:
+        response = {
+            'code': '500',
+            'data': {
+                'error': '接口调用失败，请传入正确参数！'
+            },
+            'message': '后台错误！',
+            'timeStamp': timestamp_processor(datetime.now(),'ms')
+        }
+        return jsonify(response), 500
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    if since is None:
+        since = watchlist_store.last_event_id(project)
+    watch_settings = load_settings('watchlist', WATCHLIST_DEFAULTS, project)
+    encoder = get_response_encoder()
+
+    def generate():
+        last_id = since
+        deadline = time.monotonic() + watch_settings["stream_max_seconds"]
+        while time.monotonic() < deadline:
+            events = watchlist_store.wait_for_events(project, last_id, watch_settings["heartbeat_interval"])
+            if not events:
+                # 心跳，避免代理因为连接空闲而断开
+                yield b': keepalive\n\n'
+                continue
+            for event in events:
+                yield b'id: %d\nevent: sim_change\ndata: %s\n\n' % (event["id"], encoder.dumps(event))
+            last_id = events[-1]["id"]
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/JasperGetter/WatchlistStats',methods=['GET'])
+def watchlist_stats_getter():
+    '''
+    各项目关注的卡数、保留的事件数，以及本进程的轮询波数、失败数和webhook失败次数
+    '''
+    response = {
+        'code': '200',
+        'data': watchlist_stats(),
+        'message': '请求成功！',
+        'timeStamp': timestamp_processor(datetime.now(), 'ms')
+    }
+    return jsonify(response), 200
+
+@app.route('/metrics',methods=['GET'])
+def metrics_getter():
+    '''
+    Prometheus文本格式的各阶段耗时和接口耗时直方图
+    '''
+    return Response(get_metrics().render(), mimetype='text/plain; version=0.0.4')
 
 # if __name__ == '__main__':
 #     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,148 @@
+"""
+异步ASGI入口，提供与app.py相同的/JasperGetter/SIMData和/JasperGetter/SIMDataBatch接口
+启动方式：uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+import json
+import time
+from urllib.parse import parse_qs
+
+from async_sim_details_getter import AsyncSIMInfoGetter, close_async_client
+from batch_lookup import BATCH_LOOKUP_DEFAULTS, clean_search_values
+from logging_setup import configure_logging, log_request
+from request_templates import get_request_templates
+from response_encoding import accepts_gzip, etag_matches, get_response_encoder, sim_data_etag
+from settings import load_settings
+
+
+def _envelope(code, data, message):
+    return {
+        'code': code,
+        'data': data,
+        'message': message,
+        'timeStamp': int(time.time() * 1000),
+    }
+
+
+def _bad_request_envelope(error='接口调用失败，请传入正确参数！'):
+    return _envelope('500', {'error': error}, '后台错误！')
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def _send_json(send, status, body, scope=None, etag=None):
+    encoder = get_response_encoder()
+    payload = encoder.dumps(body)
+    headers = [(b'content-type', b'application/json; charset=utf-8')]
+    if scope is not None:
+        payload, content_encoding = encoder.compress(payload, accepts_gzip(_header(scope, b'accept-encoding')))
+        if content_encoding is not None:
+            headers.append((b'content-encoding', content_encoding.encode()))
+        if encoder.encoding_settings["gzip"]:
+            headers.append((b'vary', b'Accept-Encoding'))
+    if etag is not None:
+        headers.append((b'etag', f'W/"{etag}"'.encode()))
+    headers.append((b'content-length', str(len(payload)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def _send_not_modified(send, etag):
+    await send({'type': 'http.response.start', 'status': 304, 'headers': [(b'etag', f'W/"{etag}"'.encode())]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def sim_data_getter(scope, receive, send):
+    query = parse_qs(scope['query_string'].decode('utf-8'))
+    project = query.get('project', [''])[0]
+    search_value = query.get('search_value', [''])[0]
+    fresh = query.get('fresh', [''])[0] in ('1', 'true')
+    if project == '':
+        await _send_json(send, 500, _bad_request_envelope())
+        return
+    getter = AsyncSIMInfoGetter(project, search_value)
+    sim_data = await getter.get_sim_data_with_refresh(fresh=fresh)
+    if not sim_data["success"] and sim_data.get("error_message") == "cookies_update_failed":
+        await _send_json(send, 500, _bad_request_envelope('Jasper账号cookies更新失败！'))
+        return
+    etag = None
+    if sim_data["success"] and get_response_encoder().encoding_settings["etag"]:
+        etag = getter.sim_data_etag or sim_data_etag(sim_data)
+        if etag_matches(_header(scope, b'if-none-match'), etag):
+            await _send_not_modified(send, etag)
+            return
+    await _send_json(send, 200, _envelope('200', sim_data, '请求成功！'), scope, etag)
+
+
+async def sim_data_batch_getter(scope, receive, send):
+    try:
+        body = json.loads(await _read_body(receive) or b'{}')
+    except json.decoder.JSONDecodeError:
+        body = {}
+    project = body.get('project', '')
+    search_values = body.get('search_values', [])
+    if project == '' or not isinstance(search_values, list):
+        await _send_json(send, 500, _bad_request_envelope())
+        return
+    search_values = clean_search_values(search_values)
+    max_items = load_settings('batch_lookup', BATCH_LOOKUP_DEFAULTS, project)["max_items"]
+    if len(search_values) > max_items:
+        await _send_json(send, 500, _bad_request_envelope(f'单次最多查询{max_items}条！'))
+        return
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/x-ndjson')],
+    })
+    getter = AsyncSIMInfoGetter(project)
+    encoder = get_response_encoder()
+    async for result in getter.get_sim_data_batch(search_values, bool(body.get('fresh', False))):
+        await send({'type': 'http.response.body', 'body': encoder.dumps(result) + b'\n', 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+_routes = {
+    ('GET', '/JasperGetter/SIMData'): sim_data_getter,
+    ('POST', '/JasperGetter/SIMDataBatch'): sim_data_batch_getter,
+}
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                configure_logging()
+                # 启动时编译请求模板，配置错误在启动阶段就暴露出来
+                get_request_templates()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_async_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    handler = _routes.get((scope['method'], scope['path']))
+    if handler is None:
+        await _send_json(send, 404, _envelope('404', {'error': '接口不存在！'}, '后台错误！'))
+        return
+    start = time.perf_counter()
+    await handler(scope, receive, send)
+    log_request(
+        method=scope['method'],
+        path=scope['path'],
+        duration_ms=round((time.perf_counter() - start) * 1000, 2),
+    )
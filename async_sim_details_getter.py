@@ -0,0 +1,392 @@
+import asyncio
+import json
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:  # 异步客户端是可选功能，只在使用时才需要aiohttp
+    aiohttp = None
+
+from SIMDetailsGetter import SIMInfoGetter
+from batch_lookup import BATCH_LOOKUP_DEFAULTS
+from cookie_store import get_cookie_store
+from history_sync import get_history_sync_store
+from http_session import HTTP_CLIENT_DEFAULTS
+from rate_limit import TokenBucket
+from request_templates import get_request_templates
+from result_cache import get_sim_result_cache
+from settings import load_settings
+from upstream_governor import UpstreamOverloaded, get_upstream_governor
+from sim_history import ChangeHistoryError, collapse_change_history, filter_change_records, parse_change_history_page
+
+
+class AsyncJasperClient:
+    """
+    异步HTTP客户端，每个项目一个aiohttp.ClientSession，共享连接池，绑定创建时的事件循环
+    超时、连接池大小和重试策略与同步客户端一样读取http_client配置
+    """
+    def __init__(self):
+        if aiohttp is None:
+            raise RuntimeError('异步客户端需要安装aiohttp：pip install aiohttp')
+        self.loop = asyncio.get_running_loop()
+        self._sessions = {}
+        self._settings = {}
+        # 最近一次同步到各项目cookie jar的cookies
+        self._synced_cookies = {}
+
+    def _session(self, project):
+        session = self._sessions.get(project)
+        if session is None:
+            http_settings = load_settings('http_client', HTTP_CLIENT_DEFAULTS, project)
+            connector = aiohttp.TCPConnector(limit=http_settings['async_pool_limit'])
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=http_settings['connect_timeout'],
+                sock_read=http_settings['read_timeout'],
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                # 允许向IP地址发送cookies，便于指向本地的Jasper桩服务
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            )
+            self._sessions[project] = session
+            self._settings[project] = http_settings
+            logging.info('为%s项目创建异步HTTP连接池：%s', project, http_settings)
+        return session
+
+    def sync_cookies(self, project, cookies_dict):
+        """
+        项目cookies发生变化时重建会话的cookie jar
+        """
+        session = self._session(project)
+        if cookies_dict == self._synced_cookies.get(project):
+            return
+        session.cookie_jar.clear()
+        session.cookie_jar.update_cookies(cookies_dict)
+        self._synced_cookies[project] = dict(cookies_dict)
+        logging.info('%s项目的异步会话cookies已同步', project)
+
+    async def get_json(self, project, url, headers, feedback=None):
+        """
+        发送GET请求并解析JSON，对5xx和连接错误按配置退避重试
+        :param feedback: 上游调控的反馈字典，传入时写入最后一次响应的status_code
+        :return: 响应字典
+        """
+        session = self._session(project)
+        http_settings = self._settings[project]
+        attempt = 0
+        while True:
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if feedback is not None:
+                        feedback["status_code"] = response.status
+                    if response.status in http_settings['retry_status_codes'] \
+                            and attempt < http_settings['max_retries']:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status)
+                    text = await response.text()
+                    return json.loads(text)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError):
+                if attempt >= http_settings['max_retries']:
+                    raise
+                await asyncio.sleep(http_settings['backoff_factor'] * (2 ** attempt))
+                attempt += 1
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
+_default_client = None
+
+
+def get_async_client():
+    """
+    获取当前事件循环共享的异步客户端，必须在事件循环中调用
+    """
+    global _default_client
+    if _default_client is None or _default_client.loop is not asyncio.get_running_loop():
+        _default_client = AsyncJasperClient()
+    return _default_client
+
+
+async def close_async_client():
+    global _default_client
+    if _default_client is not None:
+        await _default_client.close()
+        _default_client = None
+
+
+# 每个项目的cookies刷新锁，同一时间只有一个协程去更新cookies
+_refresh_locks = {}
+
+# 每个项目的批量查询并发上限和令牌桶，所有批量请求共用，与同步侧的get_batch_executor(project)一致
+_batch_limits = {}
+
+
+def get_batch_limits(project):
+    """
+    获取项目共享的批量查询信号量和令牌桶，信号量绑定事件循环，事件循环变化时重建
+    :return: (asyncio.Semaphore, TokenBucket)
+    """
+    loop = asyncio.get_running_loop()
+    limits = _batch_limits.get(project)
+    if limits is None or limits[0] is not loop:
+        batch_settings = load_settings('batch_lookup', BATCH_LOOKUP_DEFAULTS, project)
+        limits = (loop, asyncio.Semaphore(batch_settings["max_concurrency"]),
+                  TokenBucket(batch_settings["lookups_per_second"], batch_settings["burst"]))
+        _batch_limits[project] = limits
+        logging.info('为%s项目创建异步批量查询限制：%s', project, batch_settings)
+    return limits[1], limits[2]
+
+
+class AsyncSIMInfoGetter:
+    """
+    SIMInfoGetter的异步版本，共用配置文件、请求模板、cookies缓存、结果缓存以及结果规范化逻辑，
+    一个进程可以同时保持数百个查询在途
+    """
+    def __init__(self, project=None, search_value=None, client=None):
+        self.project = project
+        self.search_value = search_value
+        self.client = client
+        self.cookies_file_path = 'config/cookies_for_request.json'
+        self.cookie_store = get_cookie_store(self.cookies_file_path)
+        # 最近一次get_sim_data结果的内容哈希，结果来自或写入了结果缓存时才有值
+        self.sim_data_etag = None
+        # 最近一次请求使用的cookies，cookies失效时据此判断是否已被其他调用方更新
+        self.request_cookies = None
+
+    def _client(self):
+        if self.client is None:
+            self.client = get_async_client()
+        return self.client
+
+    async def mno_get_request(self, request_name, search_value, **extra_params):
+        """
+        构建并发送jasper API请求
+        :param request_name: 请求名,参照http_request_parameter.json
+        :param search_value: 请求的搜索值
+        :param extra_params: 模板中的其他占位符参数
+        :return: 响应字典
+        """
+        client = self._client()
+        self.request_cookies = self.cookie_store.get(self.project) or {}
+        client.sync_cookies(self.project, self.request_cookies)
+        param_dict = {
+            "timestamp_now": int(time.time() * 1000),
+            "search_value": search_value,
+        }
+        param_dict.update(extra_params)
+        url, headers = get_request_templates()[request_name].render(param_dict)
+        logging.debug('渲染请求结果：\n %s', url)
+        # 与同步客户端共用项目的上游调控，协程和线程发出的请求计入同一个并发上限和令牌桶
+        governor = get_upstream_governor(self.project)
+        if governor is None:
+            return await client.get_json(self.project, url, headers)
+        async with governor.async_slot(request_name) as feedback:
+            return await client.get_json(self.project, url, headers, feedback)
+
+    async def fetch_sim_basic_data(self, search_value):
+        try:
+            response = await self.mno_get_request('sim_basic_data', search_value)
+        except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamOverloaded) as e:
+            logging.error('请求Jasper失败：%r', e)
+            return {"success": False, "error_message": "upstream_error"}
+        return SIMInfoGetter.parse_sim_basic_data_response(response)
+
+    async def iter_sim_change_history(self, sim_id, change_types=None, start_after=None, start_before=None,
+                                      page_size=None):
+        """
+        与SIMInfoGetter.iter_sim_change_history相同，逐页请求并产出SIMChangeRecord
+        """
+        extra_params = {} if page_size is None else {"limit": page_size}
+        page = 1
+        fetched = 0
+        while True:
+            try:
+                response = await self.mno_get_request('sim_change_history', str(sim_id), page=page, **extra_params)
+            except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamOverloaded) as e:
+                logging.error('请求Jasper失败：%r', e)
+                raise ChangeHistoryError("upstream_error") from e
+            records, total_count = parse_change_history_page(response)
+            fetched += len(records)
+            for record in filter_change_records(records, change_types, start_after, start_before):
+                yield record
+            if not records or fetched >= total_count:
+                return
+            page += 1
+
+    async def sync_sim_change_history(self, sim_id):
+        """
+        与SIMInfoGetter.sync_sim_change_history相同的增量同步，共用同一份水位和历史
+        """
+        history_sync_store = get_history_sync_store()
+        if history_sync_store is None:
+            return [record async for record in self.iter_sim_change_history(sim_id)]
+        watermark = history_sync_store.watermark(self.project, sim_id)
+        if watermark is not None:
+            new_records = []
+            records_iterator = self.iter_sim_change_history(sim_id, page_size=history_sync_store.delta_page_size)
+            try:
+                async for record in records_iterator:
+                    if history_sync_store.is_known(record, watermark):
+                        break
+                    new_records.append(record)
+            finally:
+                await records_iterator.aclose()
+            records = history_sync_store.merge(self.project, sim_id, new_records, watermark)
+            if records is not None:
+                return records
+        records = [record async for record in self.iter_sim_change_history(sim_id)]
+        return history_sync_store.merge(self.project, sim_id, records, None)
+
+    async def fetch_sim_change_history(self, sim_id):
+        """
+        :return: (error_message, sim_change_history字典)，成功时error_message为None
+        """
+        try:
+            return None, collapse_change_history(await self.sync_sim_change_history(sim_id))
+        except ChangeHistoryError as e:
+            return e.error_message, {}
+
+    async def get_sim_basic_data_batch(self, search_values, batch_size=100, page_size=500):
+        """
+        与SIMInfoGetter.get_sim_basic_data_batch相同，各批次并发请求
+        :return: {查询值: 与fetch_sim_basic_data相同格式的结果}
+        """
+        search_values = list(dict.fromkeys(search_values))
+
+        async def fetch_chunk(chunk):
+            rows = []
+            page = 1
+            while True:
+                try:
+                    response = await self.mno_get_request('sim_basic_data_batch', None,
+                                                          search_values=chunk, page=page, limit=page_size)
+                except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamOverloaded) as e:
+                    logging.error('请求Jasper失败：%r', e)
+                    return {value: {"success": False, "error_message": "upstream_error"} for value in chunk}
+                if "totalCount" not in response:
+                    error_result = SIMInfoGetter.parse_error_response(response)
+                    return {value: dict(error_result) for value in chunk}
+                page_rows = response["data"] or []
+                rows.extend(page_rows)
+                if not page_rows or len(rows) >= response["totalCount"]:
+                    return SIMInfoGetter.match_sim_basic_data_rows(chunk, rows)
+                page += 1
+
+        chunks = [search_values[start:start + batch_size] for start in range(0, len(search_values), batch_size)]
+        results = {}
+        for chunk_results in await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks)):
+            results.update(chunk_results)
+        return results
+
+    async def get_sim_data(self, fresh=False, sim_basic_data=None):
+        """
+        与SIMInfoGetter.get_sim_data相同的查询和缓存逻辑
+        :return: 返回一个字典，为全部SIM卡信息
+        """
+        self.sim_data_etag = None
+        sim_result_cache = get_sim_result_cache()
+        cached = None
+        if sim_result_cache is not None and not fresh:
+            cached = sim_result_cache.get(self.project, self.search_value)
+        if cached is not None and cached.history_fresh:
+            self.sim_data_etag = cached.etag
+            return cached.sim_data
+        if cached is not None:
+            sim_basic_data = cached.sim_data["sim_basic_data"]
+        elif sim_basic_data is None:
+            basic_result = await self.fetch_sim_basic_data(self.search_value)
+            if not basic_result["success"]:
+                return basic_result
+            sim_basic_data = basic_result["sim_basic_data"]
+        error_message, sim_change_history = await self.fetch_sim_change_history(sim_basic_data["sim_id"])
+        sim_data = {
+            "success": error_message is None,
+            "sim_basic_data": sim_basic_data,
+            "sim_change_history": sim_change_history,
+        }
+        if error_message is not None:
+            sim_data["error_message"] = error_message
+        elif sim_result_cache is not None:
+            self.sim_data_etag = sim_result_cache.put(self.project, self.search_value, sim_data,
+                                                      basic_refreshed=cached is None)
+        return sim_data
+
+    async def update_cookies(self):
+        """
+        在线程中执行浏览器登录更新cookies，同一项目的并发调用只登录一次
+        :return: bool值
+        """
+        lock = _refresh_locks.setdefault(self.project, asyncio.Lock())
+        stale_cookies_dict = self.request_cookies or {}
+        async with lock:
+            # 请求之后其他协程已经更新过cookies则直接复用
+            current_cookies_dict = self.cookie_store.get(self.project)
+            if current_cookies_dict and current_cookies_dict != stale_cookies_dict:
+                return True
+            # 不加载cookies，避免项目还没有cookies时构造函数先登录一次；失效的cookies交给共享的单飞登录判断
+            getter = SIMInfoGetter(self.project, load_cookies=False)
+            return await asyncio.to_thread(getter.update_cookies, stale_cookies_dict)
+
+    async def get_sim_data_with_refresh(self, fresh=False, sim_basic_data=None):
+        """
+        查询SIM卡信息，cookies失效时更新一次后重试
+        """
+        sim_data = await self.get_sim_data(fresh=fresh, sim_basic_data=sim_basic_data)
+        if not sim_data["success"] and sim_data.get("error_message") == "cookies_need_update":
+            if await self.update_cookies():
+                sim_data = await self.get_sim_data(fresh=fresh)
+            else:
+                sim_data = {"success": False, "error_message": "cookies_update_failed"}
+        return sim_data
+
+    async def get_sim_data_batch(self, search_values, fresh=False):
+        """
+        并发查询多个值，并发数和速率使用batch_lookup配置并由项目的全部批量请求共享，按完成顺序逐条产出结果
+        :param search_values: 查询值列表
+        :param fresh: 是否跳过结果缓存
+        :return: 结果字典的异步生成器
+        """
+        batch_settings = load_settings('batch_lookup', BATCH_LOOKUP_DEFAULTS, self.project)
+        semaphore, rate_limiter = get_batch_limits(self.project)
+        prefetched = {}
+        if batch_settings["prefetch_basic_data"]:
+            sim_result_cache = get_sim_result_cache()
+            to_prefetch = [
+                value for value in search_values
+                if fresh or sim_result_cache is None or not sim_result_cache.contains(self.project, value)
+            ]
+            if to_prefetch:
+                basic_results = await self.get_sim_basic_data_batch(
+                    to_prefetch, batch_settings["basic_data_batch_size"], batch_settings["basic_data_page_size"])
+                prefetched = {
+                    value: result["sim_basic_data"] for value, result in basic_results.items() if result["success"]
+                }
+
+        async def lookup(search_value):
+            async with semaphore:
+                wait = rate_limiter.try_acquire()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = rate_limiter.try_acquire()
+                getter = AsyncSIMInfoGetter(self.project, search_value, self._client())
+                try:
+                    sim_data = await getter.get_sim_data_with_refresh(fresh, prefetched.get(search_value))
+                except Exception:
+                    logging.exception('批量查询%s失败', search_value)
+                    sim_data = {"success": False, "error_message": "unknown_error"}
+            result = {"search_value": search_value}
+            result.update(sim_data)
+            return result
+
+        tasks = [asyncio.ensure_future(lookup(search_value)) for search_value in search_values]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,148 @@
+import csv
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from SIMDetailsGetter import SIMInfoGetter
+from rate_limit import TokenBucket
+from result_cache import get_sim_result_cache
+from settings import load_settings
+
+# 批量查询的默认配置，可在service_settings.json的batch_lookup段中按项目覆盖
+BATCH_LOOKUP_DEFAULTS = {
+    "max_items": 5000,
+    "max_concurrency": 8,
+    "lookups_per_second": 10,
+    "burst": 10,
+    "prefetch_basic_data": True,
+    "basic_data_batch_size": 100,
+    "basic_data_page_size": 500,
+}
+
+
+class ProjectBatchExecutor:
+    """
+    单个项目的批量查询执行器，进程内同一项目的所有批量请求共用一个有界线程池和令牌桶，
+    线程池大小就是该项目的并发上限
+    """
+    def __init__(self, project, batch_settings):
+        self.project = project
+        self.max_items = batch_settings["max_items"]
+        self.prefetch_basic_data = batch_settings["prefetch_basic_data"]
+        self.basic_data_batch_size = batch_settings["basic_data_batch_size"]
+        self.basic_data_page_size = batch_settings["basic_data_page_size"]
+        self._executor = ThreadPoolExecutor(
+            max_workers=batch_settings["max_concurrency"],
+            thread_name_prefix=f'batch-{project}',
+        )
+        self._rate_limiter = TokenBucket(batch_settings["lookups_per_second"], batch_settings["burst"])
+
+    def prefetch(self, search_values, fresh=False):
+        """
+        用批量请求预先获取基础信息，已有完整缓存的查询值不再请求
+        :return: {查询值: sim_basic_data}，只包含能唯一对应到一张卡的查询值
+        """
+        sim_result_cache = get_sim_result_cache()
+        if sim_result_cache is not None and not fresh:
+            search_values = [value for value in search_values if not sim_result_cache.contains(self.project, value)]
+        if not search_values:
+            return {}
+        self._rate_limiter.acquire()
+        try:
+            basic_results = SIMInfoGetter(self.project).get_sim_basic_data_batch(
+                search_values, self.basic_data_batch_size, self.basic_data_page_size)
+        except Exception:
+            logging.exception('%s项目批量获取基础信息失败', self.project)
+            return {}
+        return {
+            search_value: result["sim_basic_data"]
+            for search_value, result in basic_results.items() if result["success"]
+        }
+
+    def lookup(self, search_value, fresh=False, sim_basic_data=None):
+        """
+        查询单个ICCID或VIN，cookies失效时更新一次后重试
+        :param sim_basic_data: 预先批量获取到的基础信息，有则只请求变更历史
+        :return: 单条结果字典，带search_value以及各自的success/error_message
+        """
+        self._rate_limiter.acquire()
+        try:
+            sim_info_getter = SIMInfoGetter(self.project, search_value)
+            sim_data = sim_info_getter.get_sim_data(fresh=fresh, sim_basic_data=sim_basic_data)
+            if not sim_data["success"] and sim_data.get("error_message") == "cookies_need_update":
+                if sim_info_getter.update_cookies():
+                    sim_data = sim_info_getter.get_sim_data(fresh=fresh)
+                else:
+                    sim_data = {"success": False, "error_message": "cookies_update_failed"}
+        except Exception:
+            logging.exception('批量查询%s失败', search_value)
+            sim_data = {"success": False, "error_message": "unknown_error"}
+        result = {"search_value": search_value}
+        result.update(sim_data)
+        return result
+
+    def run(self, search_values, fresh=False):
+        """
+        并发查询多个值，按完成顺序逐条产出结果
+        :param search_values: 查询值列表
+        :param fresh: 是否跳过结果缓存
+        :return: 结果字典的生成器
+        """
+        # 批量请求没能唯一对应的查询值（例如VIN片段）仍按单条查询处理
+        prefetched = self.prefetch(search_values, fresh) if self.prefetch_basic_data else {}
+        futures = [
+            self._executor.submit(self.lookup, search_value, fresh, prefetched.get(search_value))
+            for search_value in search_values
+        ]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # 调用方提前结束（例如客户端断开）时取消尚未开始的查询
+            for future in futures:
+                future.cancel()
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_batch_executor(project):
+    """
+    获取项目共享的批量查询执行器
+    """
+    with _executors_lock:
+        executor = _executors.get(project)
+        if executor is None:
+            batch_settings = load_settings('batch_lookup', BATCH_LOOKUP_DEFAULTS, project)
+            executor = ProjectBatchExecutor(project, batch_settings)
+            _executors[project] = executor
+            logging.info('为%s项目创建批量查询执行器：%s', project, batch_settings)
+        return executor
+
+
+def parse_search_values_csv(file_storage):
+    """
+    从上传的CSV中读取查询值，有search_value表头时取该列，否则取第一列
+    :param file_storage: 上传的文件对象
+    :return: 查询值列表
+    """
+    text = io.TextIOWrapper(file_storage.stream, encoding='utf-8-sig')
+    rows = list(csv.reader(text))
+    if not rows:
+        return []
+    header = [cell.strip() for cell in rows[0]]
+    if 'search_value' in header:
+        column = header.index('search_value')
+        rows = rows[1:]
+    else:
+        column = 0
+    return [row[column] for row in rows if len(row) > column]
+
+
+def clean_search_values(search_values):
+    """
+    去掉首尾空白和空值
+    """
+    return [str(value).strip() for value in search_values if str(value).strip()]
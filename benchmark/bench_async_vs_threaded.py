@@ -0,0 +1,91 @@
+"""
+对比线程池+SIMInfoGetter与AsyncSIMInfoGetter在本地Jasper桩服务上的吞吐
+两条路径都经过同一个项目的上游调控（令牌桶和自适应并发上限），吞吐受requests_per_second限制；
+--no-governor关闭上游调控，只比较两种客户端本身的开销
+用法：python benchmark/bench_async_vs_threaded.py --lookups 500 --concurrency 100 --latency 0.05
+需要在仓库根目录运行，以便读取config下的配置
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from jasper_stub import JasperStubServer
+
+
+def run_threaded(project, search_values, concurrency):
+    from SIMDetailsGetter import SIMInfoGetter
+
+    def lookup(search_value):
+        return SIMInfoGetter(project, search_value).get_sim_data(fresh=True)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lookup, search_values))
+
+
+async def run_async(project, search_values, concurrency):
+    from async_sim_details_getter import AsyncSIMInfoGetter, close_async_client
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def lookup(search_value):
+        async with semaphore:
+            return await AsyncSIMInfoGetter(project, search_value).get_sim_data(fresh=True)
+
+    try:
+        return await asyncio.gather(*(lookup(search_value) for search_value in search_values))
+    finally:
+        await close_async_client()
+
+
+def report(label, results, elapsed, upstream_requests):
+    from upstream_governor import upstream_governor_stats
+
+    succeeded = sum(1 for result in results if result["success"])
+    rejected = sum(stats["rejected_queue_full"] + stats["rejected_timeout"]
+                   for stats in upstream_governor_stats().values())
+    print(f'{label:<10} {len(results)} 次查询  成功 {succeeded}  耗时 {elapsed:.2f}s  '
+          f'吞吐 {len(results) / elapsed:.1f} 次/秒  上游 {upstream_requests / elapsed:.1f} 请求/秒  '
+          f'调控累计拒绝 {rejected}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--project', default='GP')
+    parser.add_argument('--lookups', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--no-governor', action='store_true', help='关闭上游调控')
+    args = parser.parse_args()
+    if args.no_governor:
+        import settings
+        # 覆盖读入内存的配置，调控器在第一次请求时才按配置创建
+        settings._load_all_settings().setdefault('upstream_governor', {})["enabled"] = False
+
+    stub = JasperStubServer(latency=args.latency).start()
+    # 必须在加载请求模板之前设置，使请求发往桩服务
+    os.environ['JASPER_BASE_URL'] = stub.base_url
+    import logging
+    logging.disable(logging.INFO)
+    search_values = [f'LSVBENCH{index:09d}' for index in range(args.lookups)]
+    try:
+        upstream_before = stub.stats()["requests"]
+        start = time.perf_counter()
+        results = run_threaded(args.project, search_values, args.concurrency)
+        report('threaded', results, time.perf_counter() - start, stub.stats()["requests"] - upstream_before)
+
+        upstream_before = stub.stats()["requests"]
+        start = time.perf_counter()
+        results = asyncio.run(run_async(args.project, search_values, args.concurrency))
+        report('asyncio', results, time.perf_counter() - start, stub.stats()["requests"] - upstream_before)
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
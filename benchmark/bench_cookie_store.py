@@ -0,0 +1,63 @@
+"""
+对比每次请求读取cookies的开销：
+旧实现每个请求都重新打开并解析cookies_for_request.json，再把字典格式化成DEBUG日志；
+新实现从进程级共享的ProjectCookieStore读取，只在文件变化时重新加载。
+用法：python benchmark/bench_cookie_store.py [--requests 20000]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cookie_store import ProjectCookieStore
+
+
+def legacy_load(file_path, project):
+    # 与旧版read_all_cookies + load_cookies一致：每次都打开、解析，并格式化调试输出
+    with open(file_path, 'r') as f:
+        all_cookies_json = json.load(f)
+    json.dumps(all_cookies_json, indent=4)
+    project_cookies_dict = all_cookies_json[project]
+    json.dumps(project_cookies_dict, indent=4)
+    return project_cookies_dict
+
+
+def store_load(store, project):
+    return store.get(project)
+
+
+def run(label, func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<10} {count} 次  总计 {elapsed:.3f}s  每次 {elapsed / count * 1e6:.1f}us')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--cookies-file', default='config/cookies_for_request.json')
+    args = parser.parse_args()
+
+    with open(args.cookies_file, 'r') as f:
+        all_cookies = json.load(f)
+    project = next(iter(all_cookies))
+    # 在临时文件上测试，避免影响真实的cookies文件
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'cookies_for_request.json')
+        with open(file_path, 'w') as f:
+            f.write(json.dumps(all_cookies, indent=4))
+        store = ProjectCookieStore(file_path)
+        before = run('before', lambda: legacy_load(file_path, project), args.requests)
+        after = run('after', lambda: store_load(store, project), args.requests)
+    print(f'加速比：{before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+对比变更历史规范化的旧实现与新实现在大量合成历史上的耗时
+旧实现：每条记录调用两次带日志装饰器的timestamp_processor，每次构造datetime并strftime，逐条重建字典
+新实现：parse_change_history_page构造SIMChangeRecord，collapse_change_history只格式化每种类型保留的记录，
+时间经过按天缓存的UTC格式化
+用法：python benchmark/bench_history_normalization.py --rows 100,1000,5000 --repeat 20
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from jasper_stub import JasperStubServer
+from sim_history import collapse_change_history, parse_change_history_page
+
+
+def legacy_log_method(func):
+    # 旧的log_method：每次调用前后各一条INFO日志
+    def wrapper(*args, **kwargs):
+        logging.info(f"========Start of {func.__name__}========")
+        result = func(*args, **kwargs)
+        logging.info(f"========End of {func.__name__}========")
+        return result
+    return wrapper
+
+
+@legacy_log_method
+def legacy_timestamp_processor(input_value, timestamp_level):
+    if type(input_value) == datetime:
+        if timestamp_level == 's':
+            return input_value.timestamp()
+        if timestamp_level == 'ms':
+            return int(input_value.timestamp() * 1000)
+    elif type(input_value) == int or type(input_value) == float:
+        if timestamp_level == 's':
+            input_value = input_value / 1000
+            return datetime.fromtimestamp(input_value, tz=timezone.utc)
+        if timestamp_level == 'ms':
+            return datetime.fromtimestamp(input_value, tz=timezone.utc)
+
+
+def legacy_parse(response):
+    sim_change_history = {}
+    if not response.get("success"):
+        return False, sim_change_history
+    for record in response["data"]:
+        change_type = record["changeTypeDisplay"]
+        start_time = legacy_timestamp_processor(record["startTime"], 's').strftime("%Y-%m-%d %H:%M:%S")
+        end_time = legacy_timestamp_processor(record["endTime"], 's').strftime("%Y-%m-%d %H:%M:%S")
+        sim_change_history[change_type] = {
+            "target_value": record["targetValue"],
+            "source_value": record["sourceValue"],
+            "start_time": start_time,
+            "end_time": end_time,
+            "change_by": record["userName"]
+        }
+    return True, sim_change_history
+
+
+def new_parse(response):
+    records, _ = parse_change_history_page(response)
+    return True, collapse_change_history(records)
+
+
+def timed(func, response, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(response)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', default='100,1000,5000', help='逗号分隔的历史条数')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    stub = JasperStubServer()
+    stub.stop()
+    devnull = open(os.devnull, 'w')
+    # 旧实现在导入时把根日志设为DEBUG并同步输出，这里输出到空设备
+    legacy_handler = logging.StreamHandler(devnull)
+    try:
+        for rows in (int(item) for item in args.rows.split(',')):
+            stub.history_length = rows
+            response = {"success": True, "data": stub.history_records(10000000001), "totalCount": rows}
+
+            logging.basicConfig(level=logging.DEBUG, handlers=[legacy_handler], force=True)
+            legacy_logged, legacy_result = timed(legacy_parse, response, args.repeat)
+            logging.getLogger().setLevel(logging.WARNING)
+            legacy_quiet, _ = timed(legacy_parse, response, args.repeat)
+            new_seconds, new_result = timed(new_parse, response, args.repeat)
+            assert legacy_result == new_result, '新旧实现结果不一致'
+            print(f'{rows:>6} 条  旧实现(含日志) {legacy_logged * 1000:8.2f}ms  旧实现(无日志) {legacy_quiet * 1000:8.2f}ms  '
+                  f'新实现 {new_seconds * 1000:7.2f}ms  加速 {legacy_logged / new_seconds:6.1f}x / '
+                  f'{legacy_quiet / new_seconds:5.1f}x')
+    finally:
+        devnull.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+统计服务模块的导入耗时和进程启动耗时，检查查询路径上没有加载selenium等浏览器依赖
+每个模块在新的解释器中用python -X importtime导入，重复多次取中位数，
+按顶层包汇总自身耗时，列出最慢的包；超出预算或者加载了禁止的包时退出码为1，可用于CI
+用法：
+python benchmark/bench_import_time.py --modules app,asgi_app,SIMDetailsGetter --repeat 5 --budget-ms 400
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_lookups import prepare_workdir
+
+# 子进程导入argv[1]中的模块后输出已加载的禁止包，禁止包由其余参数传入；
+# 用__import__而不是importlib.import_module，后者导入的模块本身不会出现在-X importtime的输出中
+PROBE = '''
+import json, sys
+__import__(sys.argv[1])
+print(json.dumps(sorted({name.split('.')[0] for name in sys.modules} & set(sys.argv[2:]))))
+'''
+
+
+def parse_importtime(stderr):
+    """
+    解析-X importtime的输出
+    :return: [(模块名, 自身耗时us, 累计耗时us)]
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        entries.append((name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def run_once(module, forbidden, workdir):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE, module] + list(forbidden),
+                               cwd=workdir, env=env, capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f'导入{module}失败：\n{completed.stderr[-2000:]}')
+    entries = parse_importtime(completed.stderr)
+    module_us = next((cumulative for name, _, cumulative in entries if name == module), None)
+    return {
+        "wall_seconds": wall_seconds,
+        "module_us": module_us,
+        "entries": entries,
+        "forbidden_loaded": json.loads(completed.stdout.strip().splitlines()[-1]),
+    }
+
+
+def interpreter_startup(repeat):
+    # 空解释器的启动耗时，用于从进程启动耗时中扣除
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', default='app,asgi_app,SIMDetailsGetter', help='逗号分隔的模块名')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='列出自身耗时最多的顶层包数量')
+    parser.add_argument('--budget-ms', type=float, default=None, help='单个模块导入耗时（中位数）上限')
+    parser.add_argument('--forbid', default='selenium,webdriver_manager', help='导入后不允许出现的顶层包')
+    parser.add_argument('--output', help='结果JSON的输出路径，默认只打印')
+    args = parser.parse_args()
+    forbidden = [name for name in args.forbid.split(',') if name]
+
+    workdir = prepare_workdir('GP')
+    failures = []
+    report = {"interpreter_startup_ms": round(interpreter_startup(args.repeat) * 1000, 1), "modules": []}
+    print(f'空解释器启动 {report["interpreter_startup_ms"]:.1f}ms')
+    try:
+        for module in args.modules.split(','):
+            runs = [run_once(module, forbidden, workdir) for _ in range(args.repeat)]
+            import_ms = statistics.median(run["module_us"] for run in runs) / 1000
+            wall_ms = statistics.median(run["wall_seconds"] for run in runs) * 1000
+            # 按顶层包汇总自身耗时，取各次运行的中位数
+            package_us = defaultdict(list)
+            for run in runs:
+                totals = defaultdict(int)
+                for name, self_us, _ in run["entries"]:
+                    totals[name.split('.')[0]] += self_us
+                for package, total in totals.items():
+                    package_us[package].append(total)
+            slowest = sorted(((package, statistics.median(samples) / 1000) for package, samples in package_us.items()),
+                             key=lambda item: item[1], reverse=True)[:args.top]
+            forbidden_loaded = sorted({name for run in runs for name in run["forbidden_loaded"]})
+            print(f'{module:<18} 导入 {import_ms:7.1f}ms  进程启动 {wall_ms:7.1f}ms  '
+                  f'加载的模块 {len(runs[0]["entries"])}')
+            for package, package_ms in slowest:
+                print(f'    {package:<24} {package_ms:7.1f}ms')
+            if forbidden_loaded:
+                failures.append(f'{module}加载了{", ".join(forbidden_loaded)}')
+            if args.budget_ms is not None and import_ms > args.budget_ms:
+                failures.append(f'{module}导入耗时{import_ms:.1f}ms，超过预算{args.budget_ms}ms')
+            report["modules"].append({
+                "module": module,
+                "import_ms": round(import_ms, 1),
+                "process_start_ms": round(wall_ms, 1),
+                "modules_loaded": len(runs[0]["entries"]),
+                "slowest_packages_ms": {package: round(package_ms, 1) for package, package_ms in slowest},
+                "forbidden_loaded": forbidden_loaded,
+            })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    for failure in failures:
+        print(f'未通过：{failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
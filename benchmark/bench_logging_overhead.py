@@ -0,0 +1,111 @@
+"""
+对比旧的日志方式（导入时把根日志设为DEBUG、同步写终端和app.log、调试日志中即时json.dumps(indent=4)）
+与configure_logging（INFO级别、队列后台写入、LazyJSON延迟序列化）下每次查询的日志开销
+Jasper请求被替换为桩服务格式的固定响应，只测量本进程内的CPU开销
+用法：python benchmark/bench_logging_overhead.py --lookups 2000
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from jasper_stub import JasperStubServer
+
+
+def prepare_workdir(project):
+    """
+    在临时目录中准备config，写入假的cookies，避免触发浏览器登录
+    """
+    workdir = tempfile.mkdtemp(prefix='bench_logging_')
+    shutil.copytree(os.path.join(REPO_ROOT, 'config'), os.path.join(workdir, 'config'))
+    with open(os.path.join(workdir, 'config', 'cookies_for_request.json'), 'w') as f:
+        json.dump({project: {"JSESSIONID": "bench", "XSRF-TOKEN": "bench"}}, f)
+    return workdir
+
+
+def install_canned_responses(eager_dumps):
+    """
+    把mno_get_request替换为返回固定响应
+    :param eager_dumps: 为True时按旧代码的方式在调试日志中即时序列化响应
+    """
+    from SIMDetailsGetter import SIMInfoGetter, LazyJSON
+
+    stub = JasperStubServer()
+    stub.stop()
+
+    def mno_get_request(self, request_name, search_value, **extra_params):
+        if request_name == 'sim_change_history':
+            response = stub.sim_changes_response({"search": json.dumps([{"value": search_value}])})
+        else:
+            response = stub.sims_response({"search": json.dumps([{"value": search_value}])})
+        if eager_dumps:
+            logging.debug('加载请求响应结果到字典：\n %s', json.dumps(response, indent=4))
+        else:
+            logging.debug('加载请求响应结果到字典：\n %s', LazyJSON(response))
+        return response
+
+    SIMInfoGetter.mno_get_request = mno_get_request
+
+
+def run_lookups(project, search_values):
+    from SIMDetailsGetter import SIMInfoGetter
+
+    start = time.perf_counter()
+    for search_value in search_values:
+        SIMInfoGetter(project, search_value).get_sim_data(fresh=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--project', default='GP')
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    workdir = prepare_workdir(args.project)
+    os.chdir(workdir)
+    search_values = [f'LSVBENCH{index:09d}' for index in range(args.lookups)]
+    devnull = open(os.devnull, 'w')
+    try:
+        from logging_setup import configure_logging
+
+        # 旧方式：与原先SIMDetailsGetter导入时的basicConfig相同，终端输出重定向到空设备
+        legacy_handlers = [
+            logging.StreamHandler(devnull),
+            logging.FileHandler('app_legacy.log', encoding="utf-8", mode='w'),
+        ]
+        logging.basicConfig(
+            level=logging.DEBUG,
+            format='%(asctime)s - %(levelname)s - %(message)s',
+            handlers=legacy_handlers,
+            force=True,
+        )
+        install_canned_responses(eager_dumps=True)
+        legacy_seconds = run_lookups(args.project, search_values)
+
+        # 新方式：应用启动时调用configure_logging
+        configure_logging(console=False, file='app.log')
+        install_canned_responses(eager_dumps=False)
+        new_seconds = run_lookups(args.project, search_values)
+    finally:
+        logging.shutdown()
+        devnull.close()
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for label, seconds in (('legacy', legacy_seconds), ('configured', new_seconds)):
+        print(f'{label:<12} {args.lookups} 次查询  耗时 {seconds:.2f}s  每次 {seconds / args.lookups * 1e6:.0f}us')
+    print(f'每次查询节省 {(legacy_seconds - new_seconds) / args.lookups * 1e6:.0f}us，'
+          f'加速 {legacy_seconds / new_seconds:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+离线压测：在本地Jasper桩服务上以不同并发驱动SIMInfoGetter.get_sim_data和Flask接口/JasperGetter/SIMData，
+统计吞吐、p50/p95/p99延迟、结果分布和每次查询的内存，结果写成JSON，便于在版本之间对比
+用法：
+python benchmark/bench_lookups.py --targets getter,flask --concurrency 1,8,32 --lookups 500 \
+    --latency 0.02 --error-rate 0.01 --history-length 50 --output bench_result.json
+python benchmark/bench_lookups.py ... --baseline bench_result.json  # 与上一次结果对比
+cookies失效的响应不会触发浏览器登录，登录被替换为立即失败，只统计失败路径的开销
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from jasper_stub import JasperStubServer
+
+
+def prepare_workdir(project):
+    """
+    在临时目录中准备config：写入假的cookies，关闭后台cookies续期，避免启动浏览器
+    """
+    workdir = tempfile.mkdtemp(prefix='bench_lookups_')
+    config_dir = os.path.join(workdir, 'config')
+    shutil.copytree(os.path.join(REPO_ROOT, 'config'), config_dir)
+    with open(os.path.join(config_dir, 'cookies_for_request.json'), 'w') as f:
+        json.dump({project: {"JSESSIONID": "bench"}}, f)
+    settings_path = os.path.join(config_dir, 'service_settings.json')
+    with open(settings_path, 'r', encoding='utf-8') as f:
+        service_settings = json.load(f)
+    service_settings.setdefault("cookie_refresher", {})["enabled"] = False
+    service_settings.setdefault("browser_pool", {}).update({"chromedriver_path": "chromedriver", "warm_projects": []})
+    service_settings.setdefault("logging", {}).update({"console": False, "file": ""})
+    with open(settings_path, 'w', encoding='utf-8') as f:
+        json.dump(service_settings, f, indent=2)
+    return workdir
+
+
+def percentile(sorted_values, fraction):
+    """
+    最近秩法求分位数
+    """
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def getter_lookup(project, include=None):
+    from SIMDetailsGetter import SIMInfoGetter
+
+    def lookup(search_value):
+        sim_data = SIMInfoGetter(project, search_value).get_sim_data(fresh=True, include=include)
+        return "ok" if sim_data["success"] else sim_data.get("error_message", "unknown_error")
+    return lookup
+
+
+def flask_lookup(project, base_url, include=None):
+    import requests
+
+    local = threading.local()
+    params = {"project": project, "fresh": "1"}
+    if include:
+        params["include"] = ','.join(include)
+
+    def lookup(search_value):
+        # 每个线程一个会话，复用连接
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        response = session.get(f'{base_url}/JasperGetter/SIMData',
+                               params=dict(params, search_value=search_value))
+        if response.status_code != 200:
+            return f'http_{response.status_code}'
+        sim_data = response.json()["data"]
+        if sim_data.get("success"):
+            return "ok"
+        return sim_data.get("error_message") or sim_data.get("error", "unknown_error")
+    return lookup
+
+
+def start_flask_server():
+    from werkzeug.serving import make_server
+    from app import app
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def measure_memory(lookup, search_values):
+    """
+    顺序执行若干次查询，用tracemalloc统计每次查询的峰值分配和保留下来的内存
+    """
+    tracemalloc.start()
+    try:
+        peaks = []
+        retained_before = tracemalloc.get_traced_memory()[0]
+        for search_value in search_values:
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            lookup(search_value)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        retained_after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return {
+        "peak_bytes_per_lookup": int(sum(peaks) / len(peaks)) if peaks else None,
+        "retained_bytes_per_lookup": int((retained_after - retained_before) / len(search_values))
+        if search_values else None,
+    }
+
+
+def run_case(target, lookup, concurrency, search_values, memory_sample):
+    latencies = []
+    outcomes = Counter()
+    lock = threading.Lock()
+
+    def timed(search_value):
+        start = time.perf_counter()
+        try:
+            outcome = lookup(search_value)
+        except Exception as e:
+            outcome = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            outcomes[outcome] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, search_values))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    result = {
+        "target": target,
+        "concurrency": concurrency,
+        "lookups": len(search_values),
+        "outcomes": dict(outcomes),
+        "elapsed_s": round(elapsed, 4),
+        "throughput_per_s": round(len(search_values) / elapsed, 2),
+        "latency_ms": {
+            name: round(value * 1000, 3) for name, value in (
+                ("mean", sum(latencies) / len(latencies)),
+                ("p50", percentile(latencies, 0.50)),
+                ("p95", percentile(latencies, 0.95)),
+                ("p99", percentile(latencies, 0.99)),
+                ("max", latencies[-1]),
+            )
+        },
+    }
+    if memory_sample:
+        result["memory"] = measure_memory(lookup, [f'{value}-mem' for value in search_values[:memory_sample]])
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_baseline(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {(item["target"], item["concurrency"]): item for item in json.load(f)["results"]}
+    print(f'与基线{baseline_path}对比：')
+    for result in results:
+        previous = baseline.get((result["target"], result["concurrency"]))
+        if previous is None:
+            continue
+        throughput_change = result["throughput_per_s"] / previous["throughput_per_s"] - 1
+        p95_change = result["latency_ms"]["p95"] / previous["latency_ms"]["p95"] - 1
+        print(f'{result["target"]:<7} c={result["concurrency"]:<4} 吞吐 {throughput_change:+.1%}  p95 {p95_change:+.1%}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--project', default='GP')
+    parser.add_argument('--targets', default='getter,flask', help='getter、flask，逗号分隔')
+    parser.add_argument('--concurrency', default='1,8,32', help='逗号分隔的并发数列表')
+    parser.add_argument('--lookups', type=int, default=500, help='每个场景的查询次数')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--history-length', type=int, default=None)
+    parser.add_argument('--auth-expired-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--include', default='', help='只查询的部分，例如basic，默认查询全部')
+    parser.add_argument('--memory-sample', type=int, default=50, help='用于统计内存的顺序查询次数，0表示不统计')
+    parser.add_argument('--output', help='结果JSON的输出路径，默认只打印')
+    parser.add_argument('--baseline', help='上一次的结果JSON，用于对比')
+    args = parser.parse_args()
+    include = [section for section in args.include.split(',') if section] or None
+    output_path = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    stub = JasperStubServer(latency=args.latency, error_rate=args.error_rate, history_length=args.history_length,
+                            auth_expired_rate=args.auth_expired_rate, seed=args.seed).start()
+    # 必须在加载请求模板之前设置，使请求发往桩服务
+    os.environ['JASPER_BASE_URL'] = stub.base_url
+    workdir = prepare_workdir(args.project)
+    os.chdir(workdir)
+    logging.disable(logging.INFO)
+    from SIMDetailsGetter import SIMInfoGetter
+    # 不启动浏览器，cookies失效时登录立即失败
+    SIMInfoGetter.refresh_cookies = lambda self, stale_cookies_dict: False
+
+    results = []
+    server = None
+    try:
+        for target in args.targets.split(','):
+            if target == 'getter':
+                lookup = getter_lookup(args.project, include)
+            elif target == 'flask':
+                if server is None:
+                    server, base_url = start_flask_server()
+                lookup = flask_lookup(args.project, base_url, include)
+            else:
+                parser.error(f'未知的压测对象：{target}')
+            for concurrency in (int(item) for item in args.concurrency.split(',')):
+                search_values = [f'LSVBENCH{concurrency:03d}{index:07d}' for index in range(args.lookups)]
+                upstream_before = stub.stats()["requests"]
+                result = run_case(target, lookup, concurrency, search_values, args.memory_sample)
+                # 包括统计内存时的顺序查询
+                result["upstream_requests_per_lookup"] = round(
+                    (stub.stats()["requests"] - upstream_before) / (len(search_values) + min(args.memory_sample, len(search_values))), 3)
+                results.append(result)
+                latency = result["latency_ms"]
+                print(f'{target:<7} c={concurrency:<4} 吞吐 {result["throughput_per_s"]:.1f}/s  '
+                      f'p50 {latency["p50"]:.1f}ms  p95 {latency["p95"]:.1f}ms  p99 {latency["p99"]:.1f}ms  '
+                      f'结果 {result["outcomes"]}')
+    finally:
+        if server is not None:
+            server.shutdown()
+        stub.stop()
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(),
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        "stub": stub.stats(),
+        "results": results,
+    }
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f'结果已写入{output_path}')
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    if baseline_path:
+        compare_with_baseline(results, baseline_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+对比/JasperGetter/SIMData轮询时各种响应编码的CPU耗时和响应字节数
+结果缓存命中后重复请求同一张卡：
+  序列化       原来的flask.jsonify与ResponseEncoder只计序列化的耗时
+  json         标准库json，不带ETag
+  orjson       orjson，不带ETag
+  orjson+gzip  orjson并gzip压缩
+  304          带上次的ETag重新请求，内容未变化
+用法：python benchmark/bench_response_encoding.py --history-length 50,500 --requests 2000
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_lookups import prepare_workdir
+from jasper_stub import JasperStubServer
+
+
+def timed_requests(client, url, headers, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        response = client.get(url, headers=headers)
+    return (time.perf_counter() - start) / count, response
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--project', default='GP')
+    parser.add_argument('--history-length', default='50,500', help='逗号分隔的变更历史条数')
+    parser.add_argument('--requests', type=int, default=2000, help='每种编码的请求次数')
+    args = parser.parse_args()
+
+    stub = JasperStubServer().start()
+    os.environ['JASPER_BASE_URL'] = stub.base_url
+    workdir = prepare_workdir(args.project)
+    os.chdir(workdir)
+    logging.disable(logging.INFO)
+    import flask
+    from app import app
+    from response_encoding import get_response_encoder, orjson
+    encoder = get_response_encoder()
+    client = app.test_client()
+    if orjson is None:
+        print('未安装orjson，orjson场景实际使用标准库json')
+    try:
+        for history_length in (int(item) for item in args.history_length.split(',')):
+            stub.history_length = history_length
+            url = f'/JasperGetter/SIMData?project={args.project}&search_value=LSVENCODE{history_length:07d}'
+            # 第一次请求写入结果缓存，之后都是缓存命中
+            warm = client.get(url)
+            envelope = warm.get_json()
+            with app.test_request_context():
+                start = time.perf_counter()
+                for _ in range(args.requests):
+                    envelope['timeStamp'] = int(datetime.now().timestamp() * 1000)
+                    legacy_bytes = flask.jsonify(envelope).get_data()
+                jsonify_seconds = (time.perf_counter() - start) / args.requests
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                envelope['timeStamp'] = int(datetime.now().timestamp() * 1000)
+                encoded_bytes = encoder.dumps(envelope)
+            encoder_seconds = (time.perf_counter() - start) / args.requests
+            print(f'{history_length:>5} 条历史  序列化 jsonify {jsonify_seconds * 1e6:6.1f}us {len(legacy_bytes)}字节  '
+                  f'ResponseEncoder {encoder_seconds * 1e6:6.1f}us {len(encoded_bytes)}字节')
+
+            cases = [
+                ('json', {"etag": False, "gzip": False}, False, {}),
+                ('orjson', {"etag": False, "gzip": False}, True, {}),
+                ('orjson+gzip', {"etag": False, "gzip": True}, True, {'Accept-Encoding': 'gzip'}),
+                ('304', {"etag": True, "gzip": True}, True, None),
+            ]
+            for name, overrides, use_orjson, headers in cases:
+                encoder.encoding_settings.update(overrides)
+                encoder.use_orjson = use_orjson and orjson is not None
+                if headers is None:
+                    headers = {'If-None-Match': client.get(url).headers['ETag'], 'Accept-Encoding': 'gzip'}
+                seconds, response = timed_requests(client, url, headers, args.requests)
+                print(f'{history_length:>5} 条历史  {name:<12} 整个请求 {seconds * 1e6:6.1f}us  '
+                      f'状态 {response.status_code}  {len(response.get_data()):>7} 字节')
+    finally:
+        stub.stop()
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+本地Jasper桩服务，模拟/provision/api/v1/sims和/provision/api/v1/simChanges，
+响应格式参照ref and test/SIMchangehistory.json，用于离线压测
+可以配置延迟、服务端错误比例、变更历史条数以及cookies失效（需要重新登录）的响应比例
+单独运行：python benchmark/jasper_stub.py --port 8900 --latency 0.05
+然后设置环境变量JASPER_BASE_URL=http://127.0.0.1:8900 再启动服务
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+REF_HISTORY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'ref and test', 'SIMchangehistory.json')
+
+# Jasper在会话失效时返回的响应
+AUTH_EXPIRED_RESPONSE = {"errorMessage": "Full authentication is required to access this resource"}
+SERVER_ERROR_RESPONSE = {"success": False, "errorMessage": "Internal Server Error"}
+
+
+def _sim_id_of(search_value):
+    # 由查询值稳定地推出一个simId，同一个值每次得到同一张卡
+    return 10000000000 + zlib.crc32(str(search_value).encode('utf-8')) % 90000000
+
+
+def make_sim_row(search_value):
+    sim_id = _sim_id_of(search_value)
+    return {
+        "simId": sim_id,
+        "iccid": search_value if str(search_value).startswith('8986') else f'8986{sim_id:016d}',
+        "custom1": search_value if not str(search_value).startswith('8986') else f'VIN{sim_id}',
+        "custom2": "VW",
+        "custom3": "Activated",
+        "sessionType": "DATA",
+        "activationDate": 1745907637979,
+        "simAuxFieldsDTO": {"imei": f'86{sim_id:013d}', "custom9": "ConMod"},
+    }
+
+
+class JasperStubServer:
+    """
+    在后台线程中运行的Jasper桩服务
+    """
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, history_length=None, auth_expired_rate=0.0, seed=None,
+                 inventory_size=0):
+        """
+        :param port: 监听端口，0表示随机端口
+        :param latency: 每个请求的固定延迟（秒）
+        :param error_rate: 返回HTTP 500的请求比例
+        :param history_length: 每张卡的变更历史条数，None表示与参考文件相同
+        :param auth_expired_rate: 返回cookies失效响应的请求比例
+        :param seed: 随机数种子，便于复现错误分布
+        :param inventory_size: 不带搜索条件查询/sims时返回的卡数，模拟项目的全部SIM卡清单
+        """
+        with open(REF_HISTORY_PATH, 'r', encoding='utf-8') as f:
+            self.history_template = json.load(f)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.history_length = history_length
+        self.auth_expired_rate = auth_expired_rate
+        self.inventory_size = inventory_size
+        self._random = random.Random(seed)
+        self.request_count = 0
+        self.error_count = 0
+        self.auth_expired_count = 0
+        self._count_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # 响应头和响应体分两次写出，不关闭Nagle时长连接上每个请求会多出几十毫秒的延迟确认
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                status, body = stub.pick_failure()
+                if stub.latency:
+                    time.sleep(stub.latency)
+                url = urlsplit(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if body is None:
+                    if url.path.endswith('/sims'):
+                        body = stub.sims_response(query)
+                    elif url.path.endswith('/simChanges'):
+                        body = stub.sim_changes_response(query)
+                    else:
+                        self.send_error(404)
+                        return
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def pick_failure(self):
+        """
+        按配置的比例决定本次请求是否返回错误
+        :return: (HTTP状态码, 错误响应)，正常请求时错误响应为None
+        """
+        with self._count_lock:
+            self.request_count += 1
+            draw = self._random.random()
+            if draw < self.error_rate:
+                self.error_count += 1
+                return 500, SERVER_ERROR_RESPONSE
+            if draw < self.error_rate + self.auth_expired_rate:
+                self.auth_expired_count += 1
+                return 401, AUTH_EXPIRED_RESPONSE
+        return 200, None
+
+    def stats(self):
+        with self._count_lock:
+            return {
+                "requests": self.request_count,
+                "errors": self.error_count,
+                "auth_expired": self.auth_expired_count,
+            }
+
+    def history_records(self, sim_id):
+        """
+        生成一张卡的全部变更历史，按dateModified倒序，与模板请求的sort/dir一致
+        """
+        template_records = self.history_template["data"]
+        length = len(template_records) if self.history_length is None else self.history_length
+        records = []
+        for index in range(length):
+            # 参考文件中的记录都是扁平的，浅拷贝即可
+            record = dict(template_records[index % len(template_records)])
+            # 超出参考文件条数的记录向更早的时间平移，保证simChangeId和dateModified不重复
+            shift = (index // len(template_records)) * 86400000
+            for field in ("startTime", "endTime", "dateAdded", "dateModified", "effectiveDate", "requestDate"):
+                if record.get(field) is not None:
+                    record[field] -= shift
+            record["simChangeId"] = record["simChangeId"] - index // len(template_records) * 1000000
+            record["simId"] = sim_id
+            records.append(record)
+        records.sort(key=lambda item: item["dateModified"], reverse=True)
+        return records
+
+    def sims_response(self, query):
+        search = json.loads(query.get('search', '[]'))
+        page = int(query.get('page', 1))
+        limit = int(query.get('limit', 50))
+        if not search:
+            # 全部清单按dateAdded升序，只生成请求的这一页
+            start = min((page - 1) * limit, self.inventory_size)
+            end = min(page * limit, self.inventory_size)
+            return {
+                "data": [make_sim_row(f'LSVFLEET{index:09d}') for index in range(start, end)],
+                "totalCount": self.inventory_size,
+                "success": True,
+            }
+        value = search[0]['value']
+        values = value if isinstance(value, list) else [value]
+        rows = [make_sim_row(item) for item in values if not str(item).startswith('missing')]
+        return {
+            "data": rows[(page - 1) * limit:page * limit],
+            "totalCount": len(rows),
+            "success": True,
+        }
+
+    def sim_changes_response(self, query):
+        body = {key: value for key, value in self.history_template.items() if key != "data"}
+        search = json.loads(query.get('search', '[]'))
+        sim_id = int(search[0]['value']) if search else 0
+        records = self.history_records(sim_id)
+        page = int(query.get('page', 1))
+        limit = int(query.get('limit', 200))
+        body["data"] = records[(page - 1) * limit:page * limit]
+        body["totalCount"] = len(records)
+        return body
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # 未启动时只释放端口，shutdown会一直等待serve_forever
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--history-length', type=int, default=None)
+    parser.add_argument('--auth-expired-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--inventory-size', type=int, default=0)
+    args = parser.parse_args()
+    stub = JasperStubServer(args.port, args.latency, args.error_rate, args.history_length,
+                            args.auth_expired_rate, args.seed, args.inventory_size).start()
+    print(f'Jasper桩服务已启动：{stub.base_url}')
+    try:
+        stub._thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
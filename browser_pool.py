@@ -0,0 +1,288 @@
+import atexit
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# selenium和webdriver_manager导入很慢，只在真正启动浏览器时才导入，查询路径和进程启动时不加载
+from settings import load_settings
+
+try:
+    import psutil
+except ImportError:  # 没有psutil时在Linux上读取/proc统计内存
+    psutil = None
+
+# 浏览器池的默认配置，可在service_settings.json的browser_pool段中修改
+BROWSER_POOL_DEFAULTS = {
+    # 最多同时保留的热浏览器数，超过时关闭最久未用的空闲浏览器
+    "max_browsers": 3,
+    # 需要人工输入邮箱验证码的账号应设为false，以便在窗口中操作
+    "headless": True,
+    # 浏览器用户目录的上级目录，每个进程的每个项目一个子目录，多个worker之间不会争用同一个用户目录
+    "profile_dir": "browser_profiles",
+    # 指定chromedriver路径时不再通过webdriver_manager解析
+    "chromedriver_path": "",
+    # 启动时预热的项目，为空则不预热
+    "warm_projects": [],
+}
+
+_driver_path = None
+_driver_path_lock = threading.Lock()
+
+
+def resolve_chromedriver_path():
+    """
+    解析chromedriver路径，进程内只解析一次，避免每次登录都访问网络检查驱动版本
+    """
+    global _driver_path
+    with _driver_path_lock:
+        if _driver_path is None:
+            configured_path = load_settings('browser_pool', BROWSER_POOL_DEFAULTS)["chromedriver_path"]
+            if configured_path:
+                _driver_path = configured_path
+            else:
+                from webdriver_manager.chrome import ChromeDriverManager
+                _driver_path = ChromeDriverManager().install()
+            logging.info('chromedriver路径：%s', _driver_path)
+        return _driver_path
+
+
+def _process_tree_rss(pid):
+    """
+    统计进程及其全部子进程的常驻内存
+    :return: 字节数，无法统计时返回None
+    """
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + process.children(recursive=True)
+            return sum(item.memory_info().rss for item in processes if item.is_running())
+        except psutil.Error:
+            return None
+    if not os.path.isdir('/proc'):
+        return None
+    # 读取/proc建立父子关系，再累加进程树的VmRSS
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                parent_pid = int(f.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(parent_pid, []).append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class BrowserPool:
+    """
+    热浏览器池：每个项目一个使用独立用户目录的无头Chrome，登录和恢复cookies时复用，
+    使用过程中出错或者进程退出时可靠地关闭浏览器
+    """
+    def __init__(self, pool_settings):
+        self.pool_settings = pool_settings
+        self._lock = threading.Lock()
+        # project -> driver，按最近使用排序
+        self._drivers = OrderedDict()
+        self._project_locks = {}
+        # 正在被使用、不在self._drivers中的浏览器数
+        self._in_use = 0
+        self._login_metrics = {}
+
+    def _project_lock(self, project):
+        with self._lock:
+            return self._project_locks.setdefault(project, threading.Lock())
+
+    def _profile_dir(self, project):
+        # Chrome不允许多个进程共用一个用户目录，按进程区分，否则第二个gunicorn worker的浏览器无法启动
+        return os.path.abspath(os.path.join(self.pool_settings["profile_dir"], f'{project}-{os.getpid()}'))
+
+    def _create_driver(self, project):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.chrome.service import Service
+
+        options = Options()
+        if self.pool_settings["headless"]:
+            options.add_argument("--headless=new")  # 无头模式
+        options.add_argument("--no-sandbox")  # 禁用沙盒（Docker 需要）
+        options.add_argument("--disable-dev-shm-usage")  # 避免内存问题
+        options.add_argument(f"--user-data-dir={self._profile_dir(project)}")
+        logging.info('为%s项目启动浏览器', project)
+        return webdriver.Chrome(service=Service(resolve_chromedriver_path()), options=options)
+
+    @staticmethod
+    def _alive(driver):
+        from selenium.common import WebDriverException
+
+        try:
+            driver.title
+            return True
+        except WebDriverException:
+            return False
+
+    def _quit(self, project, driver):
+        try:
+            driver.quit()
+            logging.info('已关闭%s项目的浏览器', project)
+        except Exception:
+            logging.exception('关闭%s项目的浏览器失败', project)
+        # 用户目录只属于本进程，登录状态已经保存在cookies文件中，关闭后删除以免目录随进程号不断增加
+        shutil.rmtree(self._profile_dir(project), ignore_errors=True)
+
+    def _evict_idle(self):
+        # 调用方需持有self._lock；只关闭没有被使用的浏览器
+        for project in list(self._drivers):
+            if len(self._drivers) + self._in_use <= self.pool_settings["max_browsers"]:
+                return
+            project_lock = self._project_locks[project]
+            if project_lock.acquire(blocking=False):
+                try:
+                    self._quit(project, self._drivers.pop(project))
+                finally:
+                    project_lock.release()
+
+    @contextmanager
+    def lease(self, project):
+        """
+        独占使用项目的浏览器，不存在或者已失效时新建；使用中抛出异常则关闭该浏览器
+        :param project: 项目名
+        :return: WebDriver
+        """
+        with self._project_lock(project):
+            with self._lock:
+                driver = self._drivers.pop(project, None)
+                self._in_use += 1
+            try:
+                if driver is not None and not self._alive(driver):
+                    self._quit(project, driver)
+                    driver = None
+                if driver is None:
+                    with self._lock:
+                        self._evict_idle()
+                    driver = self._create_driver(project)
+                try:
+                    yield driver
+                except BaseException:
+                    self._quit(project, driver)
+                    raise
+                with self._lock:
+                    self._drivers[project] = driver
+            finally:
+                with self._lock:
+                    self._in_use -= 1
+
+    def warm_up(self, projects):
+        """
+        预先启动项目的浏览器
+        """
+        for project in projects:
+            try:
+                with self.lease(project):
+                    pass
+            except Exception:
+                logging.exception('预热%s项目的浏览器失败', project)
+
+    def record_login(self, project, seconds, success):
+        """
+        记录一次登录（含复用cookies）的耗时和结果
+        """
+        with self._lock:
+            metrics = self._login_metrics.setdefault(project, {
+                "count": 0, "failures": 0, "total_seconds": 0.0, "max_seconds": 0.0, "last_seconds": 0.0,
+            })
+            metrics["count"] += 1
+            metrics["failures"] += 0 if success else 1
+            metrics["total_seconds"] += seconds
+            metrics["max_seconds"] = max(metrics["max_seconds"], seconds)
+            metrics["last_seconds"] = seconds
+
+    def stats(self):
+        """
+        :return: 各项目登录耗时统计和浏览器内存占用
+        """
+        with self._lock:
+            drivers = dict(self._drivers)
+            login_metrics = {project: dict(metrics) for project, metrics in self._login_metrics.items()}
+        browsers = {}
+        for project, driver in drivers.items():
+            process = getattr(driver.service, 'process', None)
+            browsers[project] = {"rss_bytes": _process_tree_rss(process.pid) if process else None}
+        return {"browsers": browsers, "logins": login_metrics}
+
+    def shutdown(self):
+        """
+        关闭全部浏览器
+        """
+        with self._lock:
+            drivers = list(self._drivers.items())
+            self._drivers.clear()
+        for project, driver in drivers:
+            self._quit(project, driver)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_browser_pool():
+    """
+    获取进程共享的浏览器池，进程退出时自动关闭全部浏览器
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool(load_settings('browser_pool', BROWSER_POOL_DEFAULTS))
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def start_browser_pool():
+    """
+    配置了warm_projects时，在后台解析chromedriver路径并预热浏览器；
+    没有需要预热的项目时不做任何事，chromedriver路径在第一次登录时解析，启动时不导入selenium
+    """
+    pool = get_browser_pool()
+    if not pool.pool_settings["warm_projects"]:
+        return pool
+
+    def prepare():
+        try:
+            resolve_chromedriver_path()
+        except Exception:
+            logging.exception('解析chromedriver路径失败')
+            return
+        pool.warm_up(pool.pool_settings["warm_projects"])
+
+    threading.Thread(target=prepare, name='browser-pool-prepare', daemon=True).start()
+    return pool
+
+
+@contextmanager
+def timed_login(project):
+    """
+    记录一次登录耗时，调用方在成功时把返回字典中的success置为True
+    """
+    outcome = {"success": False}
+    start = time.perf_counter()
+    try:
+        yield outcome
+    finally:
+        get_browser_pool().record_login(project, time.perf_counter() - start, outcome["success"])
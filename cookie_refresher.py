@@ -0,0 +1,114 @@
+import json
+import logging
+import threading
+import time
+
+from SIMDetailsGetter import SIMInfoGetter
+from settings import load_settings
+
+# 后台刷新的默认配置，可在service_settings.json的cookie_refresher段中按项目覆盖
+COOKIE_REFRESHER_DEFAULTS = {
+    "enabled": False,
+    # 每隔多少秒检查一次各项目cookies
+    "check_interval": 60,
+    # cookies在到期前多少秒开始续期
+    "refresh_margin": 1800,
+    # 每隔多少秒通过轻量请求探测一次会话是否仍然有效
+    "probe_interval": 300,
+    # 两次主动续期之间的最小间隔，避免服务端发放的cookies有效期过短时反复登录
+    "min_refresh_interval": 600,
+}
+
+WEBDRIVER_COOKIES_FILE_PATH = 'config/cookies_for_webdriver.json'
+MNO_ACCOUNT_FILE_PATH = 'config/mno_account.json'
+
+
+def earliest_cookie_expiry(project):
+    """
+    从cookies_for_webdriver.json中读取项目cookies最早的expiry
+    :param project: 项目名
+    :return: 秒级时间戳，没有带expiry的cookie时返回None
+    """
+    try:
+        with open(WEBDRIVER_COOKIES_FILE_PATH, 'r') as f:
+            cookies_for_webdriver = json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+    expiries = [cookie['expiry'] for cookie in cookies_for_webdriver.get(project, []) if 'expiry' in cookie]
+    return min(expiries) if expiries else None
+
+
+class CookieRefresher(threading.Thread):
+    """
+    后台线程：在cookies到期前主动续期，并定期探测会话是否已在服务端失效，
+    使用户请求不必在请求路径上等待浏览器登录
+    """
+    def __init__(self, projects):
+        super().__init__(name='cookie-refresher', daemon=True)
+        self.projects = list(projects)
+        self._stop_event = threading.Event()
+        self._last_probe = {}
+        self._last_refresh = {}
+
+    def stop(self):
+        self._stop_event.set()
+
+    def needs_refresh(self, project, refresher_settings, now):
+        """
+        :return: 需要续期的原因，不需要时返回None
+        """
+        expiry = earliest_cookie_expiry(project)
+        if expiry is not None and expiry - time.time() < refresher_settings["refresh_margin"]:
+            return 'cookies即将到期'
+        if now - self._last_probe.get(project, 0) >= refresher_settings["probe_interval"]:
+            self._last_probe[project] = now
+            if SIMInfoGetter(project).if_cookies_need_update():
+                return '会话已失效'
+        return None
+
+    def check_project(self, project):
+        refresher_settings = load_settings('cookie_refresher', COOKIE_REFRESHER_DEFAULTS, project)
+        now = time.monotonic()
+        if now - self._last_refresh.get(project, -float('inf')) < refresher_settings["min_refresh_interval"]:
+            return
+        reason = self.needs_refresh(project, refresher_settings, now)
+        if reason is None:
+            return
+        logging.info('%s项目%s，后台开始续期cookies', project, reason)
+        self._last_refresh[project] = now
+        # 与请求路径共用单飞登录，请求线程此时遇到cookies失效会等待这次登录的结果
+        if SIMInfoGetter(project).update_cookies():
+            logging.info('%s项目cookies后台续期成功', project)
+        else:
+            logging.error('%s项目cookies后台续期失败', project)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for project in self.projects:
+                try:
+                    self.check_project(project)
+                except Exception:
+                    logging.exception('%s项目cookies后台检查失败', project)
+            check_interval = load_settings('cookie_refresher', COOKIE_REFRESHER_DEFAULTS)["check_interval"]
+            self._stop_event.wait(check_interval)
+
+
+_refresher = None
+
+
+def start_cookie_refresher(projects=None):
+    """
+    按配置启动后台cookies刷新线程，未启用时返回None
+    :param projects: 需要维护的项目，默认为mno_account.json中的全部项目
+    """
+    global _refresher
+    if not load_settings('cookie_refresher', COOKIE_REFRESHER_DEFAULTS)["enabled"]:
+        return None
+    if _refresher is None:
+        if projects is None:
+            with open(MNO_ACCOUNT_FILE_PATH, 'r') as f:
+                projects = list(json.load(f))
+        _refresher = CookieRefresher(projects)
+        _refresher.start()
+        logging.info('后台cookies刷新线程已启动：%s', projects)
+    return _refresher
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import threading
+
+from file_utils import atomic_write_text, file_lock
+
+
+class ProjectCookieStore:
+    """
+    进程级的按项目cookies缓存，线程安全
+    cookies文件只在首次访问、文件mtime变化或者显式失效后才重新读取和解析，
+    SIMInfoGetter每次请求都从这里取当前项目的cookies，而不是重新打开cookies_for_request.json
+    """
+    def __init__(self, file_path):
+        # cookies_for_request.json的路径
+        self.file_path = file_path
+        self._lock = threading.RLock()
+        # 缓存的全部项目cookies，None表示尚未加载或者已失效
+        self._all_cookies = None
+        # 缓存对应的文件mtime，用于发现外部进程对文件的修改
+        self._mtime = None
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.file_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        """
+        从文件重新加载全部cookies，调用方需持有锁
+        :return: 全部项目的cookies字典，文件不存在或者为空时返回空字典
+        """
+        mtime = self._file_mtime()
+        if mtime is None:
+            logging.info('cookies文件不存在')
+            all_cookies = {}
+        else:
+            with open(self.file_path, 'r') as f:
+                try:
+                    all_cookies = json.load(f)
+                except json.decoder.JSONDecodeError:
+                    logging.info('cookies文件无内容')
+                    all_cookies = {}
+        self._all_cookies = all_cookies
+        self._mtime = mtime
+        logging.info('cookies文件已重新加载到缓存')
+        return all_cookies
+
+    def _current(self):
+        """
+        返回当前有效的缓存，如果文件mtime变化则先重新加载，调用方需持有锁
+        """
+        if self._all_cookies is None or self._file_mtime() != self._mtime:
+            return self._load()
+        return self._all_cookies
+
+    def get_all(self):
+        """
+        :return: 全部项目cookies字典的浅拷贝
+        """
+        with self._lock:
+            return dict(self._current())
+
+    def get(self, project):
+        """
+        :param project: 项目名
+        :return: 当前项目的cookies字典的拷贝，没有当前项目时返回None
+        """
+        with self._lock:
+            project_cookies = self._current().get(project)
+            if project_cookies is None:
+                return None
+            return dict(project_cookies)
+
+    def save(self, project, cookies_dict):
+        """
+        写入当前项目的cookies到文件，并同步更新缓存
+        :param project: 项目名
+        :param cookies_dict: 当前项目的cookies字典
+        """
+        # 文件锁保证多个进程对cookies文件的读-改-写不会互相覆盖，原子替换保证读取方不会读到半个文件
+        with self._lock, file_lock(self.file_path + '.lock'):
+            # 写之前以文件内容为准，避免覆盖其他项目在别处写入的cookies
+            all_cookies = dict(self._load())
+            all_cookies[project] = cookies_dict
+            atomic_write_text(self.file_path, json.dumps(all_cookies, indent=4))
+            self._all_cookies = all_cookies
+            self._mtime = self._file_mtime()
+            logging.info('%s项目cookies已经写入到cookies文件中', project)
+
+    def invalidate(self):
+        """
+        使缓存失效，下次访问时重新读取文件
+        """
+        with self._lock:
+            self._all_cookies = None
+            self._mtime = None
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_cookie_store(file_path):
+    """
+    获取指定cookies文件对应的进程级共享store
+    :param file_path: cookies文件路径
+    :return: ProjectCookieStore
+    """
+    key = os.path.abspath(file_path)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = ProjectCookieStore(file_path)
+            _stores[key] = store
+        return store
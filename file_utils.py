@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    跨进程的排他文件锁，阻塞直到取得锁
+    :param lock_path: 锁文件路径，不存在时自动创建
+    """
+    with open(lock_path, 'a+') as f:
+        if os.name == 'nt':
+            # msvcrt按当前位置加锁，追加模式打开后需要回到文件开头
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write_text(file_path, text):
+    """
+    先写入同目录下的临时文件再替换目标文件，读取方不会看到写了一半的内容
+    :param file_path: 目标文件路径
+    :param text: 文件内容
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix=os.path.basename(file_path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
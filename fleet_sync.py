@@ -0,0 +1,343 @@
+"""
+全量同步项目的SIM卡清单到本地SQLite快照，并与上一次完成的快照对比
+用法：
+python fleet_sync.py --project GP              # 同步一个项目，上次未完成的同步会从断点继续
+python fleet_sync.py --all --every 86400       # 每天同步mno_account.json中的全部项目
+python fleet_sync.py --project GP --report     # 只输出最近一次快照的统计和差异
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from SIMDetailsGetter import SIMInfoGetter
+from logging_setup import configure_logging
+from rate_limit import TokenBucket
+from settings import load_settings
+from sim_store import SIM_BASIC_DATA_FIELDS, get_sim_store
+
+# 全量同步的默认配置，可在service_settings.json的fleet_sync段中按项目覆盖
+FLEET_SYNC_DEFAULTS = {
+    "page_size": 500,
+    "max_concurrency": 4,
+    "requests_per_second": 2,
+    "burst": 2,
+    "snapshot_dir": "data/fleet_snapshots",
+    # 单页请求失败后的重试次数，仍失败的页在下次运行时从断点补齐
+    "page_retries": 2,
+}
+
+MNO_ACCOUNT_FILE_PATH = 'config/mno_account.json'
+
+_SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS run (
+    project TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    completed_at REAL,
+    page_size INTEGER NOT NULL,
+    total_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS pages_done (
+    page INTEGER PRIMARY KEY,
+    row_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sims (
+    sim_id INTEGER PRIMARY KEY,
+    iccid TEXT,
+    imei TEXT,
+    bound_vin TEXT,
+    brand TEXT,
+    lifecycle TEXT,
+    session_type_now TEXT,
+    device_type TEXT,
+    activation_datetime TEXT
+);
+"""
+
+
+class FleetSyncError(Exception):
+    pass
+
+
+class FleetSnapshot:
+    """
+    一次全量同步的快照文件，已完成的页和该页的数据在同一个事务中写入，中断后可以从断点继续
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(_SNAPSHOT_SCHEMA)
+
+    def run_info(self):
+        row = self.connection.execute(
+            'SELECT project, started_at, completed_at, page_size, total_count FROM run').fetchone()
+        if row is None:
+            return None
+        return dict(zip(("project", "started_at", "completed_at", "page_size", "total_count"), row))
+
+    def start(self, project, page_size):
+        with self._lock, self.connection:
+            self.connection.execute('INSERT INTO run (project, started_at, page_size) VALUES (?, ?, ?)',
+                                    (project, time.time(), page_size))
+
+    def set_total_count(self, total_count):
+        with self._lock, self.connection:
+            self.connection.execute('UPDATE run SET total_count = ?', (total_count,))
+
+    def pages_done(self):
+        return {row[0] for row in self.connection.execute('SELECT page FROM pages_done')}
+
+    def save_page(self, page, sim_basic_data_list):
+        with self._lock, self.connection:
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO sims ({", ".join(SIM_BASIC_DATA_FIELDS)}) '
+                f'VALUES ({", ".join("?" * len(SIM_BASIC_DATA_FIELDS))})',
+                [tuple(sim_basic_data[field] for field in SIM_BASIC_DATA_FIELDS)
+                 for sim_basic_data in sim_basic_data_list])
+            self.connection.execute('INSERT OR REPLACE INTO pages_done (page, row_count) VALUES (?, ?)',
+                                    (page, len(sim_basic_data_list)))
+
+    def complete(self):
+        with self._lock, self.connection:
+            self.connection.execute('UPDATE run SET completed_at = ?', (time.time(),))
+
+    def report(self):
+        """
+        :return: 卡数以及按生命周期、设备类型、品牌的统计
+        """
+        report = {"sims": self.connection.execute('SELECT count(*) FROM sims').fetchone()[0]}
+        for field in ("lifecycle", "device_type", "brand"):
+            report[field] = dict(self.connection.execute(
+                f'SELECT coalesce({field}, \'\'), count(*) FROM sims GROUP BY {field} ORDER BY count(*) DESC'))
+        return report
+
+    def diff(self, previous_path, sample_size=20):
+        """
+        与上一次的快照对比
+        :param previous_path: 上一次完成的快照路径
+        :param sample_size: 每类差异最多列出的simId个数
+        :return: 新增、移除、字段变化的卡数和示例，以及各字段变化的次数
+        """
+        self.connection.execute('ATTACH DATABASE ? AS previous', (previous_path,))
+        try:
+            changed_condition = ' OR '.join(f'current.{field} IS NOT previous.{field}'
+                                            for field in SIM_BASIC_DATA_FIELDS[1:])
+            added = [row[0] for row in self.connection.execute("""
+                SELECT sim_id FROM main.sims WHERE sim_id NOT IN (SELECT sim_id FROM previous.sims)""")]
+            removed = [row[0] for row in self.connection.execute("""
+                SELECT sim_id FROM previous.sims WHERE sim_id NOT IN (SELECT sim_id FROM main.sims)""")]
+            changed_rows = self.connection.execute(f"""
+                SELECT current.*, previous.* FROM main.sims AS current
+                JOIN previous.sims AS previous ON current.sim_id = previous.sim_id
+                WHERE {changed_condition}""").fetchall()
+        finally:
+            self.connection.execute('DETACH DATABASE previous')
+        field_changes = {}
+        width = len(SIM_BASIC_DATA_FIELDS)
+        for row in changed_rows:
+            for index, field in enumerate(SIM_BASIC_DATA_FIELDS[1:], start=1):
+                if row[index] != row[index + width]:
+                    field_changes[field] = field_changes.get(field, 0) + 1
+        return {
+            "previous": os.path.basename(previous_path),
+            "added": len(added),
+            "removed": len(removed),
+            "changed": len(changed_rows),
+            "field_changes": field_changes,
+            "added_sample": added[:sample_size],
+            "removed_sample": removed[:sample_size],
+            "changed_sample": [row[0] for row in changed_rows[:sample_size]],
+        }
+
+    def close(self):
+        self.connection.close()
+
+
+class FleetSync:
+    """
+    按页并发拉取/provision/api/v1/sims的全部记录，使用SIMInfoGetter的请求模板、连接池和cookies，
+    页按dateAdded升序排列，同步期间新增的卡只会出现在末尾，不会打乱已经取过的页
+    """
+    def __init__(self, project, sync_settings=None):
+        self.project = project
+        self.sync_settings = sync_settings or load_settings('fleet_sync', FLEET_SYNC_DEFAULTS, project)
+        self.snapshot_dir = os.path.join(self.sync_settings["snapshot_dir"], project)
+        self._rate_limiter = TokenBucket(self.sync_settings["requests_per_second"], self.sync_settings["burst"])
+        self._cookies_lock = threading.Lock()
+
+    def snapshot_paths(self):
+        """
+        :return: 按时间排序的快照路径列表
+        """
+        if not os.path.isdir(self.snapshot_dir):
+            return []
+        return sorted(os.path.join(self.snapshot_dir, name) for name in os.listdir(self.snapshot_dir)
+                      if name.endswith('.db'))
+
+    def _open_snapshot(self, resume):
+        """
+        :return: (快照, 是否为续跑)
+        """
+        paths = self.snapshot_paths()
+        if resume and paths:
+            snapshot = FleetSnapshot(paths[-1])
+            run_info = snapshot.run_info()
+            if run_info is not None and run_info["completed_at"] is None \
+                    and run_info["page_size"] == self.sync_settings["page_size"]:
+                logging.info('%s项目从断点继续同步：%s', self.project, paths[-1])
+                return snapshot, True
+            snapshot.close()
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = os.path.join(self.snapshot_dir, time.strftime('%Y%m%d_%H%M%S') + '.db')
+        snapshot = FleetSnapshot(path)
+        snapshot.start(self.project, self.sync_settings["page_size"])
+        return snapshot, False
+
+    def fetch_page(self, page):
+        """
+        请求一页SIM卡记录，cookies失效时更新一次后重试
+        :return: (本页的sim_basic_data列表, totalCount)
+        """
+        sim_info_getter = SIMInfoGetter(self.project)
+        for attempt in range(self.sync_settings["page_retries"] + 1):
+            self._rate_limiter.acquire()
+            try:
+                response = sim_info_getter.mno_get_request('sim_inventory', None, page=page,
+                                                           limit=self.sync_settings["page_size"])
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # ValueError：重试后仍是5xx页面等非JSON响应，与请求失败一样重试或者记入failed_pages
+                logging.error('%s项目第%s页请求失败：%r', self.project, page, e)
+                continue
+            if "totalCount" in response:
+                rows = response["data"] or []
+                return [SIMInfoGetter.normalize_sim_basic_data(row) for row in rows], response["totalCount"]
+            error_message = SIMInfoGetter.parse_error_response(response)["error_message"]
+            if error_message == "cookies_need_update":
+                with self._cookies_lock:
+                    if not sim_info_getter.update_cookies():
+                        raise FleetSyncError(f'{self.project}项目cookies更新失败')
+                continue
+            logging.error('%s项目第%s页返回未知错误：%r', self.project, page, response)
+        raise FleetSyncError(f'{self.project}项目第{page}页请求失败')
+
+    def run(self, resume=True):
+        """
+        执行一次全量同步，完成后与上一次完成的快照对比
+        :param resume: 上一次同步未完成时是否从断点继续
+        :return: 本次同步的统计和差异
+        """
+        previous_paths = [path for path in self.snapshot_paths() if self._completed(path)]
+        snapshot, resumed = self._open_snapshot(resume)
+        sim_store = get_sim_store()
+        try:
+            pages_done = snapshot.pages_done()
+            total_count = snapshot.run_info()["total_count"]
+            if total_count is None or 1 not in pages_done:
+                sim_basic_data_list, total_count = self.fetch_page(1)
+                snapshot.set_total_count(total_count)
+                snapshot.save_page(1, sim_basic_data_list)
+                if sim_store is not None:
+                    sim_store.save_basic_data(self.project, sim_basic_data_list)
+                pages_done.add(1)
+            page_count = max(1, -(-total_count // self.sync_settings["page_size"]))
+            pending_pages = [page for page in range(1, page_count + 1) if page not in pages_done]
+            logging.info('%s项目共%s条，%s页，待同步%s页', self.project, total_count, page_count, len(pending_pages))
+            failed_pages = []
+            with ThreadPoolExecutor(max_workers=self.sync_settings["max_concurrency"]) as executor:
+                futures = {executor.submit(self.fetch_page, page): page for page in pending_pages}
+                # 某一页失败时其余页照常完成并写入快照，下次只需补齐失败的页
+                for future in as_completed(futures):
+                    page = futures[future]
+                    try:
+                        sim_basic_data_list, _ = future.result()
+                    except FleetSyncError as e:
+                        logging.error('%s', e)
+                        failed_pages.append(page)
+                        continue
+                    snapshot.save_page(page, sim_basic_data_list)
+                    if sim_store is not None:
+                        sim_store.save_basic_data(self.project, sim_basic_data_list)
+                    logging.info('%s项目第%s页完成：%s条', self.project, page, len(sim_basic_data_list))
+            if failed_pages:
+                raise FleetSyncError(f'{self.project}项目有{len(failed_pages)}页同步失败：{sorted(failed_pages)}')
+            snapshot.complete()
+            result = {
+                "project": self.project,
+                "snapshot": snapshot.path,
+                "resumed": resumed,
+                "total_count": total_count,
+                "report": snapshot.report(),
+            }
+            previous_paths = [path for path in previous_paths if path != snapshot.path]
+            if previous_paths:
+                result["diff"] = snapshot.diff(previous_paths[-1])
+            return result
+        finally:
+            snapshot.close()
+
+    @staticmethod
+    def _completed(path):
+        snapshot = FleetSnapshot(path)
+        try:
+            run_info = snapshot.run_info()
+            return run_info is not None and run_info["completed_at"] is not None
+        finally:
+            snapshot.close()
+
+    def latest_report(self):
+        """
+        :return: 最近一次完成的快照的统计，以及与再上一次的差异
+        """
+        completed_paths = [path for path in self.snapshot_paths() if self._completed(path)]
+        if not completed_paths:
+            return None
+        snapshot = FleetSnapshot(completed_paths[-1])
+        try:
+            result = {"project": self.project, "snapshot": snapshot.path, "report": snapshot.report()}
+            if len(completed_paths) > 1:
+                result["diff"] = snapshot.diff(completed_paths[-2])
+            return result
+        finally:
+            snapshot.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='全量同步项目的SIM卡清单')
+    parser.add_argument('--project', action='append', help='项目名，可以重复')
+    parser.add_argument('--all', action='store_true', help='同步mno_account.json中的全部项目')
+    parser.add_argument('--no-resume', action='store_true', help='不从上一次未完成的同步继续')
+    parser.add_argument('--report', action='store_true', help='只输出最近一次快照的统计和差异')
+    parser.add_argument('--every', type=float, help='每隔多少秒重复同步一次')
+    args = parser.parse_args()
+    configure_logging()
+
+    projects = args.project or []
+    if args.all:
+        with open(MNO_ACCOUNT_FILE_PATH, 'r') as f:
+            projects = list(json.load(f))
+    if not projects:
+        parser.error('需要--project或者--all')
+
+    while True:
+        for project in projects:
+            fleet_sync = FleetSync(project)
+            try:
+                result = fleet_sync.latest_report() if args.report else fleet_sync.run(resume=not args.no_resume)
+            except FleetSyncError as e:
+                logging.error('%s，下次运行时从断点继续', e)
+                continue
+            print(json.dumps(result, indent=4, ensure_ascii=False))
+        if not args.every or args.report:
+            break
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    main()
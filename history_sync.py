@@ -0,0 +1,124 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from settings import load_settings
+
+# 变更历史增量同步的默认配置，可在service_settings.json的history_sync段中修改
+HISTORY_SYNC_DEFAULTS = {
+    "enabled": True,
+    # 最多保存多少张卡的变更历史，超过时淘汰最久未用的
+    "max_sims": 10000,
+    # 已有水位时每页的条数，重复查询通常只需要一页很小的增量请求
+    "delta_page_size": 20,
+}
+
+
+class _History:
+    __slots__ = ('records', 'watermark')
+
+    def __init__(self, records, watermark):
+        # 按dateModified倒序的全部SIMChangeRecord
+        self.records = records
+        # 见过的最新记录的(dateModified, simChangeId)
+        self.watermark = watermark
+
+
+def _record_key(record):
+    return record.date_modified, record.sim_change_id
+
+
+class ChangeHistorySyncStore:
+    """
+    按(project, simId)保存已经取到的变更历史和水位，线程安全
+    变更历史按dateModified倒序返回，再次同步时从第一页开始读，遇到第一条不比水位新的记录就停止翻页，
+    新取到的记录与保存的记录按simChangeId合并
+    """
+    def __init__(self, max_sims, delta_page_size):
+        self.max_sims = max_sims
+        self.delta_page_size = delta_page_size
+        self._lock = threading.Lock()
+        # (project, sim_id) -> _History，按最近使用排序
+        self._histories = OrderedDict()
+        self._counters = {"full_syncs": 0, "delta_syncs": 0, "records_fetched": 0, "evictions": 0}
+
+    def watermark(self, project, sim_id):
+        """
+        :return: (dateModified, simChangeId)，没有保存过该卡时返回None
+        """
+        with self._lock:
+            history = self._histories.get((project, str(sim_id)))
+            return history.watermark if history is not None else None
+
+    @staticmethod
+    def is_known(record, watermark):
+        """
+        记录是否不比水位新；缺少dateModified或simChangeId的记录一律当作新记录
+        """
+        if watermark is None or record.date_modified is None or record.sim_change_id is None:
+            return False
+        return _record_key(record) <= watermark
+
+    def merge(self, project, sim_id, new_records, watermark):
+        """
+        把本次取到的新记录合并到保存的历史中
+        :param new_records: 本次取到的、比水位新的记录，按dateModified倒序
+        :param watermark: 本次同步开始时读取的水位，None表示本次是全量同步
+        :return: 合并后的全部记录，按dateModified倒序；增量同步期间保存的历史已被淘汰时返回None，调用方需全量同步
+        """
+        key = (project, str(sim_id))
+        with self._lock:
+            history = self._histories.get(key)
+            if watermark is None:
+                records = list(new_records)
+                self._counters["full_syncs"] += 1
+            elif history is None:
+                return None
+            else:
+                # 状态变化的记录会带着新的dateModified再次出现，以新取到的为准
+                new_ids = {record.sim_change_id for record in new_records}
+                records = list(new_records) + [record for record in history.records
+                                               if record.sim_change_id not in new_ids]
+                records.sort(key=lambda record: record.date_modified or 0, reverse=True)
+                self._counters["delta_syncs"] += 1
+            self._counters["records_fetched"] += len(new_records)
+            keyed = [_record_key(record) for record in records
+                     if record.date_modified is not None and record.sim_change_id is not None]
+            self._histories[key] = _History(records, max(keyed) if keyed else None)
+            self._histories.move_to_end(key)
+            while len(self._histories) > self.max_sims:
+                self._histories.popitem(last=False)
+                self._counters["evictions"] += 1
+            return list(records)
+
+    def invalidate(self, project, sim_id):
+        with self._lock:
+            self._histories.pop((project, str(sim_id)), None)
+
+    def stats(self):
+        """
+        :return: 全量/增量同步次数、取到的记录数以及当前保存的卡数
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats["sims"] = len(self._histories)
+            return stats
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_history_sync_store():
+    """
+    获取进程共享的变更历史同步存储，未启用时返回None
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            sync_settings = load_settings('history_sync', HISTORY_SYNC_DEFAULTS)
+            if not sync_settings["enabled"]:
+                return None
+            _store = ChangeHistorySyncStore(sync_settings["max_sims"], sync_settings["delta_page_size"])
+            logging.info('已创建变更历史同步存储：%s', sync_settings)
+        return _store
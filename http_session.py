@@ -0,0 +1,101 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from settings import load_settings
+
+# 连接池、超时和重试的默认配置，可在service_settings.json的http_client段中按项目覆盖
+HTTP_CLIENT_DEFAULTS = {
+    "pool_connections": 4,
+    "pool_maxsize": 16,
+    "connect_timeout": 5,
+    "read_timeout": 30,
+    "max_retries": 3,
+    "backoff_factor": 0.5,
+    "retry_status_codes": [500, 502, 503, 504],
+    # 异步客户端的连接数上限，协程不占线程，可以比同步连接池大得多
+    "async_pool_limit": 200,
+}
+
+
+class JasperHTTPSession:
+    """
+    每个项目一个长连接的requests.Session，在线程之间共享
+    会话的cookie jar与项目cookies保持同步，不再手工拼接Cookie请求头
+    """
+    def __init__(self, project, http_settings):
+        self.project = project
+        self.timeout = (http_settings['connect_timeout'], http_settings['read_timeout'])
+        retry = Retry(
+            total=http_settings['max_retries'],
+            connect=http_settings['max_retries'],
+            read=http_settings['max_retries'],
+            status=http_settings['max_retries'],
+            backoff_factor=http_settings['backoff_factor'],
+            status_forcelist=http_settings['retry_status_codes'],
+            # 只重试幂等的GET请求，连接被重置时也会按read错误重试
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=http_settings['pool_connections'],
+            pool_maxsize=http_settings['pool_maxsize'],
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._cookies_lock = threading.Lock()
+        # 最近一次同步到cookie jar的项目cookies
+        self._synced_cookies = None
+
+    def sync_cookies(self, cookies_dict):
+        """
+        项目cookies发生变化时重建会话的cookie jar
+        :param cookies_dict: 当前项目的cookies字典
+        """
+        if cookies_dict == self._synced_cookies:
+            return
+        with self._cookies_lock:
+            if cookies_dict == self._synced_cookies:
+                return
+            self.session.cookies.clear()
+            for name, value in cookies_dict.items():
+                self.session.cookies.set(name, value)
+            self._synced_cookies = dict(cookies_dict)
+            logging.info('%s项目的会话cookies已同步', self.project)
+
+    def get(self, url, headers=None):
+        """
+        通过连接池发送GET请求
+        :param url: 请求url
+        :param headers: 请求头
+        :return: requests.Response
+        """
+        return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_http_session(project):
+    """
+    获取项目共享的HTTP会话，不存在则按配置创建
+    :param project: 项目名
+    :return: JasperHTTPSession
+    """
+    with _sessions_lock:
+        http_session = _sessions.get(project)
+        if http_session is None:
+            http_settings = load_settings('http_client', HTTP_CLIENT_DEFAULTS, project)
+            http_session = JasperHTTPSession(project, http_settings)
+            _sessions[project] = http_session
+            logging.info('为%s项目创建HTTP连接池：%s', project, http_settings)
+        return http_session
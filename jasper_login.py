@@ -0,0 +1,186 @@
+"""
+通过浏览器登录Jasper获取cookies
+依赖selenium和webdriver_manager，只在需要登录时由SIMInfoGetter加载，查询路径和进程启动时不会导入
+"""
+import json
+import logging
+import time
+
+from selenium.common import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+
+from SIMDetailsGetter import LOGIN_DEFAULTS
+from browser_pool import get_browser_pool, timed_login
+from file_utils import atomic_write_text, file_lock
+from settings import load_settings
+
+
+class LoginVerificationRequired(Exception):
+    """
+    登录需要人工输入邮箱验证码，而浏览器是无头模式，没有人能完成验证
+    """
+
+
+def webdriver_cookies_getter(project):
+    """
+    用于执行webdriver登录
+    :param project: 项目名
+    :return: 返回获取到的cookies_list
+    """
+    # 加载配置文件中的用户名和密码
+    logging.debug('开始加载配置文件内容：')
+    with open('config/mno_account.json', 'r') as f:
+        mno_account_info_dict = json.load(f)
+        username = mno_account_info_dict[project]['ID']
+        password = mno_account_info_dict[project]['PW']
+        logging.debug('用户名和密码配置加载完成')
+    # 加载配置文件中的链接和元素
+    with open('config/url_and_element.json', 'r') as f:
+        url_and_element_dict = json.load(f)
+        url_login = url_and_element_dict['urls']['Jasper_login']
+        element_xpath_dict = url_and_element_dict['element_xpath']
+        logging.debug('url和页面元素配置加载完成')
+    # 从热浏览器池中取当前项目的浏览器，登录前后不再冷启动和关闭浏览器
+    with timed_login(project) as login_outcome, get_browser_pool().lease(project) as driver:
+        try:
+            cookies_list = webdriver_restore_or_login(project, driver, url_login, element_xpath_dict, username,
+                                                      password)
+        except LoginVerificationRequired:
+            logging.error('%s项目登录需要邮箱验证码，无头浏览器无法完成；'
+                          '请将browser_pool.headless设为false后人工登录一次', project)
+            return []
+        login_outcome["success"] = bool(cookies_list)
+        return cookies_list
+
+
+def webdriver_restore_or_login(project, driver, url_login, element_xpath_dict, username, password):
+    """
+    先尝试用cookies_for_webdriver.json中的cookies恢复登录状态，失败再输入账号密码登录
+    :return: 返回获取到的cookies_list
+    """
+    driver.get(url_login)  # 正常访问网页
+    logging.info('访问： %s', url_login)
+
+    try:
+        with open('config/cookies_for_webdriver.json', 'r') as f:
+            logging.info('读取cookies_for_webdriver')
+            try:
+                cookies_for_webdriver = json.load(f)
+            except json.decoder.JSONDecodeError:
+                logging.info('cookies_for_webdriver没有内容')
+                cookies_for_webdriver = {}
+        if cookies_for_webdriver != {} and project in cookies_for_webdriver.keys():
+            logging.info('开始加载cookies到webdriver')
+            driver.delete_all_cookies()
+            for cookie in cookies_for_webdriver[project]:
+                driver.add_cookie(cookie)
+            driver.get(url_login)
+            logging.info('刷新driver完成')
+            logging.debug('当前页面名：%s', driver.title)
+            if 'Welcome to the Control Center!' in driver.title:
+                pass
+            elif '欢迎' in driver.title:
+                logging.info('登录成功')
+                cookies_list = driver.get_cookies()
+                # 恢复成功后也写回文件，后台续期按新的expiry判断，不会反复恢复
+                save_webdriver_cookies(project, cookies_list)
+                return cookies_list
+        else:
+            logging.info('cookies_for_webdriver没有当前项目的内容')
+            logging.info('开始获取cookies for webdriver')
+            # 池中的浏览器可能残留其他会话的cookies，登录前清空
+            driver.delete_all_cookies()
+            driver.get(url_login)
+    except FileNotFoundError:
+        pass
+    logging.info('开始更新cookies')
+    cookies_list = webdriver_login(project, driver, element_xpath_dict, username, password)
+    return cookies_list
+
+
+def save_webdriver_cookies(project, cookies_list):
+    """
+    把当前项目浏览器中的cookies写入cookies_for_webdriver.json
+    :param project: 项目名
+    :param cookies_list: driver.get_cookies()的结果
+    """
+    logging.info('写入新的cookies到cookies_for_webdriver.json')
+    # 不同项目可能同时登录，读-改-写需要加文件锁，并原子替换文件
+    with file_lock('config/cookies_for_webdriver.json.lock'):
+        try:
+            with open('config/cookies_for_webdriver.json', 'r') as f:
+                # 有内容则加载到cookies_dict中
+                cookies_dict = json.load(f)
+        # 没有内容或者文件不存在则令cookies_dict为空
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            cookies_dict = {}
+        logging.debug('加载cookies_for_webdriver.json中的内容')
+        # 写入当前项目的cookies_list
+        cookies_dict[project] = cookies_list
+        atomic_write_text('config/cookies_for_webdriver.json', json.dumps(cookies_dict, indent=4))
+        logging.debug('写入当前项目cookies_list到cookies_for_webdriver.json')
+
+
+def webdriver_login(project, driver, element_xpath_dict, username, password):
+    logging.info('开始Webdriver登录')
+    # 找到用户名、密码和登录按钮
+    try:
+        # 输入用户名和密码
+        username_input_box = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.XPATH, element_xpath_dict['Input_box']['login_username']))
+        )
+        username_input_box.send_keys(username)
+        password_input_box = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.XPATH, element_xpath_dict['Input_box']['login_password']))
+        )
+        password_input_box.send_keys(password)
+        logging.info('输入用户名和密码')
+        # 提交登录表单
+        login_button = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.XPATH, element_xpath_dict['button']['login_submit']))
+        )
+        login_button.click()
+        logging.info('点击登录')
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('当前Webdriver中的cookies:%s', driver.get_cookies())
+    except TimeoutException:
+        logging.info('10秒内未找到元素')
+        cookies_dict = []
+        return cookies_dict
+    login_settings = load_settings('login', LOGIN_DEFAULTS, project)
+    headless = get_browser_pool().pool_settings["headless"]
+    deadline = time.monotonic() + login_settings["verification_timeout"]
+    while time.monotonic() < deadline:
+        try:
+            # 通过检查SIM卡搜索框有没有出现来判断检查是否登录成功
+            WebDriverWait(driver, 30).until(
+                EC.title_contains('欢迎')
+                # EC.presence_of_element_located((By.XPATH, element_xpath_dict['Input_box']['search_sim']))
+            )
+            logging.info('登录成功')
+            cookies_list = driver.get_cookies()
+            # 删除所有的有效期字段
+            # for cookie in cookies_list:
+            #     if 'expiry' in cookie.keys():
+            #         del cookie['expiry']
+            save_webdriver_cookies(project, cookies_list)
+            # 浏览器由浏览器池管理，登录后保留以便下次复用
+            return cookies_list
+        except TimeoutException:
+            logging.info('10秒内未找到元素')
+            if driver.title == '身份验证':
+                if headless:
+                    raise LoginVerificationRequired(project)
+                logging.info('请输入邮箱验证码！')
+                continue
+            elif 'Welcome' in driver.title:
+                continue
+            else:
+                logging.debug('未知页面标题：%s', driver.title)
+                cookies_list = []
+                logging.error('读取页面数据的时候遇到未知错误')
+                return cookies_list
+    logging.error('%s项目%s秒内没有完成登录', project, login_settings["verification_timeout"])
+    return []
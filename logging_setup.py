@@ -0,0 +1,81 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+
+from settings import load_settings
+
+# 日志的默认配置，可在service_settings.json的logging段中修改
+LOGGING_DEFAULTS = {
+    "level": "INFO",
+    # 日志文件路径，为空则不写文件
+    "file": "app.log",
+    # 为true时启动时清空日志文件，否则追加
+    "truncate_file": False,
+    "console": True,
+    "format": "%(asctime)s - %(levelname)s - %(message)s",
+}
+
+# 每个请求一条结构化记录
+request_logger = logging.getLogger('jasper.request')
+
+
+class LazyJSON:
+    """
+    作为日志参数传入，只有日志真正输出时才序列化，
+    级别被关闭时不再为调试日志付出json.dumps的开销
+    """
+    __slots__ = ('value', 'indent')
+
+    def __init__(self, value, indent=4):
+        self.value = value
+        self.indent = indent
+
+    def __str__(self):
+        return json.dumps(self.value, indent=self.indent, ensure_ascii=False, default=str)
+
+
+_listener = None
+
+
+def configure_logging(**overrides):
+    """
+    由应用在启动时调用：根日志只挂一个QueueHandler，格式化后的记录交给后台线程写终端和文件，
+    请求线程不再阻塞在文件写入上；重复调用时只生效第一次
+    :param overrides: 覆盖logging配置段中的项，例如level='DEBUG'
+    """
+    global _listener
+    if _listener is not None:
+        return
+    logging_settings = load_settings('logging', LOGGING_DEFAULTS)
+    logging_settings.update(overrides)
+    formatter = logging.Formatter(logging_settings["format"])
+    handlers = []
+    if logging_settings["console"]:
+        handlers.append(logging.StreamHandler())  # 输出到终端
+    if logging_settings["file"]:
+        mode = 'w' if logging_settings["truncate_file"] else 'a'
+        handlers.append(logging.FileHandler(logging_settings["file"], encoding="utf-8", mode=mode))  # 输出到文件
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging_settings["level"])
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # 进程退出前把队列中剩余的日志写完
+    atexit.register(_listener.stop)
+
+
+def log_request(**fields):
+    """
+    输出一条结构化的请求记录（单行JSON），INFO级别关闭时不做序列化
+    :param fields: 记录的字段，例如path、project、status、duration_ms
+    """
+    if request_logger.isEnabledFor(logging.INFO):
+        request_logger.info('%s', LazyJSON(fields, indent=None))
@@ -0,0 +1,170 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from settings import load_settings
+
+# 指标的默认配置，可在service_settings.json的metrics段中修改
+METRICS_DEFAULTS = {
+    "enabled": True,
+    # 直方图的桶上限（秒）
+    "buckets": [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60],
+    # 为true时在响应中附带Server-Timing头，列出本次请求各阶段耗时
+    "server_timing": False,
+}
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    按标签分组的直方图，线程安全，按Prometheus文本格式输出
+    """
+    def __init__(self, name, documentation, label_names, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = sorted(float(bucket) for bucket in buckets)
+        self._lock = threading.Lock()
+        # 标签值元组 -> [各桶计数(不累计), 总和, 次数]
+        self._series = {}
+
+    def observe(self, label_values, value):
+        """
+        :param label_values: 与label_names一一对应的标签值元组
+        :param value: 观测值（秒）
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self._series[label_values] = series
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """
+        :return: Prometheus文本格式的行列表
+        """
+        with self._lock:
+            snapshot = [(label_values, list(series[0]), series[1], series[2])
+                        for label_values, series in self._series.items()]
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, bucket_counts, total, count in sorted(snapshot):
+            labels = ','.join(f'{label_name}="{_escape_label_value(label_value)}"'
+                              for label_name, label_value in zip(self.label_names, label_values))
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bucket:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    进程内的指标集合：查询各阶段耗时和HTTP接口耗时
+    """
+    def __init__(self, metrics_settings):
+        self.metrics_settings = metrics_settings
+        self.enabled = metrics_settings["enabled"]
+        self.stage_seconds = Histogram(
+            'jasper_stage_duration_seconds', 'SIM查询各阶段耗时',
+            ('project', 'stage', 'request', 'outcome'), metrics_settings["buckets"])
+        self.http_seconds = Histogram(
+            'jasper_http_request_duration_seconds', '接口处理耗时',
+            ('method', 'path', 'status'), metrics_settings["buckets"])
+
+    def render(self):
+        """
+        :return: Prometheus文本格式的全部指标
+        """
+        return '\n'.join(self.stage_seconds.render() + self.http_seconds.render()) + '\n'
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    获取进程共享的指标集合
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = MetricsRegistry(load_settings('metrics', METRICS_DEFAULTS))
+    return _registry
+
+
+# 当前线程正在处理的请求的阶段耗时，用于Server-Timing头，None表示未开启
+_request_timings = threading.local()
+
+
+def start_request_timing():
+    """
+    开始收集当前线程的阶段耗时，由接口在请求开始时调用
+    """
+    _request_timings.spans = []
+
+
+def pop_request_timings():
+    """
+    :return: 当前线程收集到的[(阶段, 请求名, 秒)]，并停止收集
+    """
+    spans = getattr(_request_timings, 'spans', None)
+    _request_timings.spans = None
+    return spans or []
+
+
+def format_server_timing(spans):
+    """
+    :param spans: pop_request_timings的返回值
+    :return: Server-Timing头的值
+    """
+    entries = []
+    for stage, request_name, seconds in spans:
+        entry = stage
+        if request_name:
+            entry += f';desc="{request_name}"'
+        entries.append(f'{entry};dur={seconds * 1000:.1f}')
+    return ', '.join(entries)
+
+
+@contextmanager
+def span(stage, project, request_name=''):
+    """
+    记录一个阶段的耗时，调用方可以在返回的字典中设置outcome，
+    默认为ok，抛出异常时为异常类名
+    :param stage: 阶段名，例如cookie_load、upstream、json_decode
+    :param project: 项目名
+    :param request_name: 请求名，参照http_request_parameter.json，没有时为空
+    :return: {"outcome": ...}
+    """
+    timing = {"outcome": "ok"}
+    registry = get_metrics()
+    if not registry.enabled:
+        yield timing
+        return
+    start = time.perf_counter()
+    try:
+        yield timing
+    except BaseException as e:
+        timing["outcome"] = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        registry.stage_seconds.observe((project or '', stage, request_name, timing["outcome"]), seconds)
+        spans = getattr(_request_timings, 'spans', None)
+        if spans is not None:
+            spans.append((stage, request_name, seconds))
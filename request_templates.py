@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import threading
+from urllib.parse import quote_plus, urlsplit, urlunsplit
+
+# http_request_parameter.json路径
+REQUEST_TEMPLATE_FILE_PATH = 'config/http_request_parameter.json'
+
+# 设置该环境变量时，模板中base_url的协议和主机替换为它，例如指向本地的Jasper桩服务
+BASE_URL_OVERRIDE_ENV = 'JASPER_BASE_URL'
+
+# 请求模板中允许出现的占位符，渲染请求时由调用方传入
+# 模板还可以在defaults中声明带默认值的占位符，例如分页用的page和limit
+KNOWN_PLACEHOLDERS = frozenset(['timestamp_now', 'search_value', 'search_values'])
+
+# 编译JSON参数时用于标记占位符位置的字符串，json.dumps后会被转义为\u0000
+_SLOT_MARKER = '\x00slot{}\x00'
+
+
+class TemplateError(ValueError):
+    """
+    请求模板配置错误，或者渲染时缺少参数
+    """
+
+
+def _placeholder_name(value):
+    """
+    :param value: 模板中的值
+    :return: 如果值是完整的占位符字符串'{name}'则返回name，否则返回None
+    """
+    if isinstance(value, str) and value.startswith('{') and value.endswith('}'):
+        return value.strip('{}')
+    return None
+
+
+class _JSONSlots:
+    """
+    编译后的JSON参数：在一次json.dumps的结果中记录占位符位置，渲染时只需拼接字符串
+    """
+    def __init__(self, value, check_placeholder):
+        slot_names = []
+
+        def mark(node):
+            if isinstance(node, dict):
+                return {key: mark(item) for key, item in node.items()}
+            if isinstance(node, list):
+                return [mark(item) for item in node]
+            name = _placeholder_name(node)
+            if name is None:
+                return node
+            check_placeholder(name)
+            slot_names.append(name)
+            return _SLOT_MARKER.format(len(slot_names) - 1)
+
+        text = json.dumps(mark(value))
+        # 按占位符切分为固定片段，片段数比占位符数多一个
+        self.literals = []
+        for index, name in enumerate(slot_names):
+            marker = json.dumps(_SLOT_MARKER.format(index))
+            literal, text = text.split(marker, 1)
+            self.literals.append(literal)
+        self.literals.append(text)
+        self.slot_names = slot_names
+
+    def render(self, params):
+        parts = [self.literals[0]]
+        for name, literal in zip(self.slot_names, self.literals[1:]):
+            parts.append(json.dumps(params[name]))
+            parts.append(literal)
+        return ''.join(parts)
+
+
+class RequestTemplate:
+    """
+    编译后的单个请求模板，渲染时不做文件读取，也不修改模板本身
+    """
+    def __init__(self, request_name, request_info, known_placeholders=KNOWN_PLACEHOLDERS, base_url_override=None):
+        self.request_name = request_name
+        # 模板声明的占位符默认值，渲染时可被调用方传入的参数覆盖
+        self.defaults = request_info.get('defaults', {})
+        self.known_placeholders = known_placeholders | frozenset(self.defaults)
+        self.base_url = request_info['base_url']
+        if base_url_override:
+            override = urlsplit(base_url_override)
+            self.base_url = urlunsplit(urlsplit(self.base_url)._replace(scheme=override.scheme, netloc=override.netloc))
+        # 查询字符串的编译结果，元素为(类型, 编码后的key, 内容)
+        self._query_parts = []
+        for key, value in request_info.get('request_args', {}).items():
+            encoded_key = quote_plus(key)
+            name = _placeholder_name(value)
+            if name is not None:
+                self._check_placeholder(name)
+                self._query_parts.append(('slot', encoded_key, name))
+            elif isinstance(value, (dict, list)):
+                # 嵌套参数（例如search）以JSON字符串传给Jasper
+                self._query_parts.append(('json', encoded_key, _JSONSlots(value, self._check_placeholder)))
+            else:
+                self._query_parts.append(('static', encoded_key, encoded_key + '=' + quote_plus(str(value))))
+        # 请求头中不含占位符的部分直接复用，含占位符的部分记录下来
+        self._static_headers = {}
+        self._header_slots = []
+        for key, value in request_info.get('headers', {}).items():
+            name = _placeholder_name(value)
+            if name is None:
+                self._static_headers[key] = value
+            else:
+                self._check_placeholder(name)
+                self._header_slots.append((key, name))
+
+    def _check_placeholder(self, name):
+        if name not in self.known_placeholders:
+            raise TemplateError(f'请求模板{self.request_name}中存在未知占位符：{{{name}}}')
+
+    def render(self, params):
+        """
+        将参数代入编译后的模板
+        :param params: 占位符参数字典
+        :return: (完整的请求url, 请求头字典)
+        """
+        if self.defaults:
+            params = {**self.defaults, **params}
+        try:
+            query = []
+            for part_type, encoded_key, content in self._query_parts:
+                if part_type == 'static':
+                    query.append(content)
+                elif part_type == 'slot':
+                    query.append(encoded_key + '=' + quote_plus(str(params[content])))
+                else:
+                    query.append(encoded_key + '=' + quote_plus(content.render(params)))
+            headers = dict(self._static_headers)
+            for key, name in self._header_slots:
+                headers[key] = params[name]
+        except KeyError as e:
+            raise TemplateError(f'渲染请求模板{self.request_name}时缺少参数：{e}') from None
+        return self.base_url + '?' + '&'.join(query), headers
+
+
+def load_request_templates(file_path=REQUEST_TEMPLATE_FILE_PATH, base_url_override=None):
+    """
+    读取并编译配置文件中的全部请求模板
+    :param file_path: 请求模板配置文件路径
+    :param base_url_override: 替换base_url协议和主机的地址，默认读取JASPER_BASE_URL环境变量
+    :return: {请求名: RequestTemplate}
+    """
+    if base_url_override is None:
+        base_url_override = os.environ.get(BASE_URL_OVERRIDE_ENV)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        request_info_dict = json.load(f)
+    templates = {
+        request_name: RequestTemplate(request_name, request_info, base_url_override=base_url_override)
+        for request_name, request_info in request_info_dict.items()
+    }
+    logging.info('已编译请求模板：%s', list(templates))
+    return templates
+
+
+_templates = None
+_templates_lock = threading.Lock()
+
+
+def get_request_templates():
+    """
+    获取进程共享的请求模板，首次调用时加载并编译
+    :return: {请求名: RequestTemplate}
+    """
+    global _templates
+    if _templates is None:
+        with _templates_lock:
+            if _templates is None:
+                _templates = load_request_templates()
+    return _templates
@@ -0,0 +1,121 @@
+import gzip
+import hashlib
+import json
+import logging
+import threading
+
+from settings import load_settings
+
+try:
+    import orjson
+except ImportError:  # 没有orjson时使用标准库json，输出内容相同，只是更慢
+    orjson = None
+
+# 接口响应编码的默认配置，可在service_settings.json的response_encoding段中修改
+RESPONSE_ENCODING_DEFAULTS = {
+    # 为/JasperGetter/SIMData返回ETag，并对匹配的If-None-Match返回304
+    "etag": True,
+    # 客户端支持时压缩超过gzip_min_bytes的响应
+    "gzip": True,
+    "gzip_min_bytes": 2048,
+    "gzip_level": 5,
+    # 安装了orjson时用它序列化响应
+    "fast_json": True,
+}
+
+
+def _canonical_json(value):
+    # 键排序后的紧凑JSON，同样的内容总是得到同样的字节
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def sim_data_etag(sim_data):
+    """
+    计算规范化后sim_data的内容哈希，内容不变时各进程、各次请求得到的值都相同
+    :param sim_data: get_sim_data返回的结果
+    :return: 32位十六进制字符串，不含引号
+    """
+    return hashlib.blake2b(_canonical_json(sim_data), digest_size=16).hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    """
+    按弱比较判断If-None-Match是否包含etag，供不经过werkzeug的ASGI入口使用
+    :param if_none_match: If-None-Match请求头，可以为None
+    :param etag: 不含引号的内容哈希
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
+
+
+def accepts_gzip(accept_encoding):
+    """
+    :param accept_encoding: Accept-Encoding请求头，可以为None
+    :return: 客户端是否接受gzip（q=0表示拒绝）
+    """
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.partition(';')
+        if coding.strip().lower() in ('gzip', '*'):
+            quality = params.strip()
+            if not quality.startswith('q='):
+                return True
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
+class ResponseEncoder:
+    """
+    把响应序列化为UTF-8 JSON字节，并按配置和客户端的Accept-Encoding压缩
+    """
+    def __init__(self, encoding_settings):
+        self.encoding_settings = encoding_settings
+        self.use_orjson = bool(encoding_settings["fast_json"]) and orjson is not None
+
+    def dumps(self, value):
+        """
+        :param value: 可以JSON序列化的对象
+        :return: UTF-8编码的紧凑JSON字节，非ASCII字符不转义
+        """
+        if self.use_orjson:
+            return orjson.dumps(value)
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def compress(self, body, accepts_gzip):
+        """
+        :param body: 响应体字节
+        :param accepts_gzip: 客户端是否接受gzip
+        :return: (响应体字节, Content-Encoding)，未压缩时Content-Encoding为None
+        """
+        if not (accepts_gzip and self.encoding_settings["gzip"]) or len(body) < self.encoding_settings["gzip_min_bytes"]:
+            return body, None
+        return gzip.compress(body, compresslevel=self.encoding_settings["gzip_level"], mtime=0), 'gzip'
+
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_response_encoder():
+    """
+    获取进程共享的响应编码器
+    """
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = ResponseEncoder(load_settings('response_encoding', RESPONSE_ENCODING_DEFAULTS))
+            logging.info('响应编码配置：%s，使用orjson：%s', _encoder.encoding_settings, _encoder.use_orjson)
+        return _encoder
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from response_encoding import sim_data_etag
+from settings import load_settings
+
+# 结果缓存的默认配置，可在service_settings.json的result_cache段中修改
+RESULT_CACHE_DEFAULTS = {
+    "enabled": True,
+    "max_entries": 10000,
+    # 基础信息过期时整条缓存失效，change_history_ttl必须小于basic_data_ttl，
+    # 否则变更历史的有效期不起作用，也不会出现只重新获取变更历史的部分命中
+    "basic_data_ttl": 600,
+    "change_history_ttl": 300,
+    # 为true时，过期不超过stale_ttl秒的结果直接返回，同时在后台重新获取
+    "stale_while_revalidate": False,
+    "stale_ttl": 3600,
+    # 后台重新获取的线程数
+    "revalidate_workers": 2,
+}
+
+
+class CachedSIMData:
+    """
+    缓存查询结果，basic_fresh/history_fresh分别表示基础信息和变更历史是否仍在有效期内，
+    etag为写入缓存时计算的内容哈希，stale表示已过期但仍在陈旧期内、可以先返回再后台更新
+    """
+    __slots__ = ('sim_data', 'basic_fresh', 'history_fresh', 'etag', 'stale')
+
+    def __init__(self, sim_data, basic_fresh, history_fresh, etag, stale=False):
+        self.sim_data = sim_data
+        self.basic_fresh = basic_fresh
+        self.history_fresh = history_fresh
+        self.etag = etag
+        self.stale = stale
+
+
+class _Entry:
+    __slots__ = ('sim_data', 'basic_expires_at', 'history_expires_at', 'stale_until', 'aliases', 'etag')
+
+    def __init__(self, sim_data, basic_expires_at, history_expires_at, stale_until, aliases, etag):
+        self.sim_data = sim_data
+        self.basic_expires_at = basic_expires_at
+        self.history_expires_at = history_expires_at
+        self.stale_until = stale_until
+        self.aliases = aliases
+        self.etag = etag
+
+
+class SIMResultCache:
+    """
+    进程内的LRU+TTL缓存，保存get_sim_data规范化后的sim_data
+    每张卡以(project, sim_id)为主键保存一份，查询值、sim_id、iccid和bound_vin都作为索引指向它，
+    所以用VIN查过的卡之后用ICCID查询也能命中
+    stale_ttl大于0时，基础信息或变更历史过期后的stale_ttl秒内条目仍然保留，可以作为陈旧结果返回
+    """
+    def __init__(self, max_entries, basic_data_ttl, change_history_ttl, stale_ttl=0):
+        self.max_entries = max_entries
+        self.basic_data_ttl = basic_data_ttl
+        self.change_history_ttl = change_history_ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        # (project, sim_id) -> _Entry，按最近使用排序
+        self._entries = OrderedDict()
+        # (project, 标识值) -> (project, sim_id)
+        self._index = {}
+        self._counters = {"hits": 0, "partial_hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0,
+                          "expirations": 0}
+
+    @staticmethod
+    def _identifiers(sim_data):
+        sim_basic_data = sim_data["sim_basic_data"]
+        return [str(sim_basic_data[field]) for field in ("sim_id", "iccid", "bound_vin") if sim_basic_data.get(field)]
+
+    def _remove(self, primary_key):
+        # 调用方需持有锁
+        entry = self._entries.pop(primary_key)
+        for alias in entry.aliases:
+            if self._index.get(alias) == primary_key:
+                del self._index[alias]
+
+    def get(self, project, search_value, allow_stale=False):
+        """
+        :param project: 项目名
+        :param search_value: 查询值，ICCID、VIN或者simId
+        :param allow_stale: 为True时，已过期但仍在陈旧期内的条目以stale=True返回
+        :return: CachedSIMData，没有缓存或基础信息已过期（且不接受陈旧结果）时返回None
+        """
+        now = time.monotonic()
+        with self._lock:
+            primary_key = self._index.get((project, str(search_value)))
+            if primary_key is None:
+                self._counters["misses"] += 1
+                return None
+            entry = self._entries[primary_key]
+            basic_fresh = entry.basic_expires_at > now
+            history_fresh = entry.history_expires_at > now
+            if not basic_fresh and entry.stale_until <= now:
+                self._remove(primary_key)
+                self._counters["expirations"] += 1
+                self._counters["misses"] += 1
+                return None
+            if basic_fresh and history_fresh:
+                self._counters["hits"] += 1
+                cached = CachedSIMData(entry.sim_data, True, True, entry.etag)
+            elif allow_stale and entry.stale_until > now:
+                self._counters["stale_hits"] += 1
+                cached = CachedSIMData(entry.sim_data, basic_fresh, history_fresh, entry.etag, stale=True)
+            elif basic_fresh:
+                self._counters["partial_hits"] += 1
+                cached = CachedSIMData(entry.sim_data, True, False, entry.etag)
+            else:
+                # 基础信息已过期，条目留给陈旧期内的其他调用方
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(primary_key)
+            return cached
+
+    def contains(self, project, search_value):
+        """
+        判断是否有完整有效的缓存，不计入命中统计，也不改变LRU顺序
+        """
+        now = time.monotonic()
+        with self._lock:
+            primary_key = self._index.get((project, str(search_value)))
+            if primary_key is None:
+                return False
+            entry = self._entries[primary_key]
+            return entry.basic_expires_at > now and entry.history_expires_at > now
+
+    def put(self, project, search_value, sim_data, basic_refreshed=True):
+        """
+        写入一张卡的完整查询结果
+        :param project: 项目名
+        :param search_value: 本次查询值
+        :param sim_data: get_sim_data返回的成功结果
+        :param basic_refreshed: 基础信息是否为本次重新获取，只刷新变更历史时沿用原来的基础信息有效期
+        :return: sim_data的内容哈希，每次命中缓存时不必重新计算
+        """
+        # 在锁外计算哈希，同一份sim_data只计算一次
+        etag = sim_data_etag(sim_data)
+        now = time.monotonic()
+        sim_id = str(sim_data["sim_basic_data"]["sim_id"])
+        primary_key = (project, sim_id)
+        aliases = {(project, identifier) for identifier in self._identifiers(sim_data)}
+        aliases.add((project, str(search_value)))
+        basic_expires_at = now + self.basic_data_ttl
+        history_expires_at = now + self.change_history_ttl
+        with self._lock:
+            if primary_key in self._entries:
+                if not basic_refreshed:
+                    basic_expires_at = self._entries[primary_key].basic_expires_at
+                self._remove(primary_key)
+            self._entries[primary_key] = _Entry(
+                sim_data,
+                basic_expires_at,
+                history_expires_at,
+                min(basic_expires_at, history_expires_at) + self.stale_ttl,
+                aliases,
+                etag,
+            )
+            for alias in aliases:
+                self._index[alias] = primary_key
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._counters["evictions"] += 1
+        return etag
+
+    def invalidate(self, project, search_value):
+        """
+        删除某张卡的缓存
+        """
+        with self._lock:
+            primary_key = self._index.get((project, str(search_value)))
+            if primary_key is not None:
+                self._remove(primary_key)
+
+    def stats(self):
+        """
+        :return: 命中、未命中、淘汰等计数以及当前条目数
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+            return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_sim_result_cache():
+    """
+    获取进程共享的结果缓存，未启用时返回None
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            cache_settings = load_settings('result_cache', RESULT_CACHE_DEFAULTS)
+            if not cache_settings["enabled"]:
+                return None
+            _cache = SIMResultCache(
+                cache_settings["max_entries"],
+                cache_settings["basic_data_ttl"],
+                cache_settings["change_history_ttl"],
+                cache_settings["stale_ttl"] if cache_settings["stale_while_revalidate"] else 0,
+            )
+            if cache_settings["change_history_ttl"] >= cache_settings["basic_data_ttl"]:
+                logging.warning('result_cache的change_history_ttl不小于basic_data_ttl，变更历史的有效期不会生效')
+            logging.info('已创建SIM结果缓存：%s', cache_settings)
+        return _cache
@@ -0,0 +1,39 @@
+import json
+import logging
+import threading
+
+# 服务运行参数配置文件路径，按功能分段
+SETTINGS_FILE_PATH = 'config/service_settings.json'
+
+_settings_cache = None
+_settings_lock = threading.Lock()
+
+
+def _load_all_settings():
+    global _settings_cache
+    with _settings_lock:
+        if _settings_cache is None:
+            try:
+                with open(SETTINGS_FILE_PATH, 'r', encoding='utf-8') as f:
+                    _settings_cache = json.load(f)
+            except FileNotFoundError:
+                logging.info('服务配置文件不存在，使用默认配置')
+                _settings_cache = {}
+        return _settings_cache
+
+
+def load_settings(section, defaults=None, project=None):
+    """
+    读取服务配置中的某一段，未配置的项使用默认值
+    配置段内可以有"projects"字段，按项目覆盖对应的配置
+    :param section: 配置段名，例如'http_client'
+    :param defaults: 默认配置字典
+    :param project: 项目名，传入时合并该项目的覆盖配置
+    :return: 合并后的配置字典
+    """
+    section_settings = _load_all_settings().get(section, {})
+    merged = dict(defaults or {})
+    merged.update({key: value for key, value in section_settings.items() if key != 'projects'})
+    if project is not None:
+        merged.update(section_settings.get('projects', {}).get(project, {}))
+    return merged
@@ -0,0 +1,123 @@
+from time_format import format_epoch_ms_batch
+
+AUTH_REQUIRED_MESSAGE = 'Full authentication is required to access this resource'
+
+
+class ChangeHistoryError(Exception):
+    """
+    变更历史请求失败，error_message与其他接口的取值一致：upstream_error、cookies_need_update、unknown_error
+    """
+    def __init__(self, error_message):
+        super().__init__(error_message)
+        self.error_message = error_message
+
+
+class SIMChangeRecord:
+    """
+    一条SIM卡变更记录，只保留用到的字段，时间均为毫秒级时间戳
+    """
+    __slots__ = ('change_type', 'source_value', 'target_value', 'start_time', 'end_time', 'user_name',
+                 'sim_change_id', 'date_modified')
+
+    def __init__(self, change_type, source_value, target_value, start_time, end_time, user_name,
+                 sim_change_id=None, date_modified=None):
+        self.change_type = change_type
+        self.source_value = source_value
+        self.target_value = target_value
+        self.start_time = start_time
+        self.end_time = end_time
+        self.user_name = user_name
+        self.sim_change_id = sim_change_id
+        self.date_modified = date_modified
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        :param row: /provision/api/v1/simChanges返回的data中的一条
+        """
+        return cls(
+            row["changeTypeDisplay"],
+            row["sourceValue"],
+            row["targetValue"],
+            row["startTime"],
+            row["endTime"],
+            row["userName"],
+            row.get("simChangeId"),
+            row.get("dateModified"),
+        )
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        if not isinstance(other, SIMChangeRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f'SIMChangeRecord({self.change_type!r}, {self.source_value!r} -> {self.target_value!r}, ' \
+               f'start_time={self.start_time!r}, sim_change_id={self.sim_change_id!r})'
+
+
+def parse_change_history_page(response):
+    """
+    解析一页sim_change_history的响应，同步和异步客户端共用
+    :param response: 响应字典
+    :return: (本页的SIMChangeRecord列表, 总条数)
+    :raise ChangeHistoryError: 响应不是成功的变更历史
+    """
+    if not response.get("success"):
+        if response.get("errorMessage") == AUTH_REQUIRED_MESSAGE:
+            raise ChangeHistoryError("cookies_need_update")
+        raise ChangeHistoryError("unknown_error")
+    rows = response["data"] or []
+    records = [SIMChangeRecord.from_row(row) for row in rows]
+    # 没有totalCount时按只有一页处理
+    return records, response.get("totalCount", len(records))
+
+
+def filter_change_records(records, change_types=None, start_after=None, start_before=None):
+    """
+    按变更类型和开始时间窗口过滤，返回生成器
+    :param records: SIMChangeRecord的可迭代对象
+    :param change_types: 需要的changeTypeDisplay集合，None表示全部
+    :param start_after: 只保留开始时间不早于该毫秒时间戳的记录
+    :param start_before: 只保留开始时间早于该毫秒时间戳的记录
+    """
+    if change_types is not None:
+        change_types = frozenset(change_types)
+    for record in records:
+        if change_types is not None and record.change_type not in change_types:
+            continue
+        if start_after is not None and record.start_time < start_after:
+            continue
+        if start_before is not None and record.start_time >= start_before:
+            continue
+        yield record
+
+
+def collapse_change_history(records):
+    """
+    把变更记录整理成按变更类型索引的字典，即get_sim_data返回的sim_change_history
+    与原先的逻辑一致：按响应顺序遍历，同一类型后出现的记录覆盖先出现的
+    :param records: SIMChangeRecord的可迭代对象
+    :return: {changeTypeDisplay: {...}}
+    """
+    # 先选出每种类型最终保留的记录，只对这些记录做时间格式化
+    latest_by_type = {}
+    for record in records:
+        latest_by_type[record.change_type] = record
+    kept = list(latest_by_type.values())
+    formatted_times = format_epoch_ms_batch([record.start_time for record in kept] +
+                                            [record.end_time for record in kept])
+    count = len(kept)
+    return {
+        record.change_type: {
+            "target_value": record.target_value,
+            "source_value": record.source_value,
+            "start_time": formatted_times[index],
+            "end_time": formatted_times[count + index],
+            "change_by": record.user_name,
+        }
+        for index, record in enumerate(kept)
+    }
@@ -0,0 +1,287 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from settings import load_settings
+from sim_history import SIMChangeRecord, collapse_change_history
+
+# 本地SIM卡存储的默认配置，可在service_settings.json的sim_store段中修改
+SIM_STORE_DEFAULTS = {
+    "enabled": True,
+    "path": "data/sim_store.db",
+    # 按IMEI、VIN片段搜索时单次最多返回的条数
+    "search_limit": 100,
+}
+
+SIM_BASIC_DATA_FIELDS = ("sim_id", "iccid", "imei", "bound_vin", "brand", "lifecycle", "session_type_now",
+                         "device_type", "activation_datetime")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sims (
+    project TEXT NOT NULL,
+    sim_id INTEGER NOT NULL,
+    iccid TEXT,
+    imei TEXT,
+    bound_vin TEXT,
+    -- 倒序的VIN，用于按VIN后几位查询时也能走索引
+    bound_vin_reversed TEXT,
+    brand TEXT,
+    lifecycle TEXT,
+    session_type_now TEXT,
+    device_type TEXT,
+    activation_datetime TEXT,
+    -- 基础信息和变更历史最近一次从Jasper取得的时间（秒级时间戳）
+    basic_updated_at REAL NOT NULL,
+    history_updated_at REAL,
+    PRIMARY KEY (project, sim_id)
+);
+CREATE INDEX IF NOT EXISTS sims_iccid ON sims (project, iccid);
+CREATE INDEX IF NOT EXISTS sims_imei ON sims (project, imei);
+CREATE INDEX IF NOT EXISTS sims_bound_vin ON sims (project, bound_vin);
+CREATE INDEX IF NOT EXISTS sims_bound_vin_reversed ON sims (project, bound_vin_reversed);
+CREATE TABLE IF NOT EXISTS sim_changes (
+    project TEXT NOT NULL,
+    sim_id INTEGER NOT NULL,
+    sim_change_id INTEGER NOT NULL,
+    change_type TEXT,
+    source_value TEXT,
+    target_value TEXT,
+    start_time INTEGER,
+    end_time INTEGER,
+    user_name TEXT,
+    date_modified INTEGER,
+    PRIMARY KEY (project, sim_id, sim_change_id)
+);
+CREATE INDEX IF NOT EXISTS sim_changes_date_modified ON sim_changes (project, sim_id, date_modified);
+"""
+
+
+def _prefix_upper_bound(prefix):
+    # 以prefix开头的字符串都小于该值，配合>=prefix做范围查询，可以使用索引
+    return prefix + '\U0010ffff'
+
+
+class SIMStore:
+    """
+    SQLite中的SIM卡基础信息和变更历史，由get_sim_data的结果和批量同步写入，重启后仍然可用
+    每个线程一个连接，WAL模式下读写互不阻塞，写入在进程内串行
+    """
+    def __init__(self, path, search_limit=100):
+        self.path = path
+        self.search_limit = search_limit
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._write_lock:
+            connection = self._connection()
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SCHEMA)
+            connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _sim_row(project, sim_basic_data, now):
+        bound_vin = sim_basic_data.get("bound_vin")
+        return (
+            project,
+            sim_basic_data["sim_id"],
+            sim_basic_data.get("iccid"),
+            sim_basic_data.get("imei"),
+            bound_vin,
+            bound_vin[::-1] if bound_vin else None,
+            sim_basic_data.get("brand"),
+            sim_basic_data.get("lifecycle"),
+            sim_basic_data.get("session_type_now"),
+            sim_basic_data.get("device_type"),
+            sim_basic_data.get("activation_datetime"),
+            now,
+        )
+
+    def save_basic_data(self, project, sim_basic_data_list):
+        """
+        写入或更新一批基础信息，已有的变更历史保持不变
+        :param project: 项目名
+        :param sim_basic_data_list: sim_basic_data字典的可迭代对象
+        """
+        now = time.time()
+        rows = [self._sim_row(project, sim_basic_data, now) for sim_basic_data in sim_basic_data_list]
+        if not rows:
+            return
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                connection.executemany("""
+                    INSERT INTO sims (project, sim_id, iccid, imei, bound_vin, bound_vin_reversed, brand, lifecycle,
+                                      session_type_now, device_type, activation_datetime, basic_updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (project, sim_id) DO UPDATE SET
+                        iccid = excluded.iccid, imei = excluded.imei, bound_vin = excluded.bound_vin,
+                        bound_vin_reversed = excluded.bound_vin_reversed, brand = excluded.brand,
+                        lifecycle = excluded.lifecycle, session_type_now = excluded.session_type_now,
+                        device_type = excluded.device_type, activation_datetime = excluded.activation_datetime,
+                        basic_updated_at = excluded.basic_updated_at
+                """, rows)
+
+    def save_sim(self, project, sim_basic_data, change_records):
+        """
+        写入一张卡的基础信息和全部变更历史，原有的变更历史被替换
+        :param project: 项目名
+        :param sim_basic_data: sim_basic_data字典
+        :param change_records: SIMChangeRecord列表
+        """
+        now = time.time()
+        sim_id = sim_basic_data["sim_id"]
+        change_rows = [
+            (project, sim_id, record.sim_change_id, record.change_type, record.source_value, record.target_value,
+             record.start_time, record.end_time, record.user_name, record.date_modified)
+            for record in change_records if record.sim_change_id is not None
+        ]
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                connection.execute("""
+                    INSERT OR REPLACE INTO sims (project, sim_id, iccid, imei, bound_vin, bound_vin_reversed, brand,
+                                                 lifecycle, session_type_now, device_type, activation_datetime,
+                                                 basic_updated_at, history_updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, self._sim_row(project, sim_basic_data, now) + (now,))
+                connection.execute('DELETE FROM sim_changes WHERE project = ? AND sim_id = ?', (project, sim_id))
+                connection.executemany("""
+                    INSERT INTO sim_changes (project, sim_id, sim_change_id, change_type, source_value, target_value,
+                                             start_time, end_time, user_name, date_modified)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, change_rows)
+
+    @staticmethod
+    def _basic_data(row):
+        return {field: row[field] for field in SIM_BASIC_DATA_FIELDS}
+
+    def find(self, project, search_value):
+        """
+        按sim_id、ICCID、VIN或IMEI精确查找
+        :return: sqlite3.Row，找不到或者对应多张卡时返回None
+        """
+        connection = self._connection()
+        search_value = str(search_value)
+        # sim_id是有符号64位整数，20位的ICCID超出SQLite INTEGER的范围，不能按sim_id绑定
+        sim_id = int(search_value) if search_value.isdigit() and len(search_value) <= 18 else None
+        rows = connection.execute("""
+            SELECT * FROM sims WHERE project = ? AND iccid = ?
+            UNION SELECT * FROM sims WHERE project = ? AND bound_vin = ?
+            UNION SELECT * FROM sims WHERE project = ? AND imei = ?
+            UNION SELECT * FROM sims WHERE project = ? AND sim_id = ?
+            LIMIT 2
+        """, (project, search_value, project, search_value, project, search_value,
+              project, sim_id)).fetchall()
+        return rows[0] if len(rows) == 1 else None
+
+    def change_records(self, project, sim_id):
+        """
+        :return: 保存的变更历史，按dateModified倒序，与Jasper的返回顺序一致
+        """
+        rows = self._connection().execute("""
+            SELECT * FROM sim_changes WHERE project = ? AND sim_id = ?
+            ORDER BY date_modified DESC, sim_change_id DESC
+        """, (project, sim_id)).fetchall()
+        return [
+            SIMChangeRecord(row["change_type"], row["source_value"], row["target_value"], row["start_time"],
+                            row["end_time"], row["user_name"], row["sim_change_id"], row["date_modified"])
+            for row in rows
+        ]
+
+    def get_sim_data(self, project, search_value, max_age):
+        """
+        从本地存储回答查询，基础信息和变更历史都必须在max_age秒内从Jasper取得过
+        :param project: 项目名
+        :param search_value: sim_id、ICCID、VIN或IMEI
+        :param max_age: 可以接受的最大数据年龄（秒）
+        :return: 与get_sim_data相同格式的sim_data，没有足够新的数据时返回None
+        """
+        row = self.find(project, search_value)
+        if row is None or row["history_updated_at"] is None:
+            return None
+        oldest_allowed = time.time() - max_age
+        if row["basic_updated_at"] < oldest_allowed or row["history_updated_at"] < oldest_allowed:
+            return None
+        return {
+            "success": True,
+            "sim_basic_data": self._basic_data(row),
+            "sim_change_history": collapse_change_history(self.change_records(project, row["sim_id"])),
+        }
+
+    def get_sim_basic_data(self, project, search_value, max_age):
+        """
+        从本地存储取基础信息，基础信息必须在max_age秒内从Jasper取得过，不要求有变更历史
+        :return: sim_basic_data字典，没有足够新的数据时返回None
+        """
+        row = self.find(project, search_value)
+        if row is None or row["basic_updated_at"] < time.time() - max_age:
+            return None
+        return self._basic_data(row)
+
+    def search(self, project, imei=None, vin=None, vin_match='contains', limit=None):
+        """
+        按IMEI或者VIN片段搜索本地存储
+        :param project: 项目名
+        :param imei: IMEI，精确匹配
+        :param vin: VIN片段
+        :param vin_match: prefix、suffix或contains；前两者走索引，contains需要扫描该项目的全部卡
+        :param limit: 最多返回的条数，默认使用search_limit配置
+        :return: [{"sim_basic_data": {...}, "basic_updated_at": 秒级时间戳}]
+        """
+        limit = limit or self.search_limit
+        if imei:
+            sql, params = 'SELECT * FROM sims WHERE project = ? AND imei = ?', [project, imei]
+        elif vin and vin_match == 'prefix':
+            sql = 'SELECT * FROM sims WHERE project = ? AND bound_vin >= ? AND bound_vin < ?'
+            params = [project, vin, _prefix_upper_bound(vin)]
+        elif vin and vin_match == 'suffix':
+            reversed_vin = vin[::-1]
+            sql = 'SELECT * FROM sims WHERE project = ? AND bound_vin_reversed >= ? AND bound_vin_reversed < ?'
+            params = [project, reversed_vin, _prefix_upper_bound(reversed_vin)]
+        elif vin and vin_match == 'contains':
+            sql, params = 'SELECT * FROM sims WHERE project = ? AND instr(bound_vin, ?) > 0', [project, vin]
+        else:
+            raise ValueError(f'不支持的搜索条件：imei={imei!r}, vin={vin!r}, vin_match={vin_match!r}')
+        rows = self._connection().execute(sql + ' ORDER BY bound_vin LIMIT ?', params + [limit]).fetchall()
+        return [{"sim_basic_data": self._basic_data(row), "basic_updated_at": row["basic_updated_at"]}
+                for row in rows]
+
+    def stats(self):
+        connection = self._connection()
+        return {
+            "sims": connection.execute('SELECT count(*) FROM sims').fetchone()[0],
+            "sims_with_history": connection.execute(
+                'SELECT count(*) FROM sims WHERE history_updated_at IS NOT NULL').fetchone()[0],
+            "sim_changes": connection.execute('SELECT count(*) FROM sim_changes').fetchone()[0],
+        }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_sim_store():
+    """
+    获取进程共享的本地SIM卡存储，未启用时返回None
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            store_settings = load_settings('sim_store', SIM_STORE_DEFAULTS)
+            if not store_settings["enabled"]:
+                return None
+            _store = SIMStore(store_settings["path"], store_settings["search_limit"])
+            logging.info('已打开本地SIM卡存储：%s', store_settings)
+        return _store
@@ -0,0 +1,77 @@
+import threading
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'exception', 'waiters')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+        # 等待并复用本次结果的调用方数量
+        self.waiters = 0
+
+
+class SingleFlightTimeout(TimeoutError):
+    """
+    等待第一个调用方的结果超时，第一个调用方仍在执行
+    """
+
+
+class SingleFlight:
+    """
+    合并同一个key的并发调用：第一个调用方执行函数，其余调用方等待并复用它的结果或异常
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # 实际执行的次数和复用结果的次数
+        self._executions = 0
+        self._shared = 0
+
+    def do(self, key, func, timeout=None):
+        """
+        :param key: 合并的键，例如项目名
+        :param func: 无参函数，只由第一个调用方执行
+        :param timeout: 其余调用方最长等待的秒数，None表示一直等待
+        :return: func的返回值
+        :raise SingleFlightTimeout: 等待超时
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._executions += 1
+            else:
+                call.waiters += 1
+                self._shared += 1
+        if not leader:
+            if not call.event.wait(timeout):
+                raise SingleFlightTimeout(f'等待{key!r}的结果超过{timeout}秒')
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def stats(self):
+        """
+        :return: 当前在途的key及各自的等待数、累计执行次数和复用次数；
+                 (executions + shared) / executions即合并比例
+        """
+        with self._lock:
+            return {
+                "in_flight": {key: call.waiters for key, call in self._calls.items()},
+                "executions": self._executions,
+                "shared": self._shared,
+            }
@@ -1,5 +1,9 @@
-from SIMDetailsGetter import *
+from SIMDetailsGetter import SIMInfoGetter
+from logging_setup import configure_logging
 from datetime import datetime
+import json
+
+configure_logging(level='DEBUG')
 
 print(datetime.now())
 sim_info_getter_GP = SIMInfoGetter('GP','LSVXBABDXR2023167')
@@ -0,0 +1,35 @@
+import threading
+
+import SIMDetailsGetter
+from SIMDetailsGetter import lookup_stats
+
+
+def _hold_in_flight(key, release):
+    started = threading.Event()
+
+    def func():
+        started.set()
+        release.wait(5)
+        return None
+
+    thread = threading.Thread(target=SIMDetailsGetter._lookup_flight.do, args=(key, func))
+    thread.start()
+    started.wait(5)
+    return thread
+
+
+def test_lookup_stats_reports_section_for_partial_lookups():
+    release = threading.Event()
+    threads = [
+        _hold_in_flight(("GP", "LSVSTATS000000001"), release),
+        _hold_in_flight(("GP", "LSVSTATS000000002", "basic"), release),
+        _hold_in_flight(("GP", "10000000001", "history"), release),
+    ]
+    try:
+        in_flight = {(item["search_value"], item["section"]) for item in lookup_stats()["in_flight"]}
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join(5)
+    assert {("LSVSTATS000000001", "full"), ("LSVSTATS000000002", "basic"),
+            ("10000000001", "history")} <= in_flight
@@ -0,0 +1,18 @@
+import result_cache
+from result_cache import RESULT_CACHE_DEFAULTS, SIMResultCache
+
+
+def test_default_ttls_give_partial_hits_after_history_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache.time, 'monotonic', lambda: now[0])
+    cache = SIMResultCache(10, RESULT_CACHE_DEFAULTS["basic_data_ttl"], RESULT_CACHE_DEFAULTS["change_history_ttl"])
+    sim_data = {"success": True, "sim_basic_data": {"sim_id": 10040443715, "iccid": "89860012345678901234",
+                                                    "bound_vin": "LSVCACHE000000001"}, "sim_change_history": {}}
+    cache.put("GP", "LSVCACHE000000001", sim_data)
+
+    now[0] += RESULT_CACHE_DEFAULTS["change_history_ttl"] + 1
+    cached = cache.get("GP", "89860012345678901234")
+    assert cached.basic_fresh and not cached.history_fresh
+
+    now[0] = 1000.0 + RESULT_CACHE_DEFAULTS["basic_data_ttl"] + 1
+    assert cache.get("GP", "LSVCACHE000000001") is None
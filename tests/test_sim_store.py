@@ -0,0 +1,17 @@
+from sim_store import SIMStore
+
+
+def _sim_basic_data(sim_id, iccid):
+    return {"sim_id": sim_id, "iccid": iccid, "imei": "860000000000001", "bound_vin": "LSVSTORE000000001",
+            "brand": "GP", "lifecycle": "Activated", "session_type_now": None, "device_type": None,
+            "activation_datetime": None}
+
+
+def test_find_by_twenty_digit_iccid(tmp_path):
+    store = SIMStore(str(tmp_path / "sim_store.db"))
+    store.save_sim("GP", _sim_basic_data(10040443715, "89860012345678901234"), [])
+
+    assert store.find("GP", "89860012345678901234")["sim_id"] == 10040443715
+    assert store.find("GP", "10040443715")["iccid"] == "89860012345678901234"
+    assert store.find("GP", "99999999999999999999") is None
+    assert store.get_sim_basic_data("GP", "89860012345678901234", 60)["sim_id"] == 10040443715
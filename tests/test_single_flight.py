@@ -0,0 +1,29 @@
+import threading
+
+import pytest
+
+from single_flight import SingleFlight, SingleFlightTimeout
+
+
+def test_waiter_times_out_while_leader_is_still_running():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'done'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(single_flight.do('GP', slow)))
+    leader.start()
+    started.wait(5)
+    try:
+        with pytest.raises(SingleFlightTimeout):
+            single_flight.do('GP', slow, timeout=0.05)
+    finally:
+        release.set()
+        leader.join(5)
+    assert results == ['done']
+    assert single_flight.stats()["shared"] == 1
@@ -0,0 +1,47 @@
+from sim_history import SIMChangeRecord
+from watchlist import WatchlistStore, diff_sim_data
+
+FIELDS = ["lifecycle", "session_type_now"]
+SIM_BASIC_DATA = {"sim_id": 1001, "iccid": "89860000000000001001", "lifecycle": "Activated",
+                  "session_type_now": "DATA"}
+
+
+def status_record(sim_change_id, date_modified, source_value, target_value):
+    return SIMChangeRecord('Status', source_value, target_value, date_modified, date_modified, 'ops',
+                           sim_change_id, date_modified)
+
+
+def test_diff_reports_second_change_of_an_already_seen_type():
+    first = status_record(1, 1700000000000, 'Inventory', 'Activated')
+    second = status_record(2, 1700000600000, 'Activated', 'Deactivated')
+    previous = {"sim_id": 1001, "sim_basic_data": SIM_BASIC_DATA, "history_watermark": (first.date_modified, 1)}
+    current = {"sim_id": 1001, "sim_basic_data": SIM_BASIC_DATA, "change_records": [second, first]}
+
+    changes, new_records, watermark = diff_sim_data(previous, current, FIELDS)
+
+    assert changes == {}
+    assert new_records == [second]
+    assert watermark == (second.date_modified, 2)
+
+
+def test_record_wave_emits_each_new_record_after_the_baseline(tmp_path):
+    store = WatchlistStore(str(tmp_path / 'watchlist.db'))
+    store.add('GP', ['89860000000000001001'], max_watches=10)
+    records = [status_record(1, 1700000000000, 'Inventory', 'Activated')]
+
+    def poll(records):
+        row = store.due_watches('GP', poll_interval=0, limit=10)[0]
+        return store.record_wave('GP', [(row, {"success": True, "sim_basic_data": SIM_BASIC_DATA,
+                                               "change_records": records})], FIELDS)
+
+    assert poll(records) == []
+    assert poll(records) == []
+
+    records = [status_record(2, 1700000600000, 'Activated', 'Deactivated')] + records
+    events = poll(records)
+    assert [item["target_value"] for item in events[0]["new_history"]] == ['Deactivated']
+
+    records = [status_record(3, 1700001200000, 'Deactivated', 'Activated')] + records
+    events = poll(records)
+    assert [item["sim_change_id"] for item in events[0]["new_history"]] == [3]
+    assert store.events('GP', since=0)[-1]["id"] == events[0]["id"]
@@ -0,0 +1,61 @@
+import functools
+from datetime import datetime, timedelta, timezone
+
+# Jasper返回的时间都是毫秒级时间戳，对外统一输出UTC时间的"%Y-%m-%d %H:%M:%S"
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MS_PER_DAY = 86400000
+
+
+def datetime_from_epoch_ms(value):
+    """
+    :param value: 毫秒级时间戳
+    :return: UTC时区的datetime
+    """
+    return _EPOCH + timedelta(milliseconds=value)
+
+
+def datetime_from_epoch_s(value):
+    """
+    :param value: 秒级时间戳
+    :return: UTC时区的datetime
+    """
+    return datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+def epoch_ms(value):
+    """
+    :param value: datetime
+    :return: 毫秒级时间戳
+    """
+    return int(value.timestamp() * 1000)
+
+
+@functools.lru_cache(maxsize=4096)
+def _date_prefix(day):
+    # 同一天的时间只格式化一次日期部分
+    return (_EPOCH + timedelta(days=day)).strftime("%Y-%m-%d ")
+
+
+def format_epoch_ms(value):
+    """
+    把毫秒级时间戳格式化为UTC时间字符串，结果与
+    datetime.fromtimestamp(value / 1000, tz=timezone.utc).strftime(DATETIME_FORMAT)相同，
+    日期部分按天缓存，时分秒直接由整数运算得到，不再为每个值构造datetime
+    :param value: 毫秒级时间戳
+    :return: "%Y-%m-%d %H:%M:%S"格式的字符串
+    """
+    day, ms_of_day = divmod(int(value), _MS_PER_DAY)
+    hours, remainder = divmod(ms_of_day // 1000, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f'{_date_prefix(day)}{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+
+def format_epoch_ms_batch(values):
+    """
+    批量格式化毫秒级时间戳
+    :param values: 毫秒级时间戳的可迭代对象
+    :return: 字符串列表，顺序与输入相同
+    """
+    return [format_epoch_ms(value) for value in values]
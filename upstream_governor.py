@@ -0,0 +1,230 @@
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import requests
+
+from metrics import span
+from rate_limit import TokenBucket
+from settings import load_settings
+
+# 上游请求调控的默认配置，可在service_settings.json的upstream_governor段中按项目覆盖
+UPSTREAM_GOVERNOR_DEFAULTS = {
+    "enabled": True,
+    # 令牌桶：每秒发往Jasper的请求数和瞬时突发数
+    "requests_per_second": 10,
+    "burst": 10,
+    # 自适应并发上限的初始值和范围
+    "initial_limit": 8,
+    "min_limit": 1,
+    "max_limit": 32,
+    # 单个请求耗时超过该值（秒）视为拥塞
+    "latency_target": 3.0,
+    # 拥塞时并发上限乘以该系数
+    "decrease_factor": 0.5,
+    # 排队等待并发名额和令牌的最长时间（秒），超过则快速失败
+    "queue_timeout": 10,
+    # 同时排队的请求数上限，超过时直接拒绝
+    "max_queue": 100,
+}
+
+# 协程等待并发名额时重新检查的间隔（秒）
+_ASYNC_POLL_INTERVAL = 0.01
+
+
+class UpstreamOverloaded(requests.exceptions.RequestException):
+    """
+    排队已满或者等待超过queue_timeout，请求没有发往Jasper
+    继承RequestException，调用方按上游错误(upstream_error)处理
+    """
+    def __init__(self, project, reason):
+        super().__init__(f'{project}项目上游请求被拒绝：{reason}')
+        self.project = project
+        self.reason = reason
+
+
+class ProjectGovernor:
+    """
+    单个项目发往Jasper的请求调控：令牌桶限速，加上AIMD自适应并发上限
+    请求成功且耗时正常时上限缓慢增加（每个上限窗口约加1），出现429、5xx、请求异常或耗时超过latency_target时
+    上限按decrease_factor减小；一次拥塞只减小一次，即只对上次减小之后发出的请求作出反应
+    """
+    def __init__(self, project, governor_settings):
+        self.project = project
+        self.governor_settings = governor_settings
+        self.min_limit = governor_settings["min_limit"]
+        self.max_limit = governor_settings["max_limit"]
+        self._bucket = TokenBucket(governor_settings["requests_per_second"], governor_settings["burst"])
+        self._condition = threading.Condition()
+        self._limit = float(min(max(governor_settings["initial_limit"], self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._waiting = 0
+        self._last_decrease_at = 0.0
+        self._counters = {"requests": 0, "congestion_signals": 0, "throttled": 0, "decreases": 0,
+                          "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    def _current_limit(self):
+        # 调用方需持有锁
+        return max(1, int(self._limit))
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.governor_settings["queue_timeout"]
+        with self._condition:
+            if self._in_flight >= self._current_limit() and self._waiting >= self.governor_settings["max_queue"]:
+                self._counters["rejected_queue_full"] += 1
+                raise UpstreamOverloaded(self.project, 'queue_full')
+            self._waiting += 1
+            try:
+                while self._in_flight >= self._current_limit():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["rejected_timeout"] += 1
+                        raise UpstreamOverloaded(self.project, 'queue_timeout')
+                    self._condition.wait(remaining)
+                self._in_flight += 1
+            finally:
+                self._waiting -= 1
+        # 拿到并发名额后再等令牌，等待时间同样计入截止时间
+        if not self._bucket.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            with self._condition:
+                self._in_flight -= 1
+                self._counters["rejected_timeout"] += 1
+                self._condition.notify()
+            raise UpstreamOverloaded(self.project, 'queue_timeout')
+
+    async def _acquire_async(self):
+        # 与_acquire相同的名额、令牌和截止时间，但不阻塞事件循环：
+        # 协程拿不到名额或令牌时让出事件循环，稍后再试；线程中的等待方仍由Condition唤醒
+        # 只有异步客户端会走到这里，同步查询路径不必导入asyncio
+        import asyncio
+
+        deadline = time.monotonic() + self.governor_settings["queue_timeout"]
+        with self._condition:
+            if self._in_flight >= self._current_limit() and self._waiting >= self.governor_settings["max_queue"]:
+                self._counters["rejected_queue_full"] += 1
+                raise UpstreamOverloaded(self.project, 'queue_full')
+            self._waiting += 1
+        try:
+            while True:
+                with self._condition:
+                    if self._in_flight < self._current_limit():
+                        self._in_flight += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["rejected_timeout"] += 1
+                        raise UpstreamOverloaded(self.project, 'queue_timeout')
+                await asyncio.sleep(min(remaining, _ASYNC_POLL_INTERVAL))
+        finally:
+            with self._condition:
+                self._waiting -= 1
+        while True:
+            wait = self._bucket.try_acquire()
+            if wait == 0:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._counters["rejected_timeout"] += 1
+                    self._condition.notify()
+                raise UpstreamOverloaded(self.project, 'queue_timeout')
+            await asyncio.sleep(min(wait, remaining))
+
+    def _release(self, started_at, latency, status_code, failed):
+        throttled = status_code == 429
+        congested = failed or throttled or (status_code is not None and status_code >= 500) \
+            or latency > self.governor_settings["latency_target"]
+        with self._condition:
+            self._in_flight -= 1
+            self._counters["requests"] += 1
+            if throttled:
+                self._counters["throttled"] += 1
+            if congested:
+                self._counters["congestion_signals"] += 1
+                if started_at >= self._last_decrease_at:
+                    self._limit = max(self.min_limit, self._limit * self.governor_settings["decrease_factor"])
+                    self._last_decrease_at = time.monotonic()
+                    self._counters["decreases"] += 1
+                    logging.info('%s项目上游拥塞，并发上限降为%d', self.project, self._current_limit())
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._condition.notify(max(0, self._current_limit() - self._in_flight))
+
+    @contextmanager
+    def slot(self, request_name=''):
+        """
+        排队获取并发名额和令牌后执行请求，结束时根据耗时和结果调整并发上限
+        调用方把响应状态码写入返回字典的status_code；块内抛出异常视为请求失败
+        :param request_name: 请求名，用于排队耗时指标
+        :raise UpstreamOverloaded: 排队已满或者超过queue_timeout
+        """
+        with span('upstream_queue', self.project, request_name):
+            self._acquire()
+        feedback = {"status_code": None}
+        started_at = time.monotonic()
+        failed = True
+        try:
+            yield feedback
+            failed = False
+        finally:
+            self._release(started_at, time.monotonic() - started_at, feedback["status_code"], failed)
+
+    @asynccontextmanager
+    async def async_slot(self, request_name=''):
+        """
+        slot的协程版本，与线程中的调用方共用同一个并发上限和令牌桶
+        :param request_name: 请求名，用于排队耗时指标
+        :raise UpstreamOverloaded: 排队已满或者超过queue_timeout
+        """
+        with span('upstream_queue', self.project, request_name):
+            await self._acquire_async()
+        feedback = {"status_code": None}
+        started_at = time.monotonic()
+        failed = True
+        try:
+            yield feedback
+            failed = False
+        finally:
+            self._release(started_at, time.monotonic() - started_at, feedback["status_code"], failed)
+
+    def stats(self):
+        """
+        :return: 当前并发上限、在途请求数、排队数以及各项计数
+        """
+        with self._condition:
+            stats = dict(self._counters)
+            stats.update({
+                "limit": self._current_limit(),
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "requests_per_second": self.governor_settings["requests_per_second"],
+            })
+            return stats
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def get_upstream_governor(project):
+    """
+    获取项目共享的上游请求调控器，该项目未启用时返回None
+    :param project: 项目名
+    """
+    with _governors_lock:
+        if project not in _governors:
+            governor_settings = load_settings('upstream_governor', UPSTREAM_GOVERNOR_DEFAULTS, project)
+            _governors[project] = ProjectGovernor(project, governor_settings) if governor_settings["enabled"] else None
+            logging.info('%s项目上游请求调控配置：%s', project, governor_settings)
+        return _governors[project]
+
+
+def upstream_governor_stats():
+    """
+    :return: {项目名: 调控器状态}，只包含已创建且启用的项目
+    """
+    with _governors_lock:
+        governors = [governor for governor in _governors.values() if governor is not None]
+    return {governor.project: governor.stats() for governor in governors}
@@ -0,0 +1,579 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from SIMDetailsGetter import SIMInfoGetter
+from rate_limit import TokenBucket
+from settings import load_settings
+from sim_history import filter_change_records
+from time_format import format_epoch_ms_batch
+
+# 关注列表的默认配置，可在service_settings.json的watchlist段中按项目覆盖
+WATCHLIST_DEFAULTS = {
+    "enabled": True,
+    "path": "data/watchlist.db",
+    # 每张卡多久轮询一次（秒）
+    "poll_interval": 60,
+    # 后台线程每隔多少秒检查一次是否有到期的卡
+    "check_interval": 5,
+    # 每一波最多轮询的卡数，按上次轮询时间从早到晚选取，轮询不完的留到下一波；
+    # 含history时一波约需wave_size / requests_per_second秒，应小于lease_ttl
+    "wave_size": 250,
+    # 每个项目最多关注的卡数
+    "max_watches": 20000,
+    # 轮询的部分：basic只用批量基础信息请求；含history时每张卡再请求一次变更历史（有水位时只取增量）
+    "include": ["basic", "history"],
+    # 比较这些基础信息字段，变化时产生事件
+    "fields": ["lifecycle", "session_type_now", "bound_vin", "imei", "iccid", "device_type"],
+    # 只关注这些changeTypeDisplay的新变更记录，null表示全部
+    "change_types": None,
+    # 轮询发往Jasper的请求速率和并发，留出余量给实时查询
+    "requests_per_second": 5,
+    "burst": 5,
+    "max_concurrency": 4,
+    "basic_data_batch_size": 100,
+    "basic_data_page_size": 500,
+    # 有事件时POST到该地址，为空则只能通过事件接口获取
+    "webhook_url": "",
+    "webhook_headers": {},
+    "webhook_timeout": 10,
+    "webhook_retries": 2,
+    # 事件保留的时间（秒）和条数
+    "event_retention": 86400,
+    "max_events": 100000,
+    # SSE连接最长保持的秒数，到期后由客户端带Last-Event-ID重连；无事件时每隔heartbeat_interval秒发一次心跳
+    "stream_max_seconds": 300,
+    "heartbeat_interval": 15,
+    # 多个进程共用同一个数据库时，只有持有租约的进程轮询该项目
+    "lease_ttl": 120,
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS watches (
+    project TEXT NOT NULL,
+    search_value TEXT NOT NULL,
+    added_at REAL NOT NULL,
+    -- 上一次轮询的结果，第一次轮询只记录基线，不产生事件
+    polled_at REAL,
+    sim_id INTEGER,
+    sim_basic_data TEXT,
+    -- 见过的最新变更记录的[dateModified, simChangeId]，还没有取过变更历史时为NULL
+    history_watermark TEXT,
+    error_message TEXT,
+    PRIMARY KEY (project, search_value)
+);
+CREATE INDEX IF NOT EXISTS watches_polled_at ON watches (project, polled_at);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_project ON events (project, id);
+CREATE TABLE IF NOT EXISTS poll_leases (
+    project TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+def _record_key(record):
+    return record.date_modified, record.sim_change_id
+
+
+def diff_sim_data(previous, current, fields):
+    """
+    对比同一张卡前后两次轮询的结果
+    变更历史按记录对比：比上次水位新的(dateModified, simChangeId)即为新记录，同一类型再次变更也能发现
+    :param previous: 上一次的{"sim_id", "sim_basic_data", "history_watermark"}，还没有取过变更历史时水位为None
+    :param current: 本次的{"sim_id", "sim_basic_data", "change_records"}，没有请求变更历史时change_records为None
+    :param fields: 需要比较的基础信息字段
+    :return: (基础信息变化{字段: {"old", "new"}}, 新的SIMChangeRecord列表（dateModified倒序）, 新水位)
+    """
+    changes = {}
+    if previous["sim_id"] != current["sim_id"]:
+        changes["sim_id"] = {"old": previous["sim_id"], "new": current["sim_id"]}
+    for field in fields:
+        old_value = previous["sim_basic_data"].get(field)
+        new_value = current["sim_basic_data"].get(field)
+        if old_value != new_value:
+            changes[field] = {"old": old_value, "new": new_value}
+    # 换了卡时上一张卡的水位不再适用，本次的变更历史只作为基线
+    watermark = None if "sim_id" in changes else previous["history_watermark"]
+    if current["change_records"] is None:
+        return changes, [], watermark
+    # 缺少dateModified或simChangeId的记录无法排序，不参与对比
+    records = [record for record in current["change_records"]
+               if record.date_modified is not None and record.sim_change_id is not None]
+    latest = max((_record_key(record) for record in records), default=None)
+    if watermark is None:
+        return changes, [], latest
+    new_records = sorted((record for record in records if _record_key(record) > watermark),
+                         key=_record_key, reverse=True)
+    return changes, new_records, max(watermark, latest) if latest is not None else watermark
+
+
+def format_change_records(records):
+    """
+    :param records: SIMChangeRecord列表
+    :return: 事件中的new_history，字段与sim_change_history的条目一致，另带change_type、simChangeId和dateModified
+    """
+    formatted_times = format_epoch_ms_batch([record.start_time for record in records] +
+                                            [record.end_time for record in records])
+    count = len(records)
+    return [
+        {
+            "change_type": record.change_type,
+            "target_value": record.target_value,
+            "source_value": record.source_value,
+            "start_time": formatted_times[index],
+            "end_time": formatted_times[count + index],
+            "change_by": record.user_name,
+            "sim_change_id": record.sim_change_id,
+            "date_modified": record.date_modified,
+        }
+        for index, record in enumerate(records)
+    ]
+
+
+class WatchlistStore:
+    """
+    SQLite中的关注列表、每张卡上一次的轮询结果和变化事件，多个进程可以共用
+    每个线程一个连接，写入在进程内串行；新事件写入时唤醒本进程内等待的长轮询
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._events_condition = threading.Condition()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._write_lock:
+            connection = self._connection()
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SCHEMA)
+            # 早先创建的数据库没有水位列
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(watches)')}
+            if 'history_watermark' not in columns:
+                connection.execute('ALTER TABLE watches ADD COLUMN history_watermark TEXT')
+            connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def add(self, project, search_values, max_watches):
+        """
+        :param project: 项目名
+        :param search_values: ICCID或VIN列表，已经关注的忽略
+        :param max_watches: 该项目最多关注的卡数
+        :return: 新增的个数，超过max_watches时返回None且不做任何修改
+        """
+        now = time.time()
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                existing = {row[0] for row in connection.execute(
+                    'SELECT search_value FROM watches WHERE project = ?', (project,))}
+                new_values = [value for value in dict.fromkeys(search_values) if value not in existing]
+                if len(existing) + len(new_values) > max_watches:
+                    return None
+                connection.executemany('INSERT INTO watches (project, search_value, added_at) VALUES (?, ?, ?)',
+                                       [(project, value, now) for value in new_values])
+        return len(new_values)
+
+    def remove(self, project, search_values):
+        """
+        :return: 实际移除的个数
+        """
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                return connection.executemany('DELETE FROM watches WHERE project = ? AND search_value = ?',
+                                              [(project, value) for value in search_values]).rowcount
+
+    def watches(self, project):
+        """
+        :return: [{"search_value", "added_at", "polled_at", "sim_id", "error_message"}]
+        """
+        rows = self._connection().execute("""
+            SELECT search_value, added_at, polled_at, sim_id, error_message FROM watches
+            WHERE project = ? ORDER BY added_at, search_value
+        """, (project,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def projects(self):
+        return [row[0] for row in self._connection().execute('SELECT DISTINCT project FROM watches')]
+
+    def due_watches(self, project, poll_interval, limit):
+        """
+        :return: 上次轮询早于poll_interval秒之前（或者还没轮询过）的卡，最早轮询的在前
+        """
+        rows = self._connection().execute("""
+            SELECT * FROM watches WHERE project = ? AND (polled_at IS NULL OR polled_at <= ?)
+            ORDER BY polled_at IS NOT NULL, polled_at LIMIT ?
+        """, (project, time.time() - poll_interval, limit)).fetchall()
+        return rows
+
+    def acquire_lease(self, project, owner, ttl):
+        """
+        取得或续期项目的轮询租约，其他进程的租约未过期时返回False
+        """
+        now = time.time()
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                return connection.execute("""
+                    INSERT INTO poll_leases (project, owner, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT (project) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                    WHERE poll_leases.expires_at < ? OR poll_leases.owner = excluded.owner
+                """, (project, owner, now + ttl, now)).rowcount == 1
+
+    def record_wave(self, project, results, fields):
+        """
+        保存一波轮询的结果，与上一次的结果对比，有变化的卡写入一条事件；每张卡第一次轮询只记录基线
+        :param project: 项目名
+        :param results: [(watches中的行, 轮询结果)]，成功的轮询结果为{"success": True, "sim_basic_data", "change_records"}，
+                        change_records缺省表示本次没有请求变更历史
+        :param fields: 需要比较的基础信息字段
+        :return: 新事件列表
+        """
+        now = time.time()
+        events = []
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                for row, sim_data in results:
+                    if not sim_data["success"]:
+                        connection.execute("""
+                            UPDATE watches SET polled_at = ?, error_message = ?
+                            WHERE project = ? AND search_value = ?
+                        """, (now, sim_data.get("error_message", "unknown_error"), project, row["search_value"]))
+                        continue
+                    sim_basic_data = sim_data["sim_basic_data"]
+                    current = {
+                        "sim_id": sim_basic_data["sim_id"],
+                        "sim_basic_data": sim_basic_data,
+                        "change_records": sim_data.get("change_records"),
+                    }
+                    if row["sim_basic_data"] is None:
+                        previous = {"sim_id": current["sim_id"], "sim_basic_data": sim_basic_data,
+                                    "history_watermark": None}
+                    else:
+                        previous = {
+                            "sim_id": row["sim_id"],
+                            "sim_basic_data": json.loads(row["sim_basic_data"]),
+                            "history_watermark": tuple(json.loads(row["history_watermark"]))
+                            if row["history_watermark"] is not None else None,
+                        }
+                    changes, new_records, watermark = diff_sim_data(previous, current, fields)
+                    if changes or new_records:
+                        event = {
+                            "project": project,
+                            "search_value": row["search_value"],
+                            "sim_id": current["sim_id"],
+                            "detected_at": int(now * 1000),
+                            "changes": changes,
+                            "new_history": format_change_records(new_records),
+                        }
+                        cursor = connection.execute(
+                            'INSERT INTO events (project, created_at, payload) VALUES (?, ?, ?)',
+                            (project, now, json.dumps(event, ensure_ascii=False)))
+                        event["id"] = cursor.lastrowid
+                        events.append(event)
+                    connection.execute("""
+                        UPDATE watches SET polled_at = ?, sim_id = ?, sim_basic_data = ?, history_watermark = ?,
+                                           error_message = NULL
+                        WHERE project = ? AND search_value = ?
+                    """, (now, current["sim_id"], json.dumps(sim_basic_data, ensure_ascii=False),
+                          json.dumps(watermark) if watermark is not None else None,
+                          project, row["search_value"]))
+        if events:
+            with self._events_condition:
+                self._events_condition.notify_all()
+        return events
+
+    def prune_events(self, project, retention, max_events):
+        """
+        删除超过保留时间或者超出条数的事件
+        """
+        with self._write_lock:
+            connection = self._connection()
+            with connection:
+                connection.execute('DELETE FROM events WHERE project = ? AND created_at < ?',
+                                   (project, time.time() - retention))
+                connection.execute("""
+                    DELETE FROM events WHERE project = ? AND id <= (
+                        SELECT id FROM events WHERE project = ? ORDER BY id DESC LIMIT 1 OFFSET ?)
+                """, (project, project, max_events))
+
+    def last_event_id(self, project):
+        row = self._connection().execute('SELECT max(id) FROM events WHERE project = ?', (project,)).fetchone()
+        return row[0] or 0
+
+    def events(self, project, since, limit=500):
+        """
+        :param since: 只返回id大于该值的事件
+        :return: 事件列表，id升序
+        """
+        rows = self._connection().execute("""
+            SELECT id, payload FROM events WHERE project = ? AND id > ? ORDER BY id LIMIT ?
+        """, (project, since, limit)).fetchall()
+        events = []
+        for row in rows:
+            event = json.loads(row["payload"])
+            event["id"] = row["id"]
+            events.append(event)
+        return events
+
+    def wait_for_events(self, project, since, timeout, limit=500):
+        """
+        长轮询：有id大于since的事件时立即返回，否则最多等待timeout秒
+        本进程写入的事件会立即唤醒；其他进程写入的事件每秒检查一次
+        :return: 事件列表，超时时为空列表
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.events(project, since, limit)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return events
+            with self._events_condition:
+                self._events_condition.wait(min(remaining, 1.0))
+
+    def stats(self):
+        connection = self._connection()
+        return {
+            "watches": dict(connection.execute('SELECT project, count(*) FROM watches GROUP BY project')),
+            "events": dict(connection.execute('SELECT project, count(*) FROM events GROUP BY project')),
+        }
+
+
+class WebhookNotifier:
+    """
+    把一波轮询的事件POST到配置的webhook，失败时按webhook_retries重试，仍失败则只记录日志，
+    事件仍可以通过事件接口取到
+    """
+    def __init__(self):
+        self.session = requests.Session()
+
+    def notify(self, project, events, watch_settings):
+        """
+        :return: 是否送达
+        """
+        body = json.dumps({"project": project, "events": events}, ensure_ascii=False).encode('utf-8')
+        headers = {"Content-Type": "application/json"}
+        headers.update(watch_settings["webhook_headers"])
+        for attempt in range(watch_settings["webhook_retries"] + 1):
+            try:
+                response = self.session.post(watch_settings["webhook_url"], data=body, headers=headers,
+                                             timeout=watch_settings["webhook_timeout"])
+                if response.status_code < 300:
+                    return True
+                logging.error('%s项目webhook返回%s', project, response.status_code)
+            except requests.exceptions.RequestException as e:
+                logging.error('%s项目webhook请求失败：%r', project, e)
+            if attempt < watch_settings["webhook_retries"]:
+                time.sleep(min(2 ** attempt, 30))
+        return False
+
+
+class WatchlistPoller(threading.Thread):
+    """
+    后台线程：按波轮询关注列表中到期的卡，用批量请求获取基础信息，需要时再按卡请求变更历史，
+    把变化写成事件并推送到webhook；所有订阅方共用这一次轮询，不必各自轮询
+    """
+    def __init__(self, store):
+        super().__init__(name='watchlist-poller', daemon=True)
+        self.store = store
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.notifier = WebhookNotifier()
+        self._stop_event = threading.Event()
+        self._rate_limiters = {}
+        self._counters_lock = threading.Lock()
+        self._counters = {}
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _count(self, project, **increments):
+        with self._counters_lock:
+            counters = self._counters.setdefault(project, {
+                "waves": 0, "sims_polled": 0, "lookup_failures": 0, "events": 0, "webhook_failures": 0,
+                "last_wave_seconds": None,
+            })
+            for name, value in increments.items():
+                if name == "last_wave_seconds":
+                    counters[name] = value
+                else:
+                    counters[name] += value
+
+    def stats(self):
+        with self._counters_lock:
+            return {project: dict(counters) for project, counters in self._counters.items()}
+
+    def _rate_limiter(self, project, watch_settings):
+        rate_limiter = self._rate_limiters.get(project)
+        if rate_limiter is None:
+            rate_limiter = TokenBucket(watch_settings["requests_per_second"], watch_settings["burst"])
+            self._rate_limiters[project] = rate_limiter
+        return rate_limiter
+
+    def fetch_basic_data(self, project, search_values, watch_settings):
+        """
+        分批请求基础信息，cookies失效时更新一次后重试失效的部分
+        :return: {查询值: 与fetch_sim_basic_data相同格式的结果}
+        """
+        sim_info_getter = SIMInfoGetter(project)
+        rate_limiter = self._rate_limiter(project, watch_settings)
+        batch_size = watch_settings["basic_data_batch_size"]
+        results = {}
+        for start in range(0, len(search_values), batch_size):
+            chunk = search_values[start:start + batch_size]
+            rate_limiter.acquire()
+            results.update(sim_info_getter.get_sim_basic_data_batch(chunk, batch_size,
+                                                                    watch_settings["basic_data_page_size"]))
+        expired = [value for value, result in results.items()
+                   if not result["success"] and result["error_message"] == "cookies_need_update"]
+        if expired and sim_info_getter.update_cookies():
+            for start in range(0, len(expired), batch_size):
+                rate_limiter.acquire()
+                results.update(sim_info_getter.get_sim_basic_data_batch(expired[start:start + batch_size],
+                                                                        batch_size,
+                                                                        watch_settings["basic_data_page_size"]))
+        return results
+
+    def fetch_sim_data(self, project, search_value, sim_basic_data, watch_settings):
+        """
+        已有基础信息时只请求变更历史（有水位时只取增量），结果同时写入结果缓存和本地存储，实时查询也能用上
+        :return: {"success": True, "sim_basic_data", "change_records"}，失败时为带error_message的字典
+        """
+        self._rate_limiter(project, watch_settings).acquire()
+        try:
+            sim_info_getter = SIMInfoGetter(project, search_value)
+            error_message, change_records = sim_info_getter.fetch_sim_change_records(sim_basic_data["sim_id"])
+            if error_message == "cookies_need_update" and sim_info_getter.update_cookies():
+                error_message, change_records = sim_info_getter.fetch_sim_change_records(sim_basic_data["sim_id"])
+            if error_message is not None:
+                return {"success": False, "error_message": error_message}
+            sim_info_getter.save_sim_data(sim_basic_data, change_records)
+        except Exception:
+            logging.exception('%s项目轮询%s失败', project, search_value)
+            return {"success": False, "error_message": "unknown_error"}
+        if watch_settings["change_types"] is not None:
+            change_records = list(filter_change_records(change_records, watch_settings["change_types"]))
+        return {"success": True, "sim_basic_data": sim_basic_data, "change_records": change_records}
+
+    def poll_wave(self, project, watch_settings):
+        """
+        轮询一波到期的卡并记录变化
+        :return: 新事件列表
+        """
+        rows = self.store.due_watches(project, watch_settings["poll_interval"], watch_settings["wave_size"])
+        if not rows:
+            return []
+        start = time.perf_counter()
+        search_values = [row["search_value"] for row in rows]
+        basic_results = self.fetch_basic_data(project, search_values, watch_settings)
+        results = {value: basic_results.get(value, {"success": False, "error_message": "unknown_error"})
+                   for value in search_values}
+        if "history" in watch_settings["include"]:
+            with ThreadPoolExecutor(max_workers=watch_settings["max_concurrency"],
+                                    thread_name_prefix=f'watchlist-{project}') as executor:
+                futures = {
+                    value: executor.submit(self.fetch_sim_data, project, value, result["sim_basic_data"],
+                                           watch_settings)
+                    for value, result in results.items() if result["success"]
+                }
+                for value, future in futures.items():
+                    results[value] = future.result()
+        events = self.store.record_wave(project, [(row, results[row["search_value"]]) for row in rows],
+                                        watch_settings["fields"])
+        failures = sum(1 for result in results.values() if not result["success"])
+        elapsed = time.perf_counter() - start
+        self._count(project, waves=1, sims_polled=len(rows), lookup_failures=failures, events=len(events),
+                    last_wave_seconds=round(elapsed, 3))
+        logging.info('%s项目关注列表轮询%s张卡，失败%s张，%s条变化，耗时%.1f秒',
+                     project, len(rows), failures, len(events), elapsed)
+        if events and watch_settings["webhook_url"]:
+            if not self.notifier.notify(project, events, watch_settings):
+                self._count(project, webhook_failures=1)
+        self.store.prune_events(project, watch_settings["event_retention"], watch_settings["max_events"])
+        return events
+
+    def check_project(self, project):
+        watch_settings = load_settings('watchlist', WATCHLIST_DEFAULTS, project)
+        if not self.store.acquire_lease(project, self.owner, watch_settings["lease_ttl"]):
+            return
+        self.poll_wave(project, watch_settings)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for project in self.store.projects():
+                try:
+                    self.check_project(project)
+                except Exception:
+                    logging.exception('%s项目关注列表轮询失败', project)
+            check_interval = load_settings('watchlist', WATCHLIST_DEFAULTS)["check_interval"]
+            self._stop_event.wait(check_interval)
+
+
+_store = None
+_poller = None
+_watchlist_lock = threading.Lock()
+
+
+def get_watchlist_store():
+    """
+    获取进程共享的关注列表存储，未启用时返回None
+    """
+    global _store
+    with _watchlist_lock:
+        if _store is None:
+            watch_settings = load_settings('watchlist', WATCHLIST_DEFAULTS)
+            if not watch_settings["enabled"]:
+                return None
+            _store = WatchlistStore(watch_settings["path"])
+            logging.info('已打开关注列表存储：%s', watch_settings["path"])
+        return _store
+
+
+def start_watchlist_poller():
+    """
+    按配置启动关注列表的后台轮询线程，未启用时返回None
+    """
+    global _poller
+    store = get_watchlist_store()
+    if store is None:
+        return None
+    with _watchlist_lock:
+        if _poller is None:
+            _poller = WatchlistPoller(store)
+            _poller.start()
+            logging.info('关注列表后台轮询线程已启动')
+        return _poller
+
+
+def watchlist_stats():
+    """
+    :return: 各项目关注的卡数、事件数和本进程的轮询计数
+    """
+    store = get_watchlist_store()
+    if store is None:
+        return {}
+    stats = store.stats()
+    stats["poller"] = _poller.stats() if _poller is not None else {}
+    return stats